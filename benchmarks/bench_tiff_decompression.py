@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark of the threaded decoding of compressed TIFF files.
+
+The TIFF samples of :mod:`sktracker.data` are re-saved with zlib
+compression (their planes optionally tiled in X and Y to make them
+bigger), then read with `TiffFile.asarray` and iterated over as stacks
+with `StackIO.image_iterator` for several numbers of threads.
+
+Usage::
+
+    python benchmarks/bench_tiff_decompression.py --scale 8 --workers 1 2 4
+"""
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+
+from sktracker import data
+from sktracker.io import StackIO
+from sktracker.io import TiffFile
+from sktracker.io import imsave
+
+SAMPLES = ['CZT_peaks', 'sample_ome', 'TZ_nucleus', 'TC_BF_cells']
+
+
+def compressed_copy(name, directory, scale, compress):
+    """Saves sample `name` with zlib compression, returns its file name
+    and metadata.
+    """
+    st = StackIO(getattr(data, name)())
+    with TiffFile(st.image_path) as tf:
+        arr = tf.asarray()
+    arr = np.tile(arr, (1,) * (arr.ndim - 2) + (scale, scale))
+
+    metadata = st.metadata.copy()
+    metadata['Shape'] = arr.shape
+    metadata['SizeY'], metadata['SizeX'] = arr.shape[-2:]
+
+    filename = os.path.join(directory, name + '.tif')
+    imsave(filename, arr, compress=compress)
+    metadata['FileName'] = filename
+    return filename, metadata
+
+
+def best_time(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', type=int, default=8,
+                        help='Tiling of the planes in X and Y')
+    parser.add_argument('--compress', type=int, default=6,
+                        help='zlib compression level')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        for name in SAMPLES:
+            filename, metadata = compressed_copy(name, directory,
+                                                 args.scale, args.compress)
+            st = StackIO(filename, metadata=metadata)
+            print('{}: shape {}, {:.1f} MB compressed'.format(
+                name, metadata['Shape'], os.path.getsize(filename) / 2**20))
+
+            for maxworkers in args.workers:
+
+                def read_all():
+                    with TiffFile(filename) as tf:
+                        tf.asarray(maxworkers=maxworkers)
+
+                def iterate_stacks():
+                    for stack in st.image_iterator(position=-3,
+                                                   maxworkers=maxworkers)():
+                        pass
+
+                print('    {:2d} threads: asarray {:.3f}s, image_iterator {:.3f}s'.format(
+                    maxworkers, best_time(read_all, args.repeat),
+                    best_time(iterate_stacks, args.repeat)))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
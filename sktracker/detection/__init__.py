@@ -14,5 +14,7 @@ from __future__ import print_function
 from .peak_detector import peak_detector
 from .cell_boundaries_detector import cell_boundaries_detector
 from .nuclei_detector import nuclei_detector
+from .executor import DetectionExecutor
 
-__all__ = ['peak_detector', 'cell_boundaries_detector', 'nuclei_detector']
+__all__ = ['peak_detector', 'cell_boundaries_detector', 'nuclei_detector',
+           'DetectionExecutor']
@@ -24,17 +24,25 @@ from skimage.morphology import medial_axis
 from skimage.morphology import label
 
 from ..utils.progress import print_progress
+from .executor import DetectionExecutor
 
 __all__ = []
 
 DEFAULT_PARAMETERS = {'object_height': 3,
-                      'minimal_area': 160}
+                      'minimal_area': 160,
+                      'closing_search': 'linear'}
+
+CLOSING_SEARCHES = ('bisect', 'linear')
+
+CELL_PROPERTIES = ['centroid_x', 'centroid_y', 'orientation', 'major_axis', 'minor_axis']
 
 
 def cell_boundaries_detector(data_iterator,
                              metadata,
                              show_progress=False,
-                             parameters={}):
+                             parameters={},
+                             parallel=True,
+                             executor=None):
     """
     Find cell boundary in bright field microscopy image.
 
@@ -53,6 +61,16 @@ def cell_boundaries_detector(data_iterator,
             Typical size of the object in um.
         minimal_area : float
             Typical area of the object in um^2.
+        closing_search : str
+            How the size of the closing structuring element is searched
+            for, see `closed_cell_props`: 'linear' (default) or 'bisect'.
+    parallel : bool (default: True)
+        Process the time points in several processes at once. Ignored if
+        `executor` is given.
+    executor : :class:`sktracker.detection.executor.DetectionExecutor`, optional
+        Pool running the detection, which can then be reused across
+        calls. By default, a pool with one process per CPU is created
+        (if `parallel` is True) and closed at the end of the detection.
 
     Returns
     ------()
@@ -64,93 +82,63 @@ def cell_boundaries_detector(data_iterator,
     _parameters.update(parameters)
     parameters = _parameters
 
+    if parameters['closing_search'] not in CLOSING_SEARCHES:
+        raise ValueError('Unknown closing search {}, should be one of {}'.format(
+            parameters['closing_search'], CLOSING_SEARCHES))
+
     # Load parameters
     sigma = parameters['object_height'] / metadata['PhysicalSizeZ']
     minimal_area = parameters['minimal_area'] / metadata['PhysicalSizeX']
 
-    sizeX = metadata['SizeX']
-    sizeY = metadata['SizeY']
+    own_executor = executor is None
+    if own_executor:
+        executor = DetectionExecutor(n_workers=None if parallel else 0)
 
-    # calculate the correlation image from the z-stack
+    # Only the properties of the cell are kept for each time point
     cellprop = []
     t_tot = metadata['SizeT']
-    for t, imt in enumerate(data_iterator):
-
-        if show_progress:
-            p = int(float(t + 1) / t_tot * 100.)
-            print_progress(p)
-
-        if np.any(imt) != 0:
-            corr = np.zeros((sizeY, sizeX))
-
-            for y, x in np.ndindex(sizeY, sizeX):
-                Iz = imt[:, y, x]
-                z = np.array(range(len(Iz)))
-                zf = len(Iz) / 2
-                corr[y, x] = integrate.simps(Iz[z] * (z - zf) * np.exp(-(zf - z) ** 2 /
-                                             (2 * sigma ** 2)), z)
-
-            # create binary mask of the correlation image
-            thresh = threshold_otsu(corr)
-            mask = corr > thresh
-
-            area = 0
-            n = 2
-
-            prevarea = None
-            prevcellprop = None
-
-            # un seuil pas trop petit au cas où il resterait des petits objets
-            # dans l'image
-            while area < minimal_area and prevarea != area:
-                tophat = binary_closing(mask, square(n))
-                n += 1
-                skel = medial_axis(tophat)
-                skel = (skel - 1) * (-1)
-                cleared = clear_border(skel)
-                labelized = label(cleared, 8, 0) + 1
-
-                # add cell characteristic in the cellprop list
-                if np.any(labelized):
-                    prevcellprop = regionprops(
-                        labelized, intensity_image=corr)[0]
-
-                prevarea = area
-                if prevcellprop:
-                    area = prevcellprop['area']
-
-            if prevcellprop:
-                cellprop.append(prevcellprop)
-
-            else:
-                if len(cellprop) >= 1:
-                    cellprop.append(cellprop[-1])
-                else:
-                    cellprop.append(None)
-        else:
-                if len(cellprop) >= 1:
-                    cellprop.append(cellprop[-1])
-                else:
-                    cellprop.append(None)
+    try:
+        for t, props in executor.map(detect_one_frame, data_iterator,
+                                     args=(sigma, minimal_area,
+                                           parameters['closing_search']),
+                                     ordered=True):
+
+            if show_progress:
+                p = int(float(t + 1) / t_tot * 100.)
+                print_progress(p)
+
+            # Use the previous cell shape when none is found
+            if props is None and len(cellprop) >= 1:
+                props = cellprop[-1]
+            cellprop.append(props)
+
+    except KeyboardInterrupt:
+        if own_executor:
+            executor.terminate()
+        raise Exception('Detection has been canceled by user')
+
+    except Exception:
+        if own_executor:
+            executor.terminate()
+        raise
+
+    if own_executor:
+        executor.close()
 
     print_progress(-1)
 
     # class cell morphology in time in the props Dataframe (time, centroid X,
     # centroid Y, ...)
-    listprop = ['centroid_x', 'centroid_y', 'orientation', 'major_axis', 'minor_axis']
-    cell_Prop = np.zeros((len(listprop) + 1, metadata["SizeT"]))
+    scale = np.array([metadata['PhysicalSizeX'], metadata['PhysicalSizeX'], 1,
+                      metadata['PhysicalSizeX'], metadata['PhysicalSizeX']])
+    cell_Prop = np.zeros((metadata["SizeT"], len(CELL_PROPERTIES) + 1))
 
     for i in range(metadata["SizeT"]):
-        if cellprop[i]:
-            cell_Prop[0, i] = i
-            cell_Prop[1, i] = cellprop[i]['centroid'][0] * metadata['PhysicalSizeX']
-            cell_Prop[2, i] = cellprop[i]['centroid'][1] * metadata['PhysicalSizeX']
-            cell_Prop[3, i] = cellprop[i]['orientation']
-            cell_Prop[4, i] = cellprop[i]['major_axis_length'] * metadata['PhysicalSizeX']
-            cell_Prop[5, i] = cellprop[i]['minor_axis_length'] * metadata['PhysicalSizeX']
-
-    cell_Prop = cell_Prop.T
-    props = pd.DataFrame(cell_Prop, columns=['t_stamp'] + listprop)
+        if cellprop[i] is not None:
+            cell_Prop[i, 0] = i
+            cell_Prop[i, 1:] = cellprop[i] * scale
+
+    props = pd.DataFrame(cell_Prop, columns=['t_stamp'] + CELL_PROPERTIES)
     props = props.set_index('t_stamp')
     props['t'] = props.index.get_level_values('t_stamp') * metadata['TimeIncrement']
     props = props.astype(np.float)
@@ -159,3 +147,192 @@ def cell_boundaries_detector(data_iterator,
         return pd.DataFrame([])
     else:
         return props
+
+
+def detect_one_frame(imt, sigma, minimal_area, closing_search='linear'):
+    """
+    Find the cell boundary in one z-stack.
+
+    Parameters
+    ----------
+    imt : 3D array
+        The z-stack, of shape (nz, ny, nx)
+    sigma : float
+        Typical height of the object, in planes
+    minimal_area : float
+        Typical area of the object, in pixels
+    closing_search : str
+        'linear' or 'bisect', see `closed_cell_props`
+
+    Returns
+    -------
+    props : 1D array or None
+        Centroid (two values), orientation, major and minor axis lengths
+        of the cell in pixels, in the order of `CELL_PROPERTIES`, or None
+        if no cell is found.
+    """
+    if not np.any(imt):
+        return None
+
+    # calculate the correlation image from the z-stack
+    corr = correlation_image(imt, sigma)
+
+    # create binary mask of the correlation image
+    thresh = threshold_otsu(corr)
+    mask = corr > thresh
+
+    cellprop = closed_cell_props(mask, corr, minimal_area, closing_search)
+    if cellprop is None:
+        return None
+    return np.array([cellprop['centroid'][0],
+                     cellprop['centroid'][1],
+                     cellprop['orientation'],
+                     cellprop['major_axis_length'],
+                     cellprop['minor_axis_length']])
+
+
+def closed_cell_props(mask, corr, minimal_area, closing_search='linear'):
+    """
+    Closes `mask` with a square structuring element of increasing size `n`
+    until the cell found in it covers `minimal_area`.
+
+    Parameters
+    ----------
+    mask : 2D bool array
+    corr : 2D array
+        Correlation image `mask` is computed from
+    minimal_area : float
+        In pixels
+    closing_search : str
+        With 'linear', `n` grows one step at a time from 2, until the
+        area is reached or stops changing. With 'bisect', `n` is doubled
+        until the area is reached or stops changing, and the smallest `n`
+        reaching it is then bisected for. This assumes the cell area
+        grows with `n`: both give the same cell when the area increases
+        at each step until `minimal_area`, but the bisection goes past
+        the plateaus the linear search stops on.
+
+    Returns
+    -------
+    cellprop : :class:`skimage.measure._regionprops.RegionProperties` or None
+        The last cell found, or None if there is no cell for `n` = 2.
+    """
+    def cell_props(n):
+        return _cell_props(mask, n, corr)
+
+    if closing_search == 'bisect':
+        return _bisect_closing(cell_props, minimal_area, max(mask.shape))
+    return _linear_closing(cell_props, minimal_area)
+
+
+def _linear_closing(cell_props, minimal_area):
+
+    area = 0
+    n = 2
+
+    prevarea = None
+    prevcellprop = None
+
+    # un seuil pas trop petit au cas où il resterait des petits objets
+    # dans l'image
+    while area < minimal_area and prevarea != area:
+        cellprop = cell_props(n)
+        n += 1
+
+        if cellprop is not None:
+            prevcellprop = cellprop
+
+        prevarea = area
+        if prevcellprop is not None:
+            area = prevcellprop['area']
+
+    return prevcellprop
+
+
+def _bisect_closing(cell_props, minimal_area, max_n):
+
+    found = {}
+
+    def cellprop(n):
+        if n not in found:
+            found[n] = cell_props(n)
+        return found[n]
+
+    # As the linear search, stops if there is no cell for n = 2, and
+    # keeps the last cell found
+    lastcellprop = cellprop(2)
+    if lastcellprop is None:
+        return None
+
+    low, high = None, 2
+    while lastcellprop['area'] < minimal_area:
+        if high >= max_n:
+            return lastcellprop
+        low, high = high, min(2 * high, max_n)
+        newcellprop = cellprop(high)
+        if newcellprop is None:
+            return lastcellprop
+        # The cell is not growing anymore
+        if newcellprop['area'] == lastcellprop['area']:
+            return newcellprop
+        lastcellprop = newcellprop
+
+    if low is None:
+        return lastcellprop
+
+    # Smallest n reaching minimal_area, in ]low, high]
+    while high - low > 1:
+        middle = (low + high) // 2
+        newcellprop = cellprop(middle)
+        if newcellprop is None or newcellprop['area'] < minimal_area:
+            low = middle
+        else:
+            high = middle
+    return cellprop(high)
+
+
+def _cell_props(mask, n, corr):
+    """Properties of the first region delimited by the skeleton of `mask`
+    closed by a square of size `n`, or None.
+    """
+    tophat = binary_closing(mask, square(n))
+    skel = medial_axis(tophat)
+    skel = (skel - 1) * (-1)
+    cleared = clear_border(skel)
+    labelized = label(cleared, 8, 0) + 1
+
+    # add cell characteristic in the cellprop list
+    if np.any(labelized):
+        return regionprops(labelized, intensity_image=corr)[0]
+    return None
+
+
+def correlation_image(stack, sigma):
+    """
+    Integral along z of the intensity of each pixel of `stack` weighted by
+    `(z - zf) * exp(-(z - zf)**2 / (2 * sigma**2))`, `zf` being the middle
+    of the stack, computed with Simpson's rule.
+
+    Simpson's rule being linear, the integration weights are combined with
+    the Gaussian weights in a single kernel, which is contracted with the
+    stack along z.
+
+    Parameters
+    ----------
+    stack : 3D array
+        Of shape (nz, ny, nx)
+    sigma : float
+        Gaussian width, in planes
+
+    Returns
+    -------
+    corr : 2D array
+        Of shape (ny, nx)
+    """
+    n_z = stack.shape[0]
+    z = np.arange(n_z)
+    zf = n_z / 2
+    profile = (z - zf) * np.exp(-(zf - z) ** 2 / (2 * sigma ** 2))
+    # Row k is the integral of the profile restricted to plane k
+    kernel = integrate.simps(np.eye(n_z) * profile, z)
+    return np.tensordot(kernel, np.asarray(stack, dtype=np.float64), axes=(0, 0))
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+
+import os
+import sys
+import mmap
+import shutil
+import signal
+import tempfile
+import itertools
+import traceback
+import collections
+import multiprocessing
+
+try:
+    import queue  # py3k
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+import logging
+log = logging.getLogger(__name__)
+
+__all__ = ['DetectionExecutor']
+
+# Pools report failures to an error callback since Python 3.2 only
+_HAS_ERROR_CALLBACK = sys.version_info >= (3, 2)
+
+
+class DetectionExecutor(object):
+    """Reusable process pool running a detection function over the frames
+    of a stack.
+
+    Frames are not pickled to the workers: a frame which is a contiguous
+    view of a file (such as the arrays returned by
+    :meth:`sktracker.io.StackIO.image_iterator` with `memmap=True`) is sent
+    as its file name and offset, other frames are written to a spool file
+    (in shared memory when `/dev/shm` exists) and mapped back by the
+    workers. Only `window` frames are spooled at a time.
+
+    CPU affinity of the process is left untouched.
+
+    Parameters
+    ----------
+    n_workers : int, optional
+        Number of worker processes, defaults to the number of CPUs. With
+        `n_workers=0`, frames are processed in the calling process.
+    chunksize : int, optional
+        Number of frames sent to a worker at once.
+    window : int, optional
+        Maximum number of chunks submitted and not yet returned,
+        defaults to twice the number of workers.
+    spool_dir : str, optional
+        Where to write the spooled frames.
+
+    Examples
+    --------
+    >>> with DetectionExecutor(n_workers=4) as executor:
+    ...     for position, result in executor.map(np.mean, frames):
+    ...         print(position, result)
+
+    """
+
+    def __init__(self, n_workers=None, chunksize=1, window=None, spool_dir=None):
+
+        if n_workers is None:
+            n_workers = multiprocessing.cpu_count()
+        self.n_workers = n_workers
+        self.chunksize = max(int(chunksize), 1)
+        if window is None:
+            window = 2 * max(n_workers, 1)
+        self.window = max(int(window), 1)
+
+        if spool_dir is None and os.path.isdir('/dev/shm'):
+            spool_dir = '/dev/shm'
+        self.spool_dir = spool_dir
+
+        self._pool = None
+        self._spool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(processes=self.n_workers,
+                                              initializer=_init_worker)
+        if self._spool is None:
+            self._spool = tempfile.mkdtemp(prefix='sktracker_', dir=self.spool_dir)
+        return self._pool
+
+    def close(self):
+        """Waits for the workers to finish and removes the spool files.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        self._remove_spool()
+
+    def terminate(self):
+        """Stops the workers immediately and removes the spool files.
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        self._remove_spool()
+
+    def _remove_spool(self):
+        if self._spool is not None:
+            shutil.rmtree(self._spool, ignore_errors=True)
+            self._spool = None
+
+    def map(self, function, frames, args=(), kwargs=None, ordered=True):
+        """Applies `function(frame, *args, **kwargs)` to each frame.
+
+        Parameters
+        ----------
+        function : callable
+            Must be defined at the top level of a module. Frames it
+            receives in the workers are copy on write memory maps.
+        frames : iterable of arrays
+        args : tuple
+        kwargs : dict
+        ordered : bool
+            If False, results are yielded as soon as they are available.
+
+        Yields
+        ------
+        position : int
+            Position of the frame in `frames`
+        result : object
+            Value returned by `function`
+        """
+        kwargs = kwargs or {}
+
+        if self.n_workers == 0:
+            for position, frame in enumerate(frames):
+                yield position, function(frame, *args, **kwargs)
+            return
+
+        pool = self._get_pool()
+        # Without error callback, a failed chunk would never be put on `done`
+        ordered = ordered or not _HAS_ERROR_CALLBACK
+        frames = enumerate(frames)
+        free_slots = list(range(self.window))
+        pending = collections.deque()
+        done = queue.Queue()
+
+        def submit():
+            chunk = list(itertools.islice(frames, self.chunksize))
+            if not chunk:
+                return False
+            slot = free_slots.pop()
+            refs = [(position, self._share(frame, slot, n))
+                    for n, (position, frame) in enumerate(chunk)]
+            callbacks = {}
+            if not ordered:
+                # Chunks failing in the pool, e.g. with a result which can't
+                # be pickled, put their exception on `done`
+                callbacks['callback'] = lambda res: done.put((slot, res))
+                callbacks['error_callback'] = lambda exc: done.put((slot, exc))
+            result = pool.apply_async(_run_chunk, (function, refs, args, kwargs),
+                                      **callbacks)
+            pending.append((slot, result))
+            return True
+
+        exhausted = False
+        while True:
+            while not exhausted and free_slots:
+                exhausted = not submit()
+            if not pending:
+                break
+            if ordered:
+                slot, result = pending.popleft()
+                results = result.get()
+            else:
+                slot, results = done.get()
+                pending.remove(next(item for item in pending if item[0] == slot))
+                if isinstance(results, BaseException):
+                    raise results
+            free_slots.append(slot)
+            for position, success, value in results:
+                if not success:
+                    exception, formatted = value
+                    log.error('Processing of frame %i failed:\n%s', position, formatted)
+                    raise exception
+                yield position, value
+
+    def _share(self, frame, slot, n):
+        """Returns a reference from which a worker can map `frame` back.
+        Masked arrays are sent as is.
+        """
+        if isinstance(frame, np.ma.MaskedArray):
+            return frame
+        frame = np.asarray(frame)
+        location = _memmap_location(frame)
+        if location is None:
+            filename = os.path.join(self._spool, '{}_{}'.format(slot, n))
+            with open(filename, 'wb') as spool_file:
+                np.ascontiguousarray(frame).tofile(spool_file)
+            location = (filename, 0)
+        filename, offset = location
+        return (filename, offset, frame.dtype.str, frame.shape)
+
+
+def _memmap_location(frame):
+    """File name and offset of the data of `frame` if it is a C contiguous
+    view of a :class:`numpy.memmap`, else None.
+    """
+    if not frame.flags.c_contiguous or frame.size == 0:
+        return None
+    root = frame
+    while isinstance(root.base, np.ndarray):
+        root = root.base
+    if not (isinstance(root, np.memmap) and isinstance(root.base, mmap.mmap)
+            and root.filename):
+        return None
+    # Temporary files are often unlinked once mapped
+    if not os.path.isfile(root.filename):
+        return None
+    # The root array data starts at `root.offset` in the file
+    shift = frame.__array_interface__['data'][0] - root.__array_interface__['data'][0]
+    return (root.filename, root.offset + shift)
+
+
+def _init_worker():
+    # Interruptions are handled by the parent process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _map_frame(ref):
+    """Reads back a frame shared by `DetectionExecutor._share`.
+    """
+    if isinstance(ref, np.ndarray):
+        return ref
+    filename, offset, dtype, shape = ref
+    if not int(np.prod(shape)):
+        return np.zeros(shape, dtype=np.dtype(dtype))
+    # Copy on write, modifications stay in the worker
+    return np.memmap(filename, dtype=np.dtype(dtype), mode='c',
+                     offset=offset, shape=tuple(shape))
+
+
+def _run_chunk(function, refs, args, kwargs):  # pragma: no cover
+    """Maps the frames referenced by `refs` and applies `function` to them.
+
+    Exceptions are returned with their traceback instead of being raised.
+    """
+    results = []
+    for position, ref in refs:
+        try:
+            result = function(_map_frame(ref), *args, **kwargs)
+            results.append((position, True, result))
+        except Exception as exception:
+            results.append((position, False, (exception, traceback.format_exc())))
+    return results
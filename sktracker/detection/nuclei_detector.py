@@ -15,15 +15,19 @@ import numpy as np
 import pandas as pd
 
 from scipy.spatial.distance import squareform, pdist
+from scipy.spatial import cKDTree
 from scipy.cluster import hierarchy
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from scipy import ndimage
 
 from skimage.filters import rank, threshold_otsu
 from skimage.morphology import disk, watershed
 from skimage.feature import peak_local_max
-from skimage.measure import regionprops
 
 from ..trajectories import Trajectories
+from ..utils import print_progress
+from .executor import DetectionExecutor
 
 log = logging.getLogger(__name__)
 
@@ -36,17 +40,21 @@ DEFAULT_PARAMETERS = {'segment_method': 'otsu',
                       'max_radius': 8.,
                       'num_cells': 8,
                       'nuc_distance': 6,
-                      'min_z_size': 4
+                      'min_z_size': 4,
+                      'cluster_method': 'hierarchical'
                       }
 
+CLUSTER_METHODS = ('hierarchical', 'kdtree')
+
 
 def nuclei_detector(data_iterator,
                     metadata={},
                     parameters={},
-                    parallel=False,
+                    parallel=True,
                     verbose=False,
                     mapper=None,
-                    show_progress=False):
+                    show_progress=False,
+                    executor=None):
     '''
     TODO
 
@@ -61,9 +69,20 @@ def nuclei_detector(data_iterator,
     parameters : dict
         the parameters for the detection
     parallel : bool
+        Process the stacks in several processes at once. Ignored if
+        `executor` is given.
     verbose : bool
-    mapper : bool
+    mapper : object, optional
+        Object with a `map` method (such as an IPython parallel view),
+        used instead of the built-in pool if `parallel` is True.
     show_progress : bool
+        Print progress bar during detection.
+    executor : :class:`sktracker.detection.executor.DetectionExecutor`, optional
+        Pool running the detection, which can then be reused across
+        calls. By default, a pool with one process per CPU is created
+        (if `parallel` is True) and closed at the end of the detection.
+        Stacks are read from `data_iterator` as the pool processes them,
+        so that only a few of them are in memory at once.
 
     Returns
     -------
@@ -79,18 +98,53 @@ def nuclei_detector(data_iterator,
     parameters['max_radius'] /= metadata['PhysicalSizeX']
     parameters['nuc_distance'] /= metadata['PhysicalSizeX']
 
-    arguments = zip(data_iterator, itertools.repeat(parameters))
+    n_stack = metadata.get('SizeT')
+
+    own_executor = False
     if parallel and mapper is not None:
-        results = mapper.map(detect_one_stack,
-                             arguments)
+        arguments = zip(data_iterator, itertools.repeat(parameters))
+        results = enumerate(mapper.map(detect_one_stack,
+                                       arguments))
     else:
-        results = map(detect_one_stack,
-                      arguments)
+        if executor is None:
+            own_executor = True
+            executor = DetectionExecutor(n_workers=None if parallel else 0)
+        results = executor.map(_detect_stack, data_iterator,
+                               args=(parameters,), ordered=True)
 
     raw_cell_positions = {}
-    for i, result in enumerate(results):
-        if 'positions' in result:
-            raw_cell_positions[i] = result['positions']
+    try:
+        for i, result in results:
+            if 'positions' in result:
+                raw_cell_positions[i] = result['positions']
+
+            if show_progress:
+                n_cells = len(result.get('positions', []))
+                if n_stack:
+                    percent_progression = (i + 1) / n_stack * 100
+                    message = ("%i/%i - %i nuclei detected on stack n°%i" %
+                               ((i + 1), n_stack, n_cells, i))
+                else:
+                    percent_progression = 0
+                    message = "%i nuclei detected on stack n°%i" % (n_cells, i)
+                print_progress(percent_progression, message)
+
+        if show_progress:
+            print_progress(-1)
+
+    except KeyboardInterrupt:
+        if own_executor:
+            executor.terminate()
+        raise Exception('Detection has been canceled by user')
+
+    except Exception:
+        if own_executor:
+            executor.terminate()
+        raise
+
+    if own_executor:
+        executor.close()
+
     if not len(raw_cell_positions):
         log.warning('No cell detected anywhere')
         return Trajectories.empty_trajs(['x', 'y', 'z', 'w', 'I'])
@@ -110,6 +164,10 @@ def nuclei_detector(data_iterator,
     return Trajectories(nuclei_positions)
 
 
+def _detect_stack(z_stack, parameters):
+    return detect_one_stack((z_stack, parameters))
+
+
 def detect_one_stack(args, full_output=False):
 
     z_stack, parameters = args
@@ -217,36 +275,60 @@ def get_regionprops(labeled_stack, z_stack, parameters):
     of all the regions
     Removes the regions with typical size outside [min_radius, max_radius]
 
+    Statistics of all the regions of all the planes are computed at once,
+    with `np.bincount` over the (plane, label) pairs.
+
     returns a DataFrame with colmuns ('x', 'y', 'z', 'I', 'w')
     '''
 
     min_radius = parameters['min_radius']
     max_radius = parameters['max_radius']
-    all_props = []
-    #properties = ['Area', 'WeightedCentroid', 'MeanIntensity']
     columns = ('x', 'y', 'z', 'I', 'w')
-    indices = []
-    for z, frame in enumerate(labeled_stack):
-        f_prop = regionprops(frame.astype(np.int),  # properties,
-                             intensity_image=z_stack[z])
-        for d in f_prop:
-            radius = (d.area / np.pi)**0.5
-            if (min_radius < radius < max_radius):
-                all_props.append([d.centroid[0],
-                                  d.centroid[1],
-                                  z, d.mean_intensity * d.area,
-                                  radius])
-                indices.append((d.label, z))
-    if not len(indices):
+
+    z, x, y = np.nonzero(labeled_stack)
+    labels = labeled_stack[z, x, y].astype(np.int64)
+    n_labels = labels.max() + 1 if labels.size else 1
+    # Regions are sorted by plane then by label
+    keys, inverse = np.unique(z * n_labels + labels, return_inverse=True)
+
+    area = np.bincount(inverse)
+    centroid_x = np.bincount(inverse, weights=x) / area
+    centroid_y = np.bincount(inverse, weights=y) / area
+    intensity = np.bincount(inverse, weights=z_stack[z, x, y].astype(np.float64))
+    radius = (area / np.pi) ** 0.5
+
+    good = (min_radius < radius) & (radius < max_radius)
+    if not good.any():
         return pd.DataFrame([], index=[])
-    indices = pd.MultiIndex.from_tuples(indices, names=('label', 'z'))
+    keys = keys[good]
+    indices = pd.MultiIndex.from_arrays([keys % n_labels, keys // n_labels],
+                                        names=('label', 'z'))
+    all_props = np.column_stack([centroid_x[good], centroid_y[good],
+                                 keys // n_labels, intensity[good], radius[good]])
     all_props = pd.DataFrame(all_props, index=indices, columns=columns)
     return all_props
 
 
 def cluster_regions(all_props, parameters):
-
+    '''
+    Groups the regions of the different planes belonging to the same
+    nucleus, and removes the groups spanning less than `min_z_size` planes.
+
+    Regions are clustered on their (x, y) centroid, with the method given by
+    `parameters['cluster_method']`:
+
+    - 'hierarchical' : single linkage hierarchical clustering of the rows
+      of the dense distance matrix of all the regions, cut at `max_radius`.
+    - 'kdtree' : connected components of the graph linking the regions less
+      than `max_radius` apart, found with a KD-tree. This is single
+      linkage cut at `max_radius` over the positions, in memory and time
+      close to linear in the number of regions.
+    '''
     radius = parameters['max_radius']
+    method = parameters.get('cluster_method', 'hierarchical')
+    if method not in CLUSTER_METHODS:
+        raise ValueError("Unknown cluster method {}, "
+                         "should be one of {}".format(method, CLUSTER_METHODS))
     n_clusters = all_props.shape[0]
     if not n_clusters:
         return None
@@ -258,18 +340,21 @@ def cluster_regions(all_props, parameters):
     if all_props.shape[0] < 3:
         return all_props[['x', 'y', 'z', 'w', 'I']]
 
-    # Hierarchical clustering
-    dist_mat = squareform(pdist(positions.values))
-    link_mat = hierarchy.linkage(dist_mat)
-    cluster_idx = hierarchy.fcluster(link_mat, radius,
-                                     criterion='distance')
+    if method == 'kdtree':
+        cluster_idx = kdtree_clusters(positions.values, radius)
+    else:
+        # Hierarchical clustering
+        dist_mat = squareform(pdist(positions.values))
+        link_mat = hierarchy.linkage(dist_mat)
+        cluster_idx = hierarchy.fcluster(link_mat, radius,
+                                         criterion='distance')
     all_props['label'] = cluster_idx
     all_props.set_index('label', drop=False, append=False, inplace=True)
     all_props.index.name = 'label'
     all_props = all_props.sort_index()
 
     lbl_bincount = np.bincount(
-        all_props.index.astype(np.uint16))[all_props.index.unique()]
+        all_props.index.astype(np.int64))[all_props.index.unique()]
     min_z_size = parameters['min_z_size']
     shorts = all_props.index.unique()[lbl_bincount < min_z_size]
     all_props = all_props.drop(shorts)
@@ -279,25 +364,44 @@ def cluster_regions(all_props, parameters):
     return all_props
 
 
+def kdtree_clusters(positions, radius):
+    '''
+    Cluster labels (starting at 1) of the connected components of the
+    graph linking the `positions` less than `radius` apart.
+    '''
+    n_points = positions.shape[0]
+    pairs = cKDTree(positions).query_pairs(radius)
+    pairs = np.array(list(pairs), dtype=np.int64).reshape((-1, 2))
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),
+                       shape=(n_points, n_points))
+    n_clusters, labels = connected_components(graph, directed=False)
+    return labels + 1
+
+
 def get_cell_positions(all_props, interpolate=True):
 
     # Intensity should be summed, not averaged
     intensities = all_props['I'].groupby(
         level='label').sum()
     intensities /= intensities.max()
-    cell_positions = all_props.groupby(
-        level='label').apply(df_average, 'I')
+    cell_positions = groupby_average(all_props, 'I', level='label')
     cell_positions['I'] = intensities
     return cell_positions
 
 
-def df_average(df, weights_column):
-    values = df.copy().iloc[0]
-    norm = df[weights_column].sum()
-    for col in df.columns:
-        try:
-            v = (df[col] * df[weights_column]).sum() / norm
-        except TypeError:
-            v = df[col].iloc[0]
-        values[col] = v
-    return values
+def groupby_average(df, weights_column, level):
+    '''
+    Average of the columns of `df` weighted by `weights_column`, for each
+    value of the index level `level`. Non numerical columns take the
+    value of the first row of each group.
+    '''
+    numeric = [col for col in df.columns
+               if np.issubdtype(df[col].dtype, np.number)]
+    others = [col for col in df.columns if col not in numeric]
+    weights = df[weights_column]
+    weighted = df[numeric].mul(weights, axis=0).groupby(level=level).sum()
+    averages = weighted.div(weights.groupby(level=level).sum(), axis=0)
+    if others:
+        firsts = df[others].groupby(level=level).first()
+        averages = pd.concat([averages, firsts], axis=1)
+    return averages[list(df.columns)]
@@ -8,24 +8,18 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 
-import os
 import logging
-import subprocess
-import multiprocessing
 import itertools
 
-try:
-    from subprocess import DEVNULL  # py3k
-except ImportError:
-    DEVNULL = open(os.devnull, 'wb')
-
 from scipy.optimize import leastsq
+from scipy.spatial import cKDTree
 from skimage import feature
 
 import numpy as np
 import pandas as pd
 
 from ..utils import print_progress
+from .executor import DetectionExecutor
 
 log = logging.getLogger(__name__)
 
@@ -34,15 +28,23 @@ __all__ = []
 DEFAULT_PARAMETERS = {'w_s': 0.7,
                       'peak_radius': 0.2,
                       'threshold': 27.,
-                      'max_peaks': 1e4
+                      'max_peaks': 1e4,
+                      'fit_method': 'batch',
+                      'tile_size': None,
+                      'detection_3d': False,
+                      'peak_radius_z': None,
+                      'w_s_z': None
                       }
 
+FIT_METHODS = ('batch', 'leastsq', 'log_gauss')
+
 
 def peak_detector(data_iterator,
                   metadata,
                   parallel=True,
                   show_progress=False,
-                  parameters={}):
+                  parameters={},
+                  executor=None):
     """Gaussian peak detection described in Segré et al. Nature Methods, (2008).
 
     Parameters
@@ -52,7 +54,7 @@ def peak_detector(data_iterator,
     metadata : dict
         Metadata to scale detected peaks and parameters.
     parallel : bool
-        Used several processes at once.
+        Used several processes at once. Ignored if `executor` is given.
     show_progress : bool (default: False)
         Print progress bar during detection.
     parameters : dict
@@ -73,6 +75,33 @@ def peak_detector(data_iterator,
                 once for a given data set.
             - max_peaks : int, optional
                 Deflation loop will stop if detected peaks is higher than max_peaks.
+            - fit_method : str, optional
+                Sub-pixel localization method, one of 'batch' (least square fit
+                of all the peaks of a frame at once, the default), 'leastsq'
+                (one `scipy.optimize.leastsq` fit per peak) or 'log_gauss'
+                (closed form estimate from the log of the three brightest
+                pixels along each axis, faster but less precise).
+            - tile_size : int, optional
+                If set, frames are split into tiles of this size (in pixels),
+                with a margin of twice `w_s` on each side, which are processed
+                separately. Use it for very large frames. Peaks found in
+                two overlapping tiles are merged, `max_peaks` applies per tile.
+            - detection_3d : bool, optional
+                If True, the planes of each Z stack are processed together
+                and each peak is detected once, its z position being
+                interpolated between planes (see `_find_gaussian_peaks_3d`).
+                Otherwise, each plane is processed independently.
+            - peak_radius_z : float, optional
+                Typical radius (in um) of the peaks along z, for 3D
+                detection. Defaults to `peak_radius`.
+            - w_s_z : float, optional
+                Depth (in um) of the sliding window for 3D detection.
+                Defaults to the odd number of planes spanning twice
+                `peak_radius_z` on each side of the center.
+    executor : :class:`sktracker.detection.executor.DetectionExecutor`, optional
+        Pool running the detection, which can then be reused across
+        calls. By default, a pool with one process per CPU is created
+        (if `parallel` is True) and closed at the end of the detection.
 
     Returns
     -------
@@ -87,41 +116,45 @@ def peak_detector(data_iterator,
 
     # Scale parameters in pixels
     parameters['w_s'] /= metadata['PhysicalSizeX']
-    parameters['w_s'] = np.round(parameters['w_s'])
+    parameters['w_s'] = int(np.round(parameters['w_s']))
     parameters['peak_radius'] /= metadata['PhysicalSizeX']
 
     # Find number of stacks to process
     # Only iteration over T and Z are assumed
     n_stack = int(metadata['SizeT'] * metadata['SizeZ'])
 
-    if parallel:
-
-        # Snippet to allow multiprocessing while importing
-        # module such as numpy (only needed on linux)
-        if os.name == 'posix':
-            subprocess.call("taskset -p 0xff %d" % os.getpid(),
-                            shell=True,
-                            stdout=DEVNULL,
-                            stderr=DEVNULL)
-
-        def init_worker():
-            import signal
-            signal.signal(signal.SIGINT, signal.SIG_IGN)
+    detection_3d = parameters.pop('detection_3d')
+    peak_radius_z = parameters.pop('peak_radius_z')
+    w_s_z = parameters.pop('w_s_z')
+    find_peaks = _find_gaussian_peaks
+    if detection_3d:
+        size_z = metadata.get('PhysicalSizeZ', metadata['PhysicalSizeX'])
+        if peak_radius_z is None:
+            peak_radius_z = parameters['peak_radius'] * metadata['PhysicalSizeX']
+        parameters['peak_radius_z'] = peak_radius_z / size_z
+        if w_s_z is None:
+            parameters['w_s_z'] = 2 * int(np.ceil(2 * parameters['peak_radius_z'])) + 1
+        else:
+            parameters['w_s_z'] = 2 * int(np.round(w_s_z / size_z / 2.)) + 1
+        find_peaks = _find_gaussian_peaks_3d
+        data_iterator = _z_stacks(data_iterator, int(metadata['SizeZ']))
+        n_stack = int(metadata['SizeT'])
 
-        ncore = multiprocessing.cpu_count() + 1
-        pool = multiprocessing.Pool(processes=ncore, initializer=init_worker)
+    tile_size = parameters.pop('tile_size')
+    if tile_size:
+        tiles = _FrameTiles(data_iterator, int(tile_size), 2 * parameters['w_s'])
+        data_iterator = iter(tiles)
 
-    # Build arguments list
-    arguments = zip(data_iterator,
-                    itertools.repeat(parameters),
-                    range(n_stack))
+    own_executor = executor is None
+    if own_executor:
+        executor = DetectionExecutor(n_workers=None if parallel else 0)
 
     try:
         # Launch peak_detection
-        if parallel:
-            results = pool.imap_unordered(find_gaussian_peaks, arguments)
-        else:
-            results = map(find_gaussian_peaks, arguments)
+        results = executor.map(find_peaks, data_iterator,
+                               kwargs=parameters, ordered=False)
+        if tile_size:
+            results = tiles.merge(results)
 
         all_peaks = []
 
@@ -142,59 +175,171 @@ def peak_detector(data_iterator,
             print_progress(-1)
 
     except KeyboardInterrupt:
-        if parallel:
-            pool.terminate()
-            pool.join()
+        if own_executor:
+            executor.terminate()
         raise Exception('Detection has been canceled by user')
 
-    if parallel:
-        pool.close()
-        pool.terminate()
+    except Exception:
+        if own_executor:
+            executor.terminate()
+        raise
 
-    # Sort peaks and remove index used to sort
-    all_peaks.sort(key=lambda x: x[0])
-    all_peaks = [x[1] for x in all_peaks]
-
-    # Store peaks in pd.DataFrame
-    index = []
-    peaks_df = []
+    if own_executor:
+        executor.close()
 
-    for n, peaks in enumerate(all_peaks):
-        if peaks.any():
-            for peak in peaks:
-                peaks_df.append(peak)
-                index.append((n,))
+    # Stack peaks, in stack order
+    all_peaks.sort(key=lambda x: x[0])
+    positions = np.array([pos for pos, peaks in all_peaks if len(peaks)], dtype=np.int64)
+    all_peaks = [np.atleast_2d(peaks) for pos, peaks in all_peaks if len(peaks)]
 
-    if not peaks_df:
+    if not all_peaks:
         return pd.DataFrame([])
 
     log.info('Terminating peak detection')
 
-    peaks_df = pd.DataFrame(peaks_df, columns=['y', 'x', 'w', 'I'], dtype='float')
-    peaks_df.index = pd.MultiIndex.from_tuples(index, names=['t_stamp'])
+    n_peaks = np.array([len(peaks) for peaks in all_peaks])
+    values = np.concatenate(all_peaks).astype(np.float64)
+    stacks = np.repeat(positions, n_peaks)
+
+    columns = ['y', 'x', 'w', 'I', 'fit_error', 't', 'z']
+    if detection_3d:
+        t_stamps = stacks
+        values = np.column_stack([values[:, :5], t_stamps, values[:, 5]])
+    else:
+        t_stamps = stacks // metadata['SizeZ']
+        values = np.column_stack([values, t_stamps, stacks % metadata['SizeZ']])
+
+    # Scale coordinates
+    scales = {'y': 'PhysicalSizeY',
+              'x': 'PhysicalSizeX',
+              'w': 'PhysicalSizeX',
+              'z': 'PhysicalSizeZ',
+              't': 'TimeIncrement'}
+    factors = np.array([metadata.get(scales.get(column), 1) for column in columns],
+                       dtype=np.float64)
+    values *= factors
+
+    index = pd.MultiIndex.from_arrays([t_stamps, np.arange(len(values))],
+                                      names=['t_stamp', 'label'])
+    peaks_df = pd.DataFrame(values, index=index, columns=columns)
+
+    return peaks_df
+
 
-    t_stamp = peaks_df.index.get_level_values('t_stamp').values
-    peaks_df['t'] = t_stamp // metadata['SizeZ']
-    peaks_df['z'] = t_stamp % metadata['SizeZ']
+def _z_stacks(planes, size_z):
+    """Groups the 2D planes of `planes` by stacks of `size_z`
+    """
+    planes = iter(planes)
+    while True:
+        stack = list(itertools.islice(planes, size_z))
+        if not stack:
+            return
+        yield np.array(stack)
 
-    peaks_df['label'] = np.arange(len(peaks_df))
 
-    peaks_df = peaks_df.reset_index(level=['t_stamp', 'label'])
-    peaks_df['t_stamp'] = peaks_df['t'].copy()
-    peaks_df.set_index(['t_stamp', 'label'], inplace=True)
+class _FrameTiles(object):
+    """Splits frames into overlapping tiles and puts together
+    the peaks detected on each tile.
 
-    if "PhysicalSizeX" in metadata.keys():
-        peaks_df['x'] *= metadata["PhysicalSizeX"]
-    if "PhysicalSizeY" in metadata.keys():
-        peaks_df['y'] *= metadata["PhysicalSizeY"]
-    if "PhysicalSizeZ" in metadata.keys():
-        peaks_df['z'] *= metadata["PhysicalSizeZ"]
-    if "PhysicalSizeX" in metadata.keys():
-        peaks_df['w'] *= metadata["PhysicalSizeX"]
-    if "TimeIncrement" in metadata.keys():
-        peaks_df['t'] *= metadata["TimeIncrement"]
+    Each tile keeps the peaks of its core region, which is extended by
+    `margin` pixels on each side (within the frame) so that the peaks
+    around the owned ones are also detected and deflated. Core regions
+    overlap by a pixel, so that a peak on the border of two cores is
+    not missed, and the peaks found twice are merged.
 
-    return peaks_df
+    Parameters
+    ----------
+    frames : iterable of 2D arrays
+    tile_size : int
+        Size of the core regions
+    margin : int
+    """
+
+    def __init__(self, frames, tile_size, margin):
+        self.frames = frames
+        self.tile_size = max(tile_size, 1)
+        self.margin = margin
+        # Frame, core lower and upper corners and tile
+        # lower corner of each tile
+        self.tiles = []
+        # Number of tiles of each frame, once all are generated
+        self.n_tiles = {}
+
+    def __iter__(self):
+        for pos, frame in enumerate(self.frames):
+            n_tiles = 0
+            for core_low, core_high, low, high in _tile_bounds(frame.shape[-2:],
+                                                               self.tile_size,
+                                                               self.margin):
+                self.tiles.append((pos, core_low, core_high, low))
+                n_tiles += 1
+                yield frame[..., low[0]:high[0], low[1]:high[1]]
+            self.n_tiles[pos] = n_tiles
+
+    def merge(self, results, radius=1.):
+        """Gathers the `(tile, peaks)` pairs of `results` by frame.
+
+        Yields `(frame, peaks)` pairs, as soon as all the tiles
+        of a frame are processed. Peaks found by two tiles less than
+        `radius` pixels apart are merged.
+        """
+        peaks_by_frame = {}
+        for tile, peaks in results:
+            pos, core_low, core_high, low = self.tiles[tile]
+            done, frame_peaks, tile_ids = peaks_by_frame.setdefault(pos, [0, [], []])
+            peaks_by_frame[pos][0] += 1
+            if len(peaks):
+                peaks = np.array(peaks, dtype=np.float64)
+                peaks[:, :2] += low
+                owned = np.all((peaks[:, :2] >= core_low - 1) &
+                               (peaks[:, :2] <= core_high), axis=1)
+                frame_peaks.append(peaks[owned])
+                tile_ids.append(np.repeat(tile, owned.sum()))
+
+            if peaks_by_frame[pos][0] == self.n_tiles.get(pos):
+                del peaks_by_frame[pos]
+                yield pos, _merge_duplicates(frame_peaks, tile_ids, radius)
+
+        # Frames whose last tile was processed before being counted
+        for pos, (done, frame_peaks, tile_ids) in sorted(peaks_by_frame.items()):
+            yield pos, _merge_duplicates(frame_peaks, tile_ids, radius)
+
+
+def _tile_bounds(shape, tile_size, margin):
+    """Yields core lower and upper corners and tile lower and upper
+    corners of the tiles covering an image of shape `shape`.
+    """
+    shape = np.array(shape[:2])
+    for x in range(0, shape[0], tile_size):
+        for y in range(0, shape[1], tile_size):
+            core_low = np.array([x, y])
+            core_high = np.minimum(core_low + tile_size, shape)
+            low = np.maximum(core_low - margin, 0)
+            high = np.minimum(core_high + margin, shape)
+            yield core_low, core_high, low, high
+
+
+def _merge_duplicates(peaks, tile_ids, radius):
+    """Concatenates the peaks found on the tiles of a frame and removes
+    the ones found by two tiles less than `radius` apart, keeping the
+    best fitted one.
+    """
+    if not peaks:
+        return np.array([])
+    peaks = np.concatenate(peaks)
+    tile_ids = np.concatenate(tile_ids)
+    if len(peaks) < 2:
+        return peaks
+    # x, y and, for 3D detection, z
+    tree = cKDTree(peaks[:, [0, 1] + list(range(5, peaks.shape[1]))])
+    pairs = np.array(sorted(tree.query_pairs(radius)), dtype=np.int64).reshape((-1, 2))
+    pairs = pairs[tile_ids[pairs[:, 0]] != tile_ids[pairs[:, 1]]]
+    removed = np.zeros(len(peaks), dtype=bool)
+    for i, j in pairs:
+        if removed[i] or removed[j]:
+            continue
+        removed[j if peaks[j, 4] >= peaks[i, 4] else i] = True
+    return peaks[~removed]
 
 
 def find_gaussian_peaks(args):  # pragma: no cover
@@ -206,7 +351,8 @@ def find_gaussian_peaks(args):  # pragma: no cover
 
 
 def _find_gaussian_peaks(image, w_s=15, peak_radius=1.5,
-                         threshold=27., max_peaks=1e4):  # pragma: no cover
+                         threshold=27., max_peaks=1e4,
+                         fit_method='batch'):  # pragma: no cover
     """
     This function implements the Gaussian peak detection described
     in Segré et al. Nature Methods **5**, 8 (2008). It is based on a
@@ -236,58 +382,402 @@ def _find_gaussian_peaks(image, w_s=15, peak_radius=1.5,
         A higher `threshold` corresponds to a more stringent test.
         According to the authors, this parameters needs to be adjusted
         once for a given data set.
+    max_peaks: int, optional
+        Deflation loop will stop if detected peaks is higher than max_peaks.
+    fit_method: str, optional
+        One of 'batch', 'leastsq' or 'log_gauss', see `gauss_estimation`
 
     Returns
     -------
 
     peaks: ndarray
-        peaks is a Nx4 array, where N is the number of detected peaks in the
+        peaks is a Nx5 array, where N is the number of detected peaks in the
         image. Each line gives the x position, y position, width,
-        and (background corrected) intensity of a detected peak (in that order).
+        (background corrected) intensity and root mean square fit residual
+        of a detected peak (in that order).
 
     """
-    peaks_coords = glrt_detection(image, peak_radius,
-                                  w_s, threshold)
-    peaks = gauss_estimation(image, peaks_coords, w_s)
-    d_image = image_deflation(image, peaks, w_s)
-    peaks_coords = glrt_detection(d_image, peak_radius,
-                                  w_s, threshold)
+    w_s = int(w_s)
+    if isinstance(image, np.ma.core.MaskedArray):
+        mask = image.mask
+        image = image.data
+    else:
+        mask = None
+    # The image is deflated in place
+    d_image = np.array(image, dtype=np.float64)
+    if min(d_image.shape) <= w_s:
+        return np.array([])
+
+    hmap = glrt_map(d_image, peak_radius, w_s)
+    peaks_coords = _hmap_peaks(hmap, threshold, w_s, mask)
+    peaks = []
+    found = set()
     while len(peaks_coords) > 0 and len(peaks) < max_peaks:
-        new_peaks = gauss_estimation(d_image, peaks_coords, w_s)
+        # Peaks which deflation doesn't remove are found and fitted
+        # the same again
+        new_peaks = [peak for peak in gauss_estimation(d_image, peaks_coords,
+                                                       w_s, fit_method)
+                     if tuple(peak) not in found]
         # in case the 2D gauss fit fails
         if len(new_peaks) < 1:
             break
+        found.update(tuple(peak) for peak in new_peaks)
         peaks.extend(new_peaks[:])
-        d_image = image_deflation(d_image, new_peaks, w_s)
-        peaks_coords = glrt_detection(d_image, peak_radius,
-                                      w_s, threshold)
+        lows = _deflate(d_image, new_peaks, w_s)
+        peaks_coords = _update_glrt_peaks(hmap, d_image, lows, peak_radius,
+                                          w_s, threshold, mask)
     peaks = np.array(peaks)
     return peaks
 
 
+def _find_gaussian_peaks_3d(stack, w_s=15, peak_radius=1.5,
+                            threshold=27., max_peaks=1e4,
+                            fit_method='batch', w_s_z=3,
+                            peak_radius_z=1.5):  # pragma: no cover
+    """
+    3D version of `_find_gaussian_peaks`, detecting each peak once
+    over the planes of a Z stack.
+
+    The likelyhood ratio test is computed with a 3D Gaussian template
+    (see `glrt_map_3d`). Each peak is then fitted in the plane where
+    it was detected, and its z position is refined from the log of the
+    peak intensity in this plane and in the two neighbouring ones.
+    Deflation removes each peak from the planes of its window, scaled
+    by its z profile.
+
+    Parameters
+    ----------
+    stack: 3D array
+        Planes of the stack along the first axis
+    w_s_z: int, optional
+        Number of planes of the sliding window (odd, at most the number
+        of planes)
+    peak_radius_z: float, optional
+        Typical radius of the peaks along z, in planes
+
+    See `_find_gaussian_peaks` for the other parameters.
+
+    Returns
+    -------
+    peaks: ndarray
+        Nx6 array, each line giving the x position, y position, width,
+        (background corrected) intensity in the fitted plane and root
+        mean square fit residual (as returned by `_find_gaussian_peaks`)
+        followed by the z position, in planes.
+    """
+    w_s = int(w_s)
+    d_stack = np.array(stack, dtype=np.float64)
+    if d_stack.ndim == 2:
+        d_stack = d_stack[np.newaxis]
+    n_z = d_stack.shape[0]
+    w_s_z = int(min(w_s_z, n_z - 1 + n_z % 2))
+    if min(d_stack.shape[1:]) <= w_s:
+        return np.array([])
+
+    hmap = glrt_map_3d(d_stack, peak_radius, w_s, peak_radius_z, w_s_z)
+    peaks_coords = _hmap_peaks_3d(hmap, threshold, w_s)
+    peaks = []
+    found = set()
+    while len(peaks_coords) > 0 and len(peaks) < max_peaks:
+        new_peaks = _gauss_estimation_3d(d_stack, peaks_coords, w_s, fit_method)
+        # Peaks which deflation doesn't remove are found and fitted
+        # the same again
+        new_peaks = np.array([peak for peak in new_peaks.tolist()
+                              if tuple(peak) not in found]).reshape((-1, 6))
+        if not len(new_peaks):
+            break
+        found.update(tuple(peak) for peak in new_peaks.tolist())
+        peaks.extend(new_peaks.tolist())
+        lows = _deflate_3d(d_stack, new_peaks, w_s, w_s_z, peak_radius_z)
+        peaks_coords = _update_glrt_peaks_3d(hmap, d_stack, lows, peak_radius, w_s,
+                                             peak_radius_z, w_s_z, threshold)
+    return np.array(peaks)
+
+
+def _hmap_peaks_3d(hmap, threshold, w_s, min_distance=3):  # pragma: no cover
+    """
+    Local maxima of the 3D hypothesis map above `threshold`, as
+    `(z, x, y)` image coordinates sorted by decreasing map value.
+    Maxima are searched over three consecutive planes.
+    """
+    peaks_coords = _local_maxima_3d(hmap, threshold, min_distance)
+    # Same border exclusion as `_hmap_peaks` in the plane
+    inside = np.all((peaks_coords[:, 1:] >= min_distance) &
+                    (peaks_coords[:, 1:] < np.array(hmap.shape[1:]) - min_distance),
+                    axis=1)
+    peaks_coords = peaks_coords[inside]
+    order = np.argsort(- hmap[tuple(peaks_coords.T)], kind='mergesort')
+    peaks_coords = peaks_coords[order]
+    peaks_coords[:, 1:] += w_s // 2
+    return peaks_coords
+
+
+def _local_maxima_3d(hmap, threshold, min_distance):  # pragma: no cover
+    """
+    `(z, x, y)` positions of the maxima of `hmap` above `threshold` over
+    three planes and `2 * min_distance + 1` pixels in the plane.
+    """
+    footprint = np.ones((3, 2 * min_distance + 1, 2 * min_distance + 1), dtype=bool)
+    try:
+        peaks_coords = feature.peak_local_max(hmap, footprint=footprint,
+                                              threshold_abs=threshold,
+                                              exclude_border=False)
+    except ValueError:
+        return np.zeros((0, 3), dtype=np.int64)
+    return np.asarray(peaks_coords, dtype=np.int64).reshape((-1, 3))
+
+
+def _update_glrt_peaks_3d(hmap, d_stack, lows, r0, w_s, r0_z, w_s_z, threshold,
+                          min_distance=3):  # pragma: no cover
+    """
+    3D version of `_update_glrt_peaks`: updates in place the hypothesis
+    map `hmap` of the deflated stack where the windows overlap the
+    patches substracted at the `(z, x, y)` positions `lows`, and returns
+    the peaks found in those regions (see `_hmap_peaks_3d`).
+    """
+    n_z, map_w, map_h = hmap.shape
+    half_z = w_s_z // 2
+    # The patches of a peak share their position in the plane
+    planes = {}
+    for z, low_x, low_y in lows:
+        z_range = planes.setdefault((low_x, low_y), [z, z])
+        z_range[0], z_range[1] = min(z_range[0], z), max(z_range[1], z)
+    regions = [(max(z0 - half_z, 0), min(z1 + half_z + 1, n_z),
+                max(low_x - w_s + 1, 0), min(low_x + w_s, map_w),
+                max(low_y - w_s + 1, 0), min(low_y + w_s, map_h))
+               for (low_x, low_y), (z0, z1) in planes.items()]
+    regions = [region for region in regions
+               if region[0] < region[1] and region[2] < region[3] and region[4] < region[5]]
+    if not regions:
+        return np.array([])
+
+    volume = sum((z1 - z0) * (x1 - x0) * (y1 - y0)
+                 for z0, z1, x0, x1, y0, y1 in regions)
+    start_over = volume > hmap.size // 4
+
+    # Maxima are searched in windows padded by twice the footprint, such
+    # that they are the same as in the whole map up to a footprint around
+    # the updated regions
+    md = min_distance
+    windows = [(max(z0 - 2, 0), z1 + 2, max(x0 - 2 * md, 0), x1 + 2 * md,
+                max(y0 - 2 * md, 0), y1 + 2 * md)
+               for z0, z1, x0, x1, y0, y1 in regions]
+
+    def window_maxima(window):
+        wz0, wz1, wx0, wx1, wy0, wy1 = window
+        coords = _local_maxima_3d(hmap[wz0:wz1, wx0:wx1, wy0:wy1], threshold, md)
+        return set((z, x, y) for z, x, y in coords + [wz0, wx0, wy0]
+                   if md <= x < map_w - md and md <= y < map_h - md)
+
+    # Maxima next to an updated region may have been suppressed by a higher
+    # value of the region before it was deflated. The ones which were
+    # already maxima are not found again.
+    previous = [window_maxima(window) for window in windows]
+
+    if start_over:
+        # Cheaper to start over
+        hmap[:] = glrt_map_3d(d_stack, r0, w_s, r0_z, w_s_z)
+    else:
+        for z0, z1, x0, x1, y0, y1 in regions:
+            hmap[z0:z1, x0:x1, y0:y1] = glrt_map_3d(d_stack[:, x0:x1 + w_s, y0:y1 + w_s],
+                                                    r0, w_s, r0_z, w_s_z, planes=(z0, z1))
+
+    peaks_coords = set()
+    for (z0, z1, x0, x1, y0, y1), window, before in zip(regions, windows, previous):
+        for z, x, y in window_maxima(window):
+            if z0 <= z < z1 and x0 <= x < x1 and y0 <= y < y1:
+                peaks_coords.add((z, x, y))
+            elif (z0 - 1 <= z < z1 + 1 and x0 - md <= x < x1 + md
+                  and y0 - md <= y < y1 + md and (z, x, y) not in before):
+                peaks_coords.add((z, x, y))
+    if not peaks_coords:
+        return np.array([])
+    peaks_coords = np.array(sorted(peaks_coords, key=lambda zxy: (- hmap[zxy], zxy)),
+                            dtype=np.int64)
+    peaks_coords[:, 1:] += w_s // 2
+    return peaks_coords
+
+
+def _gauss_estimation_3d(d_stack, peaks_coords, w_s, method='batch'):  # pragma: no cover
+    """
+    Fits the peaks at the `(z, x, y)` positions of `peaks_coords` in
+    their plane, and refines their z position with a parabola through
+    the log of the peak intensity in the neighbouring planes.
+
+    Returns the Nx6 array of the valid fits, see `_find_gaussian_peaks_3d`.
+    """
+    n_z, w, h = d_stack.shape
+    planes = peaks_coords[:, 0]
+    lows = peaks_coords[:, 1:] - w_s // 2
+    inside = np.all((lows >= 0) & (lows + w_s <= (w, h)), axis=1)
+    planes, lows = planes[inside], lows[inside]
+    if not len(lows):
+        return np.array([])
+
+    span = np.arange(w_s)
+    rows = (lows[:, 0, np.newaxis] + span)[:, :, np.newaxis]
+    cols = (lows[:, 1, np.newaxis] + span)[:, np.newaxis, :]
+    patches = d_stack[planes[:, np.newaxis, np.newaxis], rows, cols]
+    peaks, good = _fit_patches(patches, w_s, method)
+
+    # Background corrected intensity at the fitted center in each plane
+    center_x = np.clip(np.round(peaks[:, 0]).astype(np.int64), 0, w_s - 1)
+    center_y = np.clip(np.round(peaks[:, 1]).astype(np.int64), 0, w_s - 1)
+    background = patches[np.arange(len(patches)), center_x, center_y] - peaks[:, 3]
+    x, y = lows[:, 0] + center_x, lows[:, 1] + center_y
+    before = d_stack[np.maximum(planes - 1, 0), x, y] - background
+    center = d_stack[planes, x, y] - background
+    after = d_stack[np.minimum(planes + 1, n_z - 1), x, y] - background
+
+    tiny = np.finfo(np.float64).tiny
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_before, log_center, log_after = [np.log(np.maximum(v, tiny))
+                                             for v in (before, center, after)]
+        second = log_before - 2 * log_center + log_after
+        offset = (log_before - log_after) / (2 * second)
+    refined = ((planes > 0) & (planes < n_z - 1) & (before > 0) & (center > 0)
+               & (after > 0) & (second < 0) & np.isfinite(offset))
+    offset = np.where(refined, np.clip(offset, -0.5, 0.5), 0)
+
+    peaks[:, :2] += lows
+    peaks = np.column_stack([peaks, planes + offset])
+    return peaks[good]
+
+
+def _deflate_3d(d_stack, peaks, w_s, w_s_z, r0_z):  # pragma: no cover
+    """
+    Substracts the peaks from the planes of their window in place,
+    the fitted intensity being scaled along z by a Gaussian of radius `r0_z`.
+    Returns the `(z, x, y)` upper left corners of the modified patches.
+    """
+    n_z = d_stack.shape[0]
+    lows = []
+    for xc, yc, width, I, fit_error, zc in peaks:
+        plane = int(np.round(zc))
+        # Peak intensity at its center, from the one of the fitted plane
+        I_0 = I * np.exp((plane - zc) ** 2 / r0_z ** 2)
+        for z in range(max(plane - w_s_z // 2, 0), min(plane + w_s_z // 2 + 1, n_z)):
+            I_z = I_0 * np.exp(- (z - zc) ** 2 / r0_z ** 2)
+            for low_x, low_y in _deflate(d_stack[z], [(xc, yc, width, I_z)], w_s):
+                lows.append((z, low_x, low_y))
+    return lows
+
+
+def _update_glrt_peaks(hmap, d_image, lows, r0, w_s, threshold,
+                       mask=None, min_distance=3):  # pragma: no cover
+    """
+    Updates in place the hypothesis map `hmap` of the deflated image
+    where the windows overlap the patches substracted at `lows`,
+    and returns the peaks found in those regions.
+    """
+    map_w, map_h = hmap.shape
+    regions = [(max(low_x - w_s + 1, 0), min(low_x + w_s, map_w),
+                max(low_y - w_s + 1, 0), min(low_y + w_s, map_h))
+               for low_x, low_y in lows]
+    area = sum((x1 - x0) * (y1 - y0) for x0, x1, y0, y1 in regions)
+    if area > hmap.size // 4:
+        # Cheaper to start over
+        hmap[:] = glrt_map(d_image, r0, w_s)
+        return _hmap_peaks(hmap, threshold, w_s, mask, min_distance)
+
+    # Maxima are searched in windows padded such that they are the same
+    # as in the whole map up to `reach` around the updated regions
+    reach = min_distance
+    pad = reach + 2 * min_distance
+    windows = [(max(x0 - pad, 0), min(x1 + pad, map_w),
+                max(y0 - pad, 0), min(y1 + pad, map_h))
+               for x0, x1, y0, y1 in regions]
+
+    def window_maxima(window):
+        wx0, wx1, wy0, wy1 = window
+        if min(wx1 - wx0, wy1 - wy0) <= 2 * min_distance:
+            return set()
+        coords = feature.peak_local_max(hmap[wx0:wx1, wy0:wy1], min_distance,
+                                        threshold_abs=threshold)
+        return set((x, y) for x, y in coords + [wx0, wy0]
+                   if (min_distance <= x < map_w - min_distance
+                       and min_distance <= y < map_h - min_distance))
+
+    # Maxima next to an updated region may have been suppressed by a higher
+    # value of the region before it was deflated. The ones which were
+    # already maxima are not found again.
+    previous = [window_maxima(window) for window in windows]
+
+    for x0, x1, y0, y1 in regions:
+        hmap[x0:x1, y0:y1] = glrt_map(d_image[x0:x1 + w_s, y0:y1 + w_s], r0, w_s)
+
+    peaks_coords = set()
+    for (x0, x1, y0, y1), window, before in zip(regions, windows, previous):
+        for x, y in window_maxima(window):
+            if x0 <= x < x1 and y0 <= y < y1:
+                peaks_coords.add((x, y))
+            elif (x0 - reach <= x < x1 + reach and y0 - reach <= y < y1 + reach
+                  and (x, y) not in before):
+                peaks_coords.add((x, y))
+    if not peaks_coords:
+        return np.array([])
+    peaks_coords = np.array(sorted(peaks_coords, key=lambda xy: - hmap[xy]))
+    peaks_coords += w_s // 2
+    if isinstance(mask, np.ndarray):
+        peaks_coords = list(filter(lambda x: not mask[x[0], x[1]], peaks_coords))
+    return peaks_coords
+
+
+def _hmap_peaks(hmap, threshold, w_s, mask=None, min_distance=3):  # pragma: no cover
+    """
+    Local maxima of the hypothesis map above `threshold`, in image coordinates.
+    """
+    try:
+        peaks_coords = feature.peak_local_max(hmap, min_distance,
+                                              threshold_abs=threshold)
+        peaks_coords += w_s // 2
+        if isinstance(mask, np.ndarray):
+            peaks_coords = list(filter(lambda x: not mask[x[0], x[1]], peaks_coords))
+
+        return peaks_coords
+
+    except ValueError:
+        return np.array([])
+
+
 def image_deflation(image, peaks, w_s):  # pragma: no cover
     """
     Substracts the detected Gaussian peaks from the input image and
     returns the deflated image.
     """
-    d_image = image.copy()
+    d_image = np.array(image, dtype=np.float64)
+    _deflate(d_image, peaks, w_s)
+    return d_image
+
+
+def _deflate(d_image, peaks, w_s):  # pragma: no cover
+    """
+    Substracts the detected Gaussian peaks from the float image `d_image`
+    in place, and returns the upper left corners of the modified patches.
+    """
+    w_s = int(w_s)
+    lows = []
     for peak in peaks:
-        xc, yc, width, I = peak
+        xc, yc, width, I = peak[:4]
         xc_rel = w_s // 2 + xc - np.floor(xc)
         yc_rel = w_s // 2 + yc - np.floor(yc)
         low_x = int(xc - w_s // 2)
         low_y = int(yc - w_s // 2)
 
-        if low_x > 0 and low_y > 0:
+        if (0 < low_x <= d_image.shape[0] - w_s and
+            0 < low_y <= d_image.shape[1] - w_s):
             params = xc_rel, yc_rel, width, I, 0
             deflated_peak = gauss_continuous(params, w_s)
             d_image[low_x:low_x + w_s,
                     low_y:low_y + w_s] -= deflated_peak.reshape((w_s, w_s))
-
-    return d_image
+            # Peaks too narrow to be sampled leave the image unchanged,
+            # and would be found again
+            if deflated_peak.max() > 1e-3 * I:
+                lows.append((low_x, low_y))
+    return lows
 
 
-def gauss_estimation(image, peaks_coords, w_s):  # pragma: no cover
+def gauss_estimation(image, peaks_coords, w_s, method='batch'):  # pragma: no cover
     """
     Least square fit of a 2D Gauss peaks (with radial symmetry)
     on regions of width `w_s` centered on each element
@@ -301,23 +791,196 @@ def gauss_estimation(image, peaks_coords, w_s):  # pragma: no cover
        The peaks_coords should contain `(x, y)` pairs
        corresponding to the approximate peak center,
        in pixels.
+    w_s: int
+        Size of the fitted regions
+    method: str, optional
+        'batch' fits all the regions at once (see `batch_gauss_estimate`),
+        'leastsq' fits them one by one with `scipy.optimize.leastsq`
+        and 'log_gauss' uses the closed form `log_gauss_estimate`.
+
+    Returns
+    -------
+    peaks: list
+        `[x, y, width, I, fit_error]` for each successfully fitted peak,
+        `fit_error` being the root mean square residual of the fit.
     """
-    peaks = []
-    for coords in peaks_coords:
-        low_x, low_y = coords - w_s // 2
-        try:
-            patch = image[low_x: low_x + w_s,
-                          low_y: low_y + w_s]
-            params, success = gauss_estimate(patch, w_s)
-            xc, yc, width, I, bg = params
-            if success and I > 0 and width < w_s:
-                peaks.append([xc + low_x, yc + low_y, width, I])
-        except IndexError:
-            log.error('peak too close from the edge\n'
-                      'use a smaller window\n'
-                      'peak @ (%i, %i) discarded' % (coords[0], coords[1]))
-            continue
-    return peaks
+    if method not in FIT_METHODS:
+        raise ValueError("Unknown fit method {}, "
+                         "should be one of {}".format(method, FIT_METHODS))
+    w_s = int(w_s)
+    peaks_coords = np.asarray(peaks_coords, dtype=np.int64).reshape((-1, 2))
+    lows = peaks_coords - w_s // 2
+    inside = np.all((lows >= 0) & (lows + w_s <= image.shape), axis=1)
+    for coords in peaks_coords[~inside]:
+        log.error('peak too close from the edge\n'
+                  'use a smaller window\n'
+                  'peak @ (%i, %i) discarded' % (coords[0], coords[1]))
+    lows = lows[inside]
+    if not lows.size:
+        return []
+
+    patches = _extract_patches(image, lows, w_s)
+    peaks, good = _fit_patches(patches, w_s, method)
+    peaks[:, :2] += lows
+    return peaks[good].tolist()
+
+
+def _extract_patches(image, lows, w_s):
+    """
+    `(n, w_s, w_s)` float array of the patches of `image` with
+    the rows of `lows` as upper left corners.
+    """
+    span = np.arange(w_s)
+    patches = image[(lows[:, 0, np.newaxis] + span)[:, :, np.newaxis],
+                    (lows[:, 1, np.newaxis] + span)[:, np.newaxis, :]]
+    return patches.astype(np.float64)
+
+
+def _fit_patches(patches, w_s, method):  # pragma: no cover
+    """
+    Fits a 2D Gauss peak on each patch with `method`, returns the
+    `(n, 5)` array of `[x, y, width, I, fit_error]` in patch
+    coordinates and whether each fit is valid.
+    """
+    if method == 'batch':
+        params, success = batch_gauss_estimate(patches, w_s)
+    elif method == 'log_gauss':
+        params, success = log_gauss_estimate(patches, w_s)
+    else:
+        params = np.zeros((len(patches), 5))
+        success = np.zeros(len(patches), dtype=bool)
+        for n, patch in enumerate(patches):
+            params[n], ier = gauss_estimate(patch, w_s)
+            success[n] = ier in (1, 2, 3, 4)
+
+    xc, yc, width, I, bg = params.T
+    width = np.abs(width)
+    residuals = (patches.reshape((len(patches), -1))
+                 - _batch_gauss_continuous(params, w_s))
+    fit_error = np.sqrt((residuals ** 2).mean(axis=1))
+
+    good = success & (I > 0) & (width < w_s)
+    return np.column_stack([xc, yc, width, I, fit_error]), good
+
+
+def batch_gauss_estimate(patches, w_s, xtol=1.49012e-08, max_iter=200):  # pragma: no cover
+    """
+    Least square 2D gauss fit of a stack of patches at once,
+    with a Levenberg-Marquardt algorithm run in parallel on all of them.
+    The model and initial parameters are the ones of `gauss_estimate`.
+
+    Parameters
+    ----------
+    patches: 3D array
+        Of shape `(n_patches, w_s, w_s)`
+    w_s: int
+    xtol: float, optional
+        Relative error desired in the parameters
+    max_iter: int, optional
+
+    Returns
+    -------
+    params: 2D array
+        `(xc, yc, width, I, bg)` for each patch
+    success: 1D bool array
+    """
+    n_patches = patches.shape[0]
+    data = patches.reshape((n_patches, -1))
+    params = np.zeros((n_patches, 5))
+    params[:, 0] = params[:, 1] = w_s / 2.
+    params[:, 2] = 3.
+    params[:, 3] = data.max(axis=1) - data.min(axis=1)
+    params[:, 4] = data.min(axis=1)
+
+    cost = ((data - _batch_gauss_continuous(params, w_s)) ** 2).sum(axis=1)
+    damping = np.ones(n_patches) * 1e-3
+    success = np.zeros(n_patches, dtype=bool)
+    active = np.arange(n_patches)
+
+    for _ in range(max_iter):
+        if not active.size:
+            break
+        model, jacobian = _batch_gauss_jacobian(params[active], w_s)
+        residuals = data[active] - model
+        jtj = np.einsum('npi,npj->nij', jacobian, jacobian)
+        jtr = np.einsum('npi,np->ni', jacobian, residuals)
+        diag = np.diagonal(jtj, axis1=1, axis2=2)
+        diag = np.maximum(diag, 1e-9 * diag.max(axis=1)[:, np.newaxis]
+                          + np.finfo(np.float64).tiny)
+        lhs = jtj + (damping[active, np.newaxis] * diag)[:, :, np.newaxis] * np.eye(5)
+        step = np.linalg.solve(lhs, jtr[:, :, np.newaxis])[:, :, 0]
+
+        new_params = params[active] + step
+        new_model = _batch_gauss_continuous(new_params, w_s)
+        new_cost = ((data[active] - new_model) ** 2).sum(axis=1)
+
+        better = new_cost < cost[active]
+        improved = active[better]
+        params[improved] = new_params[better]
+        cost[improved] = new_cost[better]
+        damping[improved] /= 10.
+        damping[active[~better]] *= 10.
+
+        step_norm = np.sqrt((step ** 2).sum(axis=1))
+        param_norm = np.sqrt((params[active] ** 2).sum(axis=1))
+        # Small accepted step, or no possible improvement
+        converged = ((better & (step_norm <= xtol * param_norm))
+                     | (damping[active] > 1e10))
+        success[active[converged]] = np.isfinite(cost[active[converged]])
+        active = active[~converged]
+
+    return params, success & np.all(np.isfinite(params), axis=1)
+
+
+def log_gauss_estimate(patches, w_s):  # pragma: no cover
+    """
+    Closed form 2D gauss estimate from the logarithm of the brightest
+    pixel of each patch and of its neighbours along each axis
+    (a parabola through three points).
+
+    Parameters
+    ----------
+    patches: 3D array
+        Of shape `(n_patches, w_s, w_s)`
+    w_s: int
+
+    Returns
+    -------
+    params: 2D array
+        `(xc, yc, width, I, bg)` for each patch
+    success: 1D bool array
+        False when the brightest pixel is on the patch border
+        or the profile is not peaked.
+    """
+    n_patches = patches.shape[0]
+    flat = patches.reshape((n_patches, -1))
+    bg = flat.min(axis=1)
+    i, j = np.unravel_index(flat.argmax(axis=1), (w_s, w_s))
+    success = (i > 0) & (i < w_s - 1) & (j > 0) & (j < w_s - 1)
+    i = np.clip(i, 1, w_s - 2)
+    j = np.clip(j, 1, w_s - 2)
+
+    n = np.arange(n_patches)
+    tiny = np.finfo(np.float64).tiny
+    log_patches = np.log(np.maximum(patches - bg[:, np.newaxis, np.newaxis], tiny))
+    center = log_patches[n, i, j]
+
+    def _parabola(before, after):
+        second = before - 2 * center + after
+        with np.errstate(divide='ignore', invalid='ignore'):
+            offset = (before - after) / (2 * second)
+            width_sq = - 2. / second
+        return offset, width_sq
+
+    offset_x, width_x = _parabola(log_patches[n, i - 1, j], log_patches[n, i + 1, j])
+    offset_y, width_y = _parabola(log_patches[n, i, j - 1], log_patches[n, i, j + 1])
+    success &= (width_x > 0) & (width_y > 0)
+
+    with np.errstate(invalid='ignore'):
+        width = np.sqrt((width_x + width_y) / 2.)
+        intensity = np.exp(center + offset_x ** 2 / width_x + offset_y ** 2 / width_y)
+    params = np.column_stack([i + offset_x, j + offset_y, width, intensity, bg])
+    return params, success & np.all(np.isfinite(params), axis=1)
 
 
 def glrt_detection(image, r0, w_s, threshold):  # pragma: no cover
@@ -359,32 +1022,153 @@ def glrt_detection(image, r0, w_s, threshold):  # pragma: no cover
     else:
         raise Exception("Image has to be np.ndarray or np.ma.core.MaskedArray")
 
+    w_s = int(w_s)
+    w, h = image.shape
+    if w <= w_s or h <= w_s:
+        return np.array([])
+    hmap = glrt_map(image, r0, w_s)
+    return _hmap_peaks(hmap, threshold, w_s, mask)
+
+
+def glrt_map(image, r0, w_s):
+    """
+    Computes the hypothesis map :math:`-2 \\log(L)` for all the
+    positions of a `w_s` wide window in the image at once (see
+    `hypothesis_map` for a single window).
+
+    The Gaussian template being separable, correlations and window
+    sums are computed by two successive 1D passes over the image.
+
+    Parameters:
+    ----------
+    image: 2D array
+    r0: float
+        the detected Gaussian peak 1/e radius
+    w_s: int
+        Size of the sliding window
+
+    Returns:
+    --------
+    hmap: 2D array
+        Of shape `(w - w_s, h - w_s)`, the value at `(i, j)` corresponding
+        to the window with `(i, j)` as upper left corner.
+    """
+    w_s = int(w_s)
     w, h = image.shape
+    n_pix = w_s ** 2
+
+    profile = np.exp(- (np.arange(w_s) - w_s // 2) ** 2 / r0 ** 2)
+    amplitude = 1. / (np.sqrt(np.pi) * r0)
     g_patch = gauss_patch(r0, w_s)
-    g_patch -= g_patch.mean()
-    g_squaresum = np.sum(g_patch ** 2)
-
-    hmap = []
-    for i, j in np.ndindex((w - w_s, h - w_s)):
-        tmp = image[int(i): int(i + w_s), int(j): int(j + w_s)]
-        h = hypothesis_map(tmp,
-                           g_patch,
-                           g_squaresum)
-        hmap.append(h)
-    hmap = np.array(hmap)
+    g_mean = g_patch.mean()
+    g_squaresum = np.sum((g_patch - g_mean) ** 2)
+
+    # The zero mean template makes the correlation insensitive to an
+    # offset, which is removed to limit rounding errors
+    image = np.asarray(image, dtype=np.float64)
+    image = image - image.mean()
+    ones = np.ones(w_s)
+    sums = _window_sum(image, ones, ones, (w - w_s, h - w_s))
+    square_sums = _window_sum(image ** 2, ones, ones, (w - w_s, h - w_s))
+    intensity = (amplitude * _window_sum(image, profile, profile,
+                                         (w - w_s, h - w_s))
+                 - g_mean * sums)
+    variance = np.maximum(square_sums / n_pix - (sums / n_pix) ** 2, 0)
+    normalisation = w_s * np.sqrt(variance)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = (n_pix / 2.) * np.log(1 - (intensity / normalisation) ** 2
+                                      / g_squaresum)
+    return -2 * ratio
+
+
+def glrt_map_3d(stack, r0, w_s, r0_z, w_s_z, planes=None):
+    """
+    Computes the hypothesis map of `glrt_map` with a 3D Gaussian
+    template, `w_s` wide in the plane and `w_s_z` planes deep.
 
-    try:
-        hmap = -2 * hmap.reshape((w - w_s, h - w_s))
-        peaks_coords = feature.peak_local_max(hmap, 3,
-                                              threshold_abs=threshold)
-        peaks_coords += w_s / 2
-        if isinstance(mask, np.ndarray):
-            peaks_coords = list(filter(lambda x: not mask[x[0], x[1]], peaks_coords))
+    The stack is padded by reflection along the z axis so that
+    there is one map plane per stack plane.
 
-        return peaks_coords
+    Parameters:
+    ----------
+    stack: 3D array
+        Planes of the stack along the first axis
+    r0: float
+        the detected Gaussian peak 1/e radius in the plane
+    w_s: int
+        Size of the sliding window in the plane
+    r0_z: float
+        the detected Gaussian peak 1/e radius along z, in planes
+    w_s_z: int
+        Odd number of planes of the sliding window
+    planes: tuple, optional
+        `(start, stop)` range of the map planes to compute, all of them
+        by default
 
-    except ValueError:
-        return np.array([])
+    Returns:
+    --------
+    hmap: 3D array
+        Of shape `(n_z, w - w_s, h - w_s)`, the value at `(k, i, j)`
+        corresponding to the window centered on plane `k` with `(i, j)`
+        as upper left corner. Only the `stop - start` planes from
+        `start` if `planes` is given.
+    """
+    w_s = int(w_s)
+    w_s_z = int(w_s_z)
+    n_z, w, h = stack.shape
+    start, stop = (0, n_z) if planes is None else planes
+    n_pix = w_s ** 2 * w_s_z
+    shape = (w - w_s, h - w_s)
+
+    profile = np.exp(- (np.arange(w_s) - w_s // 2) ** 2 / r0 ** 2)
+    profile_z = np.exp(- (np.arange(w_s_z) - w_s_z // 2) ** 2 / r0_z ** 2)
+    g_patch = (profile_z[:, np.newaxis, np.newaxis]
+               * np.outer(profile, profile)[np.newaxis])
+    g_mean = g_patch.mean()
+    g_squaresum = np.sum((g_patch - g_mean) ** 2)
+
+    stack = np.asarray(stack, dtype=np.float64)
+    stack = stack - stack.mean()
+    pad = w_s_z // 2
+    if pad:
+        stack = np.pad(stack, ((pad, pad), (0, 0), (0, 0)), mode='reflect')
+
+    def z_sum(image, weights):
+        sums = np.zeros((stop - start,) + image.shape[1:])
+        for c, weight in enumerate(weights):
+            sums += weight * image[start + c: stop + c]
+        return sums
+
+    ones = np.ones(w_s)
+    ones_z = np.ones(w_s_z)
+    sums = _window_sum(z_sum(stack, ones_z), ones, ones, shape)
+    square_sums = _window_sum(z_sum(stack ** 2, ones_z), ones, ones, shape)
+    intensity = (_window_sum(z_sum(stack, profile_z), profile, profile, shape)
+                 - g_mean * sums)
+    variance = np.maximum(square_sums / n_pix - (sums / n_pix) ** 2, 0)
+    normalisation = np.sqrt(n_pix * variance)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = (n_pix / 2.) * np.log(1 - (intensity / normalisation) ** 2
+                                      / g_squaresum)
+    return -2 * ratio
+
+
+def _window_sum(image, weights_x, weights_y, shape):
+    """
+    Weighted sums of `image` over windows of weights
+    `np.outer(weights_x, weights_y)`, for the `shape` first positions
+    of the window along the last two axes of `image`.
+    """
+    n_x, n_y = shape
+    rows = np.zeros(image.shape[:-2] + (n_x, image.shape[-1]))
+    for a, weight in enumerate(weights_x):
+        rows += weight * image[..., a: a + n_x, :]
+    sums = np.zeros(image.shape[:-2] + (n_x, n_y))
+    for b, weight in enumerate(weights_y):
+        sums += weight * rows[..., b: b + n_y]
+    return sums
 
 
 def hypothesis_map(patch, g_patch, g_squaresum):  # pragma: no cover
@@ -424,6 +1208,37 @@ def gauss_continuous(params, w_s):  # pragma: no cover
     return g_patch.flatten()
 
 
+def _batch_gauss_continuous(params, w_s):  # pragma: no cover
+    """`gauss_continuous` for each row of the `(n, 5)` array `params`"""
+    xc, yc, width, I, bg = [p[:, np.newaxis] for p in params.T]
+    span = np.arange(w_s)
+    x = np.exp(- (span - xc) ** 2 / width ** 2)
+    y = np.exp(- (span - yc) ** 2 / width ** 2)
+    g_patch = I[:, :, np.newaxis] * x[:, :, np.newaxis] * y[:, np.newaxis, :]
+    return g_patch.reshape((len(params), -1)) + bg
+
+
+def _batch_gauss_jacobian(params, w_s):  # pragma: no cover
+    """Values and derivatives with respect to `(xc, yc, width, I, bg)`
+    of `gauss_continuous` for each row of `params`.
+    """
+    n_params = len(params)
+    xc, yc, width, I, bg = [p[:, np.newaxis, np.newaxis] for p in params.T]
+    grid_x, grid_y = np.indices((w_s, w_s))
+    dx = grid_x - xc
+    dy = grid_y - yc
+    gauss = np.exp(- (dx ** 2 + dy ** 2) / width ** 2)
+    peak = I * gauss
+    jacobian = np.empty((n_params, w_s, w_s, 5))
+    jacobian[..., 0] = 2 * peak * dx / width ** 2
+    jacobian[..., 1] = 2 * peak * dy / width ** 2
+    jacobian[..., 2] = 2 * peak * (dx ** 2 + dy ** 2) / width ** 3
+    jacobian[..., 3] = gauss
+    jacobian[..., 4] = 1.
+    model = (peak + bg).reshape((n_params, -1))
+    return model, jacobian.reshape((n_params, -1, 5))
+
+
 def gauss_patch(r0, w_s):  # pragma: no cover
     """
     Computes an w_s by w_s image with a
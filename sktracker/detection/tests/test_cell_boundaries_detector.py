@@ -9,12 +9,17 @@ from __future__ import print_function
 
 
 from numpy.testing import assert_array_almost_equal
+from nose.tools import assert_raises
 
 import numpy as np
+from scipy import integrate
 
 from sktracker import data
 from sktracker.io import StackIO
 from sktracker.detection import cell_boundaries_detector
+from sktracker.detection.cell_boundaries_detector import correlation_image
+from sktracker.detection.cell_boundaries_detector import _linear_closing
+from sktracker.detection.cell_boundaries_detector import _bisect_closing
 
 
 def test_cell_boundaries_detector():
@@ -61,3 +66,88 @@ def test_cell_boundaries_detector_no_shapes():
                                       parameters=parameters)
 
     assert shapes.empty is True
+
+
+def test_correlation_image():
+
+    stack = np.random.RandomState(0).randint(0, 1000, size=(7, 5, 4))
+    sigma = 2.
+
+    corr = correlation_image(stack, sigma)
+
+    z = np.arange(7)
+    zf = 7 / 2
+    real_corr = np.zeros((5, 4))
+    for y, x in np.ndindex(5, 4):
+        real_corr[y, x] = integrate.simps(stack[:, y, x] * (z - zf) *
+                                          np.exp(-(zf - z) ** 2 / (2 * sigma ** 2)), z)
+
+    assert_array_almost_equal(corr, real_corr)
+
+
+def test_cell_boundaries_detector_closing_search():
+
+    st = StackIO(data.TC_BF_cells())
+    data_iterator = list(st.image_iterator(position=-3)())
+
+    metadata = st.metadata
+
+    parameters = {'object_height': 3,
+                  'minimal_area': 160}
+
+    # On every frame of the sample
+    shapes = {}
+    for closing_search in ('bisect', 'linear'):
+        parameters['closing_search'] = closing_search
+        shapes[closing_search] = cell_boundaries_detector(data_iterator, metadata,
+                                                          parameters=parameters,
+                                                          parallel=False)
+
+    assert_array_almost_equal(shapes['bisect'], shapes['linear'])
+
+    parameters['closing_search'] = 'golden'
+    assert_raises(ValueError, cell_boundaries_detector, data_iterator,
+                  metadata, parameters=parameters)
+
+
+def _fake_cell_props(areas):
+    """Cell of area `areas[n]` for a closing of size `n`, None where the
+    area is None or past the end of `areas`.
+    """
+    def cell_props(n):
+        if n < len(areas) and areas[n] is not None:
+            return {'area': areas[n], 'n': n}
+        return None
+    return cell_props
+
+
+def test_closing_searches():
+
+    minimal_area = 100
+    max_n = 64
+
+    def closing_n(areas, search):
+        if search == 'linear':
+            cellprop = _linear_closing(_fake_cell_props(areas), minimal_area)
+        else:
+            cellprop = _bisect_closing(_fake_cell_props(areas), minimal_area, max_n)
+        return None if cellprop is None else cellprop['n']
+
+    for search in ('linear', 'bisect'):
+        # The area grows at each step
+        areas = [None, None] + list(range(10, 10 * (max_n - 1), 10))
+        assert closing_n(areas, search) == 11
+        assert closing_n([None, None, 150, 160], search) == 2
+
+        # No cell for n = 2
+        assert closing_n([None, None, None, 50, 150], search) is None
+        assert closing_n([], search) is None
+
+        # The cell found for n = 2 is kept when the larger closings find none
+        assert closing_n([None, None, 50], search) == 2
+
+        # Never reaching the area
+        assert closing_n([None, None, 20, 30, 40, 50, 60, 70, 80], search) == 8
+
+    # The linear search stops on the first plateau
+    assert closing_n([None, None, 20, 40, 40, 60, 80, 100], 'linear') == 4
@@ -0,0 +1,91 @@
+
+# -*- coding: utf-8 -*-
+
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+
+import os
+import tempfile
+from multiprocessing.pool import MaybeEncodingError
+
+import numpy as np
+from numpy.testing import assert_array_equal
+from nose.tools import assert_raises
+
+from sktracker.detection.executor import DetectionExecutor
+from sktracker.detection.executor import _memmap_location
+
+
+def _frame_sum(frame, factor=1):
+    return frame.sum() * factor
+
+
+def _fail(frame):
+    raise ValueError('bad frame')
+
+
+def _unpicklable(frame):
+    return lambda: frame
+
+
+def test_executor_map():
+
+    frames = [np.arange(12).reshape((3, 4)) * n for n in range(10)]
+    expected = [frame.sum() * 2 for frame in frames]
+
+    with DetectionExecutor(n_workers=0) as executor:
+        results = list(executor.map(_frame_sum, frames, kwargs={'factor': 2}))
+    assert_array_equal([res for pos, res in results], expected)
+
+    with DetectionExecutor(n_workers=2, chunksize=3, window=2) as executor:
+        results = list(executor.map(_frame_sum, iter(frames), args=(2,)))
+        assert_array_equal([pos for pos, res in results], np.arange(10))
+        assert_array_equal([res for pos, res in results], expected)
+
+        # The pool is reused
+        results = sorted(executor.map(_frame_sum, frames, ordered=False))
+        assert_array_equal([res for pos, res in results], np.array(expected) / 2)
+
+
+def test_executor_memmap():
+
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        stack = np.memmap(filename, dtype=np.uint16, mode='w+',
+                          offset=16, shape=(5, 8, 8))
+        stack[:] = np.arange(stack.size).reshape(stack.shape)
+        stack.flush()
+
+        assert _memmap_location(stack[2]) == (filename, 16 + 2 * 8 * 8 * 2)
+        assert _memmap_location(stack[:, 1]) is None
+
+        with DetectionExecutor(n_workers=2) as executor:
+            results = list(executor.map(_frame_sum, stack))
+        assert_array_equal([res for pos, res in results],
+                           [frame.sum() for frame in stack])
+        del stack
+    finally:
+        os.remove(filename)
+
+
+def test_executor_error():
+
+    frames = [np.zeros((2, 2))] * 3
+    with DetectionExecutor(n_workers=2) as executor:
+        assert_raises(ValueError, list, executor.map(_fail, frames))
+    assert executor._pool is None
+    assert executor._spool is None
+
+
+def test_executor_pool_error():
+
+    frames = [np.zeros((2, 2))] * 3
+    for ordered in (True, False):
+        with DetectionExecutor(n_workers=2) as executor:
+            assert_raises(MaybeEncodingError, list,
+                          executor.map(_unpicklable, frames, ordered=ordered))
@@ -12,7 +12,14 @@ import os
 from sktracker import data
 from sktracker.io import StackIO
 from sktracker.detection import nuclei_detector
+from sktracker.detection.nuclei_detector import get_regionprops
+from sktracker.detection.nuclei_detector import cluster_regions
 from nose import with_setup
+from nose.tools import assert_raises
+
+import numpy as np
+import pandas as pd
+from numpy.testing import assert_array_almost_equal
 
 
 def setup():
@@ -88,3 +95,46 @@ def test_nuclei_detector_none():
                                      parameters=parameters)
 
     assert cell_positions.empty is True
+
+
+def test_get_regionprops():
+
+    labeled_stack = np.zeros((2, 20, 20), dtype=np.uint8)
+    labeled_stack[0, 2:6, 2:6] = 1
+    labeled_stack[0, 10:17, 8:15] = 2
+    labeled_stack[1, 0:2, 0:2] = 1
+    labeled_stack[1, 11:16, 9:14] = 3
+    z_stack = np.arange(800).reshape((2, 20, 20))
+    parameters = {'min_radius': 1.5, 'max_radius': 8.}
+
+    props = get_regionprops(labeled_stack, z_stack, parameters)
+
+    # The 2x2 region is too small
+    assert props.shape == (3, 5)
+    assert list(props.index) == [(1, 0), (2, 0), (3, 1)]
+    assert_array_almost_equal(props['x'], [3.5, 13., 13.])
+    assert_array_almost_equal(props['y'], [3.5, 11., 11.])
+    assert_array_almost_equal(props['I'], [z_stack[0, 2:6, 2:6].sum(),
+                                           z_stack[0, 10:17, 8:15].sum(),
+                                           z_stack[1, 11:16, 9:14].sum()])
+    assert_array_almost_equal(props['w'], np.sqrt(np.array([16, 49, 25]) / np.pi))
+
+
+def test_cluster_regions_kdtree():
+
+    # Two nuclei over 3 and 2 planes, and an isolated region
+    props = pd.DataFrame({'x': [10., 10.5, 11., 40., 40.5, 80.],
+                          'y': [10., 10.2, 9.8, 40., 41., 10.],
+                          'z': [0, 1, 2, 1, 2, 2],
+                          'I': [1., 2., 1., 3., 3., 1.],
+                          'w': [3., 3., 3., 3., 3., 3.]},
+                         columns=['x', 'y', 'z', 'I', 'w'])
+    parameters = {'max_radius': 5., 'min_z_size': 2, 'cluster_method': 'kdtree'}
+
+    clustered = cluster_regions(props.copy(), parameters)
+    assert clustered.shape == (5, 5)
+    assert len(clustered.index.unique()) == 2
+    assert_array_almost_equal(clustered['z'].groupby(level='label').size().values, [3, 2])
+
+    parameters['cluster_method'] = 'unknown'
+    assert_raises(ValueError, cluster_regions, props.copy(), parameters)
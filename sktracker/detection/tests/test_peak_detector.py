@@ -11,6 +11,20 @@ from __future__ import print_function
 from sktracker import data
 from sktracker.io import StackIO
 from sktracker.detection import peak_detector
+from sktracker.detection.peak_detector import gauss_estimation
+from sktracker.detection.peak_detector import _batch_gauss_continuous
+from sktracker.detection.peak_detector import glrt_map_3d
+from sktracker.detection.peak_detector import glrt_map
+from sktracker.detection.peak_detector import _find_gaussian_peaks
+from sktracker.detection.peak_detector import _hmap_peaks
+from sktracker.detection.peak_detector import _deflate
+from sktracker.detection.peak_detector import _find_gaussian_peaks_3d
+from sktracker.detection.peak_detector import _hmap_peaks_3d
+from sktracker.detection.peak_detector import _gauss_estimation_3d
+from sktracker.detection.peak_detector import _deflate_3d
+
+import numpy as np
+from numpy.testing import assert_array_almost_equal
 
 
 def test_peak_detector():
@@ -32,7 +46,7 @@ def test_peak_detector():
                           show_progress=False,
                           parameters=parameters)
 
-    assert peaks.shape == (28, 6)
+    assert peaks.shape == (28, 7)
 
 
 def test_peak_detector_no_peaks():
@@ -54,3 +68,191 @@ def test_peak_detector_no_peaks():
                           parameters=parameters)
 
     assert peaks.empty is True
+
+
+def test_gauss_estimation():
+
+    w_s = 11
+    params = np.array([[4.7, 5.2, 2., 200., 100.],
+                       [5.3, 4.6, 1.5, 150., 80.]])
+    image = np.zeros((40, 40))
+    image[10: 10 + w_s, 10: 10 + w_s] = _batch_gauss_continuous(params[:1], w_s).reshape((w_s, w_s))
+    image[25: 25 + w_s, 20: 20 + w_s] = _batch_gauss_continuous(params[1:], w_s).reshape((w_s, w_s))
+    peaks_coords = np.array([[15, 15], [30, 25]])
+
+    for method in ('batch', 'leastsq', 'log_gauss'):
+        peaks = np.array(gauss_estimation(image, peaks_coords, w_s, method=method))
+        assert peaks.shape == (2, 5)
+        assert_array_almost_equal(peaks[:, :2], params[:, :2] + [[10, 10], [25, 20]], decimal=2)
+        assert_array_almost_equal(peaks[:, 2], params[:, 2], decimal=2)
+        assert np.all(peaks[:, 4] < 1e-2)
+
+
+def test_peak_detector_tiles():
+
+    rng = np.random.RandomState(0)
+    size = 200
+    image = rng.normal(100, 5, (size, size))
+    span = np.arange(size)
+    # Some peaks lie on the tiles borders
+    for xc, yc in [(20.3, 30.6), (63.7, 64.2), (64.4, 120.8), (150.1, 127.5),
+                   (100.5, 60.2), (180.2, 180.9), (127.6, 64.3)]:
+        image += 150 * np.outer(np.exp(- (span - xc) ** 2 / 1.5 ** 2),
+                                np.exp(- (span - yc) ** 2 / 1.5 ** 2))
+
+    metadata = {'PhysicalSizeX': 1., 'PhysicalSizeY': 1., 'SizeT': 1, 'SizeZ': 1}
+    parameters = {'w_s': 9, 'peak_radius': 1.5, 'threshold': 27, 'max_peaks': 100}
+
+    peaks = peak_detector([image], metadata, parallel=False, parameters=parameters)
+    parameters['tile_size'] = 64
+    tiled_peaks = peak_detector([image], metadata, parallel=False, parameters=parameters)
+
+    assert peaks.shape == (7, 7)
+    assert tiled_peaks.shape == (7, 7)
+    order = np.lexsort(peaks[['x', 'y']].values.T)
+    tiled_order = np.lexsort(tiled_peaks[['x', 'y']].values.T)
+    assert_array_almost_equal(peaks[['y', 'x']].values[order],
+                              tiled_peaks[['y', 'x']].values[tiled_order])
+
+
+def test_peak_detector_3d():
+
+    rng = np.random.RandomState(0)
+    size, size_z = 64, 7
+    stack = rng.normal(100, 5, (size_z, size, size))
+    span, span_z = np.arange(size), np.arange(size_z)
+    spots = np.array([[15.3, 20.6, 2.4], [30.4, 12.8, 4.3], [40.7, 44.2, 3.8]])
+    for xc, yc, zc in spots:
+        stack += 150 * (np.exp(- (span_z - zc) ** 2 / 1.5 ** 2)[:, np.newaxis, np.newaxis]
+                        * np.outer(np.exp(- (span - xc) ** 2 / 1.5 ** 2),
+                                   np.exp(- (span - yc) ** 2 / 1.5 ** 2)))
+
+    metadata = {'PhysicalSizeX': 0.1, 'PhysicalSizeY': 0.1, 'PhysicalSizeZ': 0.2,
+                'SizeT': 1, 'SizeZ': size_z}
+    parameters = {'w_s': 0.9, 'peak_radius': 0.15, 'threshold': 27, 'max_peaks': 100}
+
+    # Each spot is found on several planes
+    peaks = peak_detector(list(stack), metadata, parallel=False, parameters=parameters)
+    assert len(peaks) > 3
+
+    parameters.update({'detection_3d': True, 'peak_radius_z': 0.3})
+    peaks = peak_detector(list(stack), metadata, parallel=False, parameters=parameters)
+    assert peaks.shape == (3, 7)
+    order = np.argsort(peaks['y'].values)
+    assert_array_almost_equal(peaks[['y', 'x']].values[order] / 0.1, spots[:, :2], decimal=1)
+    assert np.all(np.abs(peaks['z'].values[order] / 0.2 - spots[:, 2]) < 0.2)
+
+
+def test_glrt_map_3d_planes():
+
+    rng = np.random.RandomState(0)
+    stack = rng.normal(100, 5, (9, 60, 70))
+    hmap = glrt_map_3d(stack, 1.5, 9, 1.5, 3)
+    assert hmap.shape == (9, 51, 61)
+
+    # Map of a sub-block, on the first planes where z is padded
+    part = glrt_map_3d(stack[:, 10:30, 5:25], 1.5, 9, 1.5, 3, planes=(0, 4))
+    assert_array_almost_equal(part, hmap[0:4, 10:21, 5:16])
+
+
+def _spots_frame(seed, size=96, n_spots=25, n_close=8):
+    """Noisy frame of Gaussian spots, `n_close` of them having a neighbour
+    closer than the detection window.
+    """
+    rng = np.random.RandomState(seed)
+    image = rng.normal(100, 5, (size, size))
+    span = np.arange(size)
+    centers = rng.uniform(10, size - 10, (n_spots, 2))
+    close = centers[:n_close] + rng.uniform(-5, 5, (n_close, 2))
+    for xc, yc in np.vstack([centers, close]):
+        image += rng.uniform(60, 200) * np.outer(np.exp(- (span - xc) ** 2 / 1.5 ** 2),
+                                                 np.exp(- (span - yc) ** 2 / 1.5 ** 2))
+    return image
+
+
+def _full_recompute_peaks(image, w_s, peak_radius, threshold, max_peaks=1e4):
+    """Deflation loop recomputing the whole hypothesis map on each round.
+    Peaks deflation doesn't remove are found again on every round, the
+    loop stops on the first round finding only known peaks.
+    """
+    d_image = np.array(image, dtype=np.float64)
+    peaks_coords = _hmap_peaks(glrt_map(d_image, peak_radius, w_s), threshold, w_s)
+    peaks = []
+    while len(peaks_coords) > 0 and len(peaks) < max_peaks:
+        new_peaks = [peak for peak in gauss_estimation(d_image, peaks_coords, w_s)
+                     if peak not in peaks]
+        if not new_peaks:
+            break
+        peaks.extend(new_peaks)
+        _deflate(d_image, new_peaks, w_s)
+        peaks_coords = _hmap_peaks(glrt_map(d_image, peak_radius, w_s), threshold, w_s)
+    return np.array(peaks)
+
+
+def test_find_gaussian_peaks_incremental():
+
+    for seed in range(10):
+        image = _spots_frame(seed)
+        peaks = _find_gaussian_peaks(image, w_s=9, peak_radius=1.5, threshold=27)
+        expected = _full_recompute_peaks(image, w_s=9, peak_radius=1.5, threshold=27)
+        assert peaks.shape == expected.shape
+        order = np.lexsort(peaks[:, :2].T)
+        expected_order = np.lexsort(expected[:, :2].T)
+        assert_array_almost_equal(peaks[order], expected[expected_order])
+
+
+def test_find_gaussian_peaks_not_deflated():
+
+    image = _spots_frame(18)
+    max_peaks = 40
+    peaks = _find_gaussian_peaks(image, w_s=9, peak_radius=1.5, threshold=27,
+                                 max_peaks=max_peaks)
+
+    # A peak is fitted away from its candidate position, which deflation
+    # leaves unchanged: the whole deflated map still has the candidate,
+    # and fitting it gives the same peak again
+    d_image = np.array(image, dtype=np.float64)
+    _deflate(d_image, peaks, 9)
+    peaks_coords = _hmap_peaks(glrt_map(d_image, 1.5, 9), 27, 9)
+    refitted = gauss_estimation(d_image, peaks_coords, 9)
+    assert any(peak in peaks.tolist() for peak in refitted)
+
+    # The loop stops instead of fitting it again until max_peaks
+    assert len(peaks) < max_peaks
+    assert len(set(map(tuple, peaks[:, :2]))) == len(peaks)
+
+
+def test_find_gaussian_peaks_3d_incremental():
+
+    rng = np.random.RandomState(3)
+    size, size_z = 128, 9
+    stack = rng.normal(100, 5, (size_z, size, size))
+    span, span_z = np.arange(size), np.arange(size_z)
+    for xc, yc, zc in np.column_stack([rng.uniform(8, size - 8, (40, 2)),
+                                       rng.uniform(1, size_z - 2, 40)]):
+        profile_z = np.exp(- (span_z - zc) ** 2 / 1.5 ** 2)[:, np.newaxis, np.newaxis]
+        stack += rng.uniform(80, 200) * (profile_z
+                                         * np.outer(np.exp(- (span - xc) ** 2 / 1.5 ** 2),
+                                                    np.exp(- (span - yc) ** 2 / 1.5 ** 2)))
+
+    peaks = _find_gaussian_peaks_3d(stack, w_s=9, peak_radius=1.5, threshold=27,
+                                    peak_radius_z=1.5)
+
+    # Deflation loop recomputing the whole hypothesis map on each round
+    d_stack = np.array(stack, dtype=np.float64)
+    peaks_coords = _hmap_peaks_3d(glrt_map_3d(d_stack, 1.5, 9, 1.5, 3), 27, 9)
+    expected = []
+    while len(peaks_coords) > 0:
+        new_peaks = [peak for peak in _gauss_estimation_3d(d_stack, peaks_coords, 9).tolist()
+                     if peak not in expected]
+        if not new_peaks:
+            break
+        expected.extend(new_peaks)
+        _deflate_3d(d_stack, np.array(new_peaks), 9, 3, 1.5)
+        peaks_coords = _hmap_peaks_3d(glrt_map_3d(d_stack, 1.5, 9, 1.5, 3), 27, 9)
+    expected = np.array(expected)
+
+    assert peaks.shape == expected.shape
+    order = np.lexsort(peaks[:, :3].T)
+    expected_order = np.lexsort(expected[:, :3].T)
+    assert_array_almost_equal(peaks[order], expected[expected_order])
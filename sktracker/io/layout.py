@@ -0,0 +1,338 @@
+
+# -*- coding: utf-8 -*-
+
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+
+import os
+import json
+import struct
+import hashlib
+import logging
+import tempfile
+
+import numpy as np
+
+from . import TiffFile
+
+log = logging.getLogger(__name__)
+
+__all__ = []
+
+
+class TiffLayout(object):
+    """Position of the image data in a TIFF file, used to read other files
+    written the same way without parsing all their pages.
+
+    A file is considered to share the layout if it has the same size, the
+    same first page (image shape, data type, compression and data
+    position) and the same data position for all its pages as the file the
+    layout was built from. Only the first page of such a file is parsed and
+    the data position of its other pages read from their IFD, its data is
+    then read directly from the offsets of the template pages.
+
+    Parameters
+    ----------
+    tf : :class:`sktracker.io.TiffFile`
+        Template file, its first series is used.
+
+    Raises
+    ------
+    ValueError
+        If the image data of the series can't be read directly (compressed,
+        predicted or colormapped pages, missing pages).
+    """
+
+    def __init__(self, tf):
+
+        series = tf.series[0]
+        pages = series.pages
+        if any(page is None for page in pages):
+            raise ValueError("Missing pages in series")
+        for page in pages:
+            if page.parent is not tf:
+                raise ValueError("Series pages are in several files")
+            if (not page.is_contiguous or page.predictor or page.is_palette or
+                    page.is_mdgel or page.is_stk):
+                raise ValueError("Page {} data can't be read directly".format(page.index))
+
+        self.dtype = np.dtype(tf.byteorder + pages[0].dtype)
+        self.shape = tuple(series.shape)
+        self.page_shape = tuple(pages[0].shape)
+        self.data = [page.is_contiguous for page in pages]
+        page_size = self.dtype.itemsize * int(np.prod(self.page_shape))
+        if (any(size != page_size for offset, size in self.data) or
+                len(self.data) * page_size != self.dtype.itemsize * np.prod(self.shape)):
+            raise ValueError("Series shape doesn't match pages data")
+
+        self.file_size = tf.filehandle.size
+        self.signature = _page_signature(tf, pages[0])
+        self.page_offsets = _page_data_offsets(tf)
+
+    @classmethod
+    def from_file(cls, filename):
+        """Builds the layout of `filename`, or returns None if its data can't
+        be read directly.
+        """
+        with TiffFile(filename) as tf:
+            try:
+                return cls(tf)
+            except ValueError as e:
+                log.debug("No layout for %s: %s", filename, e)
+                return None
+
+    @classmethod
+    def from_dict(cls, layout_dict):
+        """Builds a layout from the output of `TiffLayout.to_dict`.
+        """
+        layout = cls.__new__(cls)
+        layout.dtype = np.dtype(str(layout_dict['dtype']))
+        layout.shape = tuple(layout_dict['shape'])
+        layout.page_shape = tuple(layout_dict['page_shape'])
+        layout.data = [tuple(data) for data in layout_dict['data']]
+        layout.file_size = layout_dict['file_size']
+        layout.signature = _as_tuple(layout_dict['signature'])
+        layout.page_offsets = layout_dict['page_offsets']
+        return layout
+
+    def to_dict(self):
+        """JSON serializable description of the layout.
+        """
+        return {'dtype': self.dtype.str,
+                'shape': list(self.shape),
+                'page_shape': list(self.page_shape),
+                'data': [list(data) for data in self.data],
+                'file_size': self.file_size,
+                'signature': self.signature,
+                'page_offsets': self.page_offsets}
+
+    def pages(self, filename):
+        """Readers of the pages of `filename`, which must have this layout,
+        in series order, see `LayoutPage`.
+        """
+        return [LayoutPage(filename, offset, self.dtype, self.page_shape)
+                for offset, size in self.data]
+
+    def matches(self, filename):
+        """Whether `filename` has this layout. Only its first page is parsed,
+        the data position of the other pages is read from their IFD.
+        """
+        if os.path.getsize(filename) != self.file_size:
+            return False
+        try:
+            with TiffFile(filename, max_pages=1) as tf:
+                # Pages with tags of variable length (e.g. per plane JSON
+                # metadata) may shift the data of the next pages
+                return (_page_signature(tf, tf.pages[0]) == self.signature and
+                        _page_data_offsets(tf) == self.page_offsets)
+        except (ValueError, struct.error):
+            return False
+
+    def read(self, filename, memmap=False):
+        """Reads the image of `filename`, which must have this layout.
+
+        Parameters
+        ----------
+        filename : str
+        memmap : bool
+            If True and the whole image is stored contiguously in native
+            byte order, return a read only `numpy.memmap` of the file.
+
+        Returns
+        -------
+        arr : array
+            Image data with the shape of the template series, in native byte
+            order.
+        """
+        offset = self.data[0][0]
+        # Pages data follow each other
+        contiguous = all(start + size == next_start for (start, size), (next_start, _)
+                         in zip(self.data[:-1], self.data[1:]))
+        if memmap and contiguous and self.dtype.isnative:
+            return np.memmap(filename, dtype=self.dtype, mode='r',
+                             offset=offset, shape=self.shape)
+
+        native_dtype = self.dtype.newbyteorder('=')
+        arr = np.empty(self.shape, dtype=native_dtype)
+        flat = arr.reshape(len(self.data), -1)
+        with open(filename, 'rb') as image_file:
+            if contiguous:
+                image_file.seek(offset)
+                flat[:] = np.fromfile(image_file, self.dtype, arr.size).reshape(flat.shape)
+            else:
+                for plane, (start, size) in zip(flat, self.data):
+                    image_file.seek(start)
+                    plane[:] = np.fromfile(image_file, self.dtype, plane.size)
+        return arr
+
+
+class LayoutPage(object):
+    """Image data of a TIFF page at a known position of a file.
+
+    Provides the `dtype` attribute and the `asarray` method of
+    :class:`sktracker.io.tifffile.TiffPage`, the file is opened for each
+    read.
+    """
+
+    def __init__(self, filename, offset, dtype, shape):
+        self.filename = filename
+        self.offset = offset
+        self._file_dtype = dtype
+        self.dtype = dtype.newbyteorder('=')
+        self.shape = shape
+
+    def asarray(self, memmap=False, maxworkers=1):
+        # Data is not compressed, maxworkers is unused
+        if memmap and self._file_dtype.isnative:
+            return np.memmap(self.filename, dtype=self._file_dtype, mode='r',
+                             offset=self.offset, shape=self.shape)
+        with open(self.filename, 'rb') as image_file:
+            image_file.seek(self.offset)
+            arr = np.fromfile(image_file, self._file_dtype, int(np.prod(self.shape)))
+        return arr.reshape(self.shape).astype(self.dtype, copy=False)
+
+
+def load_structure(filename, cache_dir):
+    """Loads the layout and metadata of `filename` stored in `cache_dir` by
+    `save_structure`.
+
+    Returns
+    -------
+    layout : :class:`TiffLayout` or None
+        None if the data of `filename` can't be read directly.
+    metadata : dict
+
+    Or None if nothing is cached for `filename` or if the file changed
+    (other modification time or size) since it was cached.
+    """
+    cache_path = _cache_path(filename, cache_dir)
+    if not os.path.isfile(cache_path):
+        return None
+    try:
+        with open(cache_path) as cache_file:
+            cached = json.load(cache_file)
+        if cached['key'] != list(_cache_key(filename)):
+            return None
+
+        layout = cached['layout']
+        if layout is not None:
+            layout = TiffLayout.from_dict(layout)
+        metadata = cached['metadata']
+        for key in cached['tuples']:
+            metadata[key] = tuple(metadata[key])
+    # Missing keys are from an older cache format
+    except (ValueError, KeyError):
+        log.warning("Ignoring corrupted cache file %s", cache_path)
+        return None
+    return layout, metadata
+
+
+def save_structure(filename, cache_dir, layout, metadata):
+    """Stores the layout and metadata of `filename` in `cache_dir`. They are
+    keyed on the absolute path, modification time and size of the file.
+
+    Parameters
+    ----------
+    filename : str
+    cache_dir : str
+        Created if it doesn't exist.
+    layout : :class:`TiffLayout` or None
+    metadata : dict
+        Must be JSON serializable, tuples are restored as such.
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    cached = {'key': list(_cache_key(filename)),
+              'layout': layout.to_dict() if layout is not None else None,
+              'metadata': metadata,
+              'tuples': [key for key, value in metadata.items()
+                         if isinstance(value, tuple)]}
+
+    # Written aside then renamed, so that a cache file is always complete
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as cache_file:
+        json.dump(cached, cache_file, default=_to_builtin)
+    os.rename(tmp_path, _cache_path(filename, cache_dir))
+
+
+def _cache_key(filename):
+    stat = os.stat(filename)
+    return os.path.abspath(filename), stat.st_mtime, stat.st_size
+
+
+def _cache_path(filename, cache_dir):
+    name = hashlib.sha1(os.path.abspath(filename).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, name + '.json')
+
+
+def _to_builtin(value):
+    # numpy scalars
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("{} is not JSON serializable".format(repr(value)))
+
+
+def _as_tuple(value):
+    if isinstance(value, list):
+        return tuple(_as_tuple(item) for item in value)
+    return value
+
+
+def _page_data_offsets(tf):
+    """Offsets of the first strip or tile of all the pages of `tf`, read
+    from the IFD chain without parsing the pages.
+    """
+    fh = tf.filehandle
+    byteorder = tf.byteorder
+    if tf.offset_size == 8:
+        first_ifd, count_fmt, entry_fmt, value_size = 8, 'Q', 'HHQ', 8
+    else:
+        first_ifd, count_fmt, entry_fmt, value_size = 4, 'H', 'HHI', 4
+    offset_fmt = {4: 'I', 8: 'Q'}[tf.offset_size]
+    entry_size = struct.calcsize(byteorder + entry_fmt) + value_size
+    # SHORT, LONG and LONG8 tag types
+    type_fmts = {3: 'H', 4: 'I', 16: 'Q'}
+
+    def read(fmt, offset=None):
+        if offset is not None:
+            fh.seek(offset)
+        fmt = byteorder + fmt
+        return struct.unpack(fmt, fh.read(struct.calcsize(fmt)))
+
+    data_offsets = []
+    ifd_offset = read(offset_fmt, first_ifd)[0]
+    visited = set()
+    while ifd_offset and ifd_offset not in visited:
+        visited.add(ifd_offset)
+        n_entries = read(count_fmt, ifd_offset)[0]
+        entries = fh.read(n_entries * entry_size)
+        data_offset = None
+        for i in range(n_entries):
+            entry = entries[i * entry_size:(i + 1) * entry_size]
+            code, dtype, count = struct.unpack(byteorder + entry_fmt,
+                                               entry[:-value_size])
+            # StripOffsets and TileOffsets
+            if code not in (273, 324) or dtype not in type_fmts:
+                continue
+            fmt = type_fmts[dtype]
+            value = entry[-value_size:]
+            if count * struct.calcsize(fmt) > value_size:
+                value_offset = struct.unpack(byteorder + offset_fmt, value)[0]
+                data_offset = read(fmt, value_offset)[0]
+            else:
+                data_offset = struct.unpack(byteorder + fmt,
+                                            value[:struct.calcsize(fmt)])[0]
+            break
+        data_offsets.append(data_offset)
+        ifd_offset = read(offset_fmt, ifd_offset + struct.calcsize(byteorder + count_fmt)
+                          + n_entries * entry_size)[0]
+    return data_offsets
+
+
+def _page_signature(tf, page):
+    return (tf.byteorder, page.shape, page.dtype, page.compression,
+            page.is_contiguous)
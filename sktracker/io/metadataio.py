@@ -73,7 +73,7 @@ class OIOMetadata(OrderedDict):
                         raise ValueError(msg.format(k, type(self[k]), v))
 
 
-def get_metadata(filename, json_discovery=False, base_dir=None):
+def get_metadata(filename, json_discovery=False, base_dir=None, header_only=False):
     """Get image file metadata. Metadata will be retrieved from TIFF IFD comments. OME is
     automatically detected. Additionnaly a file called metadata.json can be in the same directory or
     in the parent directory will be read to initialize metadata.
@@ -82,6 +82,14 @@ def get_metadata(filename, json_discovery=False, base_dir=None):
     ----------
     filename: str
         Filename of the image
+    json_discovery: bool
+        Find metadata in metadata.json files
+    base_dir: str
+        Directory `filename` is relative to
+    header_only: bool
+        For OME-TIFF files, only read the first page and get shape and
+        dimensions from its OME XML, instead of parsing all the pages of
+        the file. Falls back to parsing all pages for other files.
 
     Returns
     -------
@@ -99,27 +107,16 @@ def get_metadata(filename, json_discovery=False, base_dir=None):
     else:
         abs_filename = filename
 
-    tf = TiffFile(abs_filename)
+    header_md = None
+    if header_only:
+        header_md = _get_from_first_page(abs_filename)
+        if header_md is None:
+            log.debug("No OME shape in the first page of %s, reading all pages", abs_filename)
 
-    axes = tf.series[0]['axes']
-    shape = tf.series[0]['shape']
-
-    md['Shape'] = shape
-    md['DimensionOrder'] = axes
-
-    if tf.is_imagej or tf.is_ome:
-
-        for dim_label in md['DimensionOrder']:
-            try:
-                dim_id = axes.index(dim_label)
-                md["Size" + dim_label] = shape[dim_id]
-            except:
-                md["Size" + dim_label] = 1
-
-    if tf.is_ome:
-        xml_metadata = tf[0].tags['image_description'].value.decode(errors='ignore')
-        ome = OMEModel(xml_metadata)
-        md.update(ome.get_metadata())
+    if header_md is not None:
+        md.update(header_md)
+    else:
+        md.update(_get_from_tiff(abs_filename))
 
     # if tf.is_micromanager:
         # pass
@@ -129,10 +126,52 @@ def get_metadata(filename, json_discovery=False, base_dir=None):
         json_metadata = _get_from_metadata_json(abs_filename)
         md.update(json_metadata)
 
-    del tf
-    import gc
-    gc.collect()
+    return md
+
+
+def _get_from_tiff(filename):
+    """Get metadata from the series and the OME XML of a TIFF file, all its
+    pages are parsed.
+    """
+    md = {}
+
+    with TiffFile(filename) as tf:
+
+        axes = tf.series[0]['axes']
+        shape = tf.series[0]['shape']
+
+        md['Shape'] = shape
+        md['DimensionOrder'] = axes
+
+        if tf.is_imagej or tf.is_ome:
+
+            for dim_label in md['DimensionOrder']:
+                try:
+                    dim_id = axes.index(dim_label)
+                    md["Size" + dim_label] = shape[dim_id]
+                except:
+                    md["Size" + dim_label] = 1
+
+        if tf.is_ome:
+            xml_metadata = tf[0].tags['image_description'].value.decode(errors='ignore')
+            ome = OMEModel(xml_metadata)
+            md.update(ome.get_metadata())
+
+    return md
+
+
+def _get_from_first_page(filename):
+    """Get metadata from the OME XML of the first page of a TIFF file, or
+    None if it is not an OME-TIFF file or its shape can't be found.
+    """
+    with TiffFile(filename, multifile=False, max_pages=1) as tf:
+        if not tf.is_ome:
+            return None
+        xml_metadata = tf[0].tags['image_description'].value.decode(errors='ignore')
 
+    md = OMEModel(xml_metadata).get_metadata()
+    if 'Shape' not in md:
+        return None
     return md
 
 
@@ -23,6 +23,10 @@ from ..utils.dict import guess_values_type
 
 __all__ = []
 
+# Columns indexed in table format, so that they can be queried with
+# `ObjectsIO.select`
+DATA_COLUMNS = ['t_stamp', 'label']
+
 
 class ObjectsIO(object):
     """
@@ -40,13 +44,32 @@ class ObjectsIO(object):
     clean_store : bool
         If True, remove duplicated data in the HDFStore file
         (see https://github.com/pydata/pandas/issues/2132)
+    table_format : bool
+        If True, DataFrames are stored in the chunked and compressed
+        'table' format of `pandas.HDFStore`, with the `t_stamp` and
+        `label` columns and index levels queryable: parts of them can
+        then be read with `ObjectsIO.select`. Otherwise they are stored
+        in the faster to write but uncompressed 'fixed' format.
+    complib : str
+        Compression library of the table format: 'blosc', 'zlib', 'lzo'
+        or 'bzip2'.
+    complevel : int
+        Compression level of the table format, from 0 (no compression)
+        to 9.
     """
 
     def __init__(self, metadata=None,
                  store_path=None,
                  base_dir=None,
                  minimum_metadata_keys=[],
-                 clean_store=False):
+                 clean_store=False,
+                 table_format=False,
+                 complib='blosc',
+                 complevel=5):
+
+        self.table_format = table_format
+        self.complib = complib
+        self.complevel = complevel
 
         if metadata is not None:
             validate_metadata(metadata, keys=minimum_metadata_keys)
@@ -86,7 +109,8 @@ class ObjectsIO(object):
         return cls(metadata=stackio.metadata)
 
     @classmethod
-    def from_h5(cls, store_path, base_dir=None, minimum_metadata_keys=[], clean_store=False):
+    def from_h5(cls, store_path, base_dir=None, minimum_metadata_keys=[], clean_store=False,
+                **kwargs):
         """Load ObjectsIO from HDF5 file.
 
         Parameters
@@ -95,6 +119,8 @@ class ObjectsIO(object):
             HDF5 file path.
         base_dir : str
             Root directory
+        kwargs : dict
+            Storage options passed to :class:`ObjectsIO`
 
         """
 
@@ -112,7 +138,8 @@ class ObjectsIO(object):
                    store_path=store_path,
                    base_dir=base_dir,
                    minimum_metadata_keys=minimum_metadata_keys,
-                   clean_store=clean_store)
+                   clean_store=clean_store,
+                   **kwargs)
 
     def __getitem__(self, name):
         """Get an object from HDF5 file.
@@ -148,6 +175,12 @@ class ObjectsIO(object):
             if isinstance(obj, dict) or isinstance(obj, OrderedDict):
                 obj = sanitize_dict(obj)
                 store.put(name, pd.Series(obj))
+            elif isinstance(obj, pd.DataFrame) and self.table_format:
+                data_columns = [column for column in DATA_COLUMNS if column in obj.columns]
+                store.put(name, obj, format='table',
+                          data_columns=data_columns,
+                          complib=self.complib,
+                          complevel=self.complevel)
             elif isinstance(obj, pd.DataFrame):
                 store.put(name, obj)
             elif isinstance(obj, pd.Series):
@@ -155,6 +188,29 @@ class ObjectsIO(object):
             else:
                 log.warning("'{}' not saved because {} are not handled.".format(name, type(obj)))
 
+    def select(self, name, where=None, columns=None):
+        """Read the rows of an object matching `where`, without loading
+        the whole object. It has to be stored with `table_format=True`.
+
+        Parameters
+        ----------
+        name : str
+            Name of the object
+        where : str or list, optional
+            Query on the index levels and the `t_stamp` and `label`
+            columns, such as `'t_stamp < 100'`, see
+            :meth:`pandas.HDFStore.select`
+        columns : list, optional
+            Columns to read
+
+        Returns
+        -------
+        obj : :class:`pandas.DataFrame`
+        """
+        with pd.get_store(self.store_path) as store:
+            obj = store.select(name, where=where, columns=columns)
+        return obj
+
     def __delitem__(self, name):
         """
         """
@@ -197,8 +253,13 @@ class ObjectsIO(object):
         """
         _, fname = tempfile.mkstemp()
 
+        # Tables are compressed again in the copy
+        kwargs = {}
+        if self.table_format:
+            kwargs = dict(complib=self.complib, complevel=self.complevel)
+
         with pd.get_store(self.store_path) as store:
-            new_store = store.copy(fname)
+            new_store = store.copy(fname, **kwargs)
 
         new_store.close()
 
@@ -11,11 +11,18 @@ from __future__ import print_function
 import sys
 import os
 import logging
+import collections
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 
 from .metadataio import get_metadata
+from .metadataio import _get_from_metadata_json
+from .utils import prefetch_iterator
 from . import TiffFile
+from .layout import TiffLayout
+from .layout import load_structure
+from .layout import save_structure
 
 log = logging.getLogger(__name__)
 
@@ -35,6 +42,11 @@ class StackIO(object):
         Specify a root directory relative to `image_path`.
     json_discovery : bool
         Find metadata in metadata.json files
+    cache_dir : path or None
+        If given, the metadata and the position of the image data in the
+        file are stored in this directory, and reused as long as the file
+        is not modified, so that TIFF pages are parsed only once. See
+        :func:`sktracker.io.layout.save_structure`.
 
     """
 
@@ -43,9 +55,11 @@ class StackIO(object):
                  image_path_list=None,
                  metadata=None,
                  base_dir=None,
-                 json_discovery=False):
+                 json_discovery=False,
+                 cache_dir=None):
 
         self.base_dir = base_dir
+        self._layout = None
         if image_path_list:
             image_path = image_path_list[0]
 
@@ -53,6 +67,9 @@ class StackIO(object):
             self.metadata = metadata
             if image_path is not None:
                 self.metadata['FileName'] = image_path
+        elif cache_dir is not None:
+            self.metadata = self._get_cached_metadata(image_path, json_discovery,
+                                                      cache_dir)
         else:
             self.metadata = get_metadata(image_path, json_discovery,
                                          base_dir=self.base_dir)
@@ -66,6 +83,32 @@ class StackIO(object):
                     self.metadata['DimensionOrder'] = 'T'+''.join(self.metadata['DimensionOrder'])
         self._image_path_list = image_path_list
 
+    def _get_cached_metadata(self, image_path, json_discovery, cache_dir):
+        """Get metadata and image layout from `cache_dir`, or from the TIFF
+        file, which are then cached.
+        """
+        if self.base_dir:
+            abs_path = os.path.join(self.base_dir, image_path)
+        else:
+            abs_path = image_path
+
+        cached = load_structure(abs_path, cache_dir)
+        if cached is not None:
+            self._layout, metadata = cached
+            log.info('Getting metadata from cache')
+        else:
+            metadata = get_metadata(image_path, base_dir=self.base_dir)
+            log.info('Getting metadata from TIFF file')
+            metadata.pop('FileName')
+            self._layout = TiffLayout.from_file(abs_path)
+            save_structure(abs_path, cache_dir, self._layout, metadata)
+
+        metadata['FileName'] = image_path
+        # metadata.json files are not cached
+        if json_discovery:
+            metadata.update(_get_from_metadata_json(abs_path))
+        return metadata
+
     @property
     def image_path_list(self):
         if not self._image_path_list:
@@ -117,16 +160,18 @@ class StackIO(object):
         tf = TiffFile(self.image_path_list[index])
         return tf
 
-    def image_iterator(self, position=-2, channel_index=0, z_projection=False, memmap=False):
+    def image_iterator(self, position=-2, channel_index=0, z_projection=False, memmap=False,
+                       prefetch=0, maxworkers=1):
         """Iterate over image T and Z dimensions. A channel has to be
         choosen and will be excluded from the iterator.
 
         Notes
         -----
-        For now image_iterator load the whole image in memory and build iterator from it.
-        To avoid filling memory you can try to use memmap=True but it often fails. In the
-        future, image_iterator should only build iterator without filling memory with whole
-        image.
+        The image is never loaded as a whole: the TIFF pages holding each
+        yielded array are read when it is requested, so that memory is
+        bounded by the size of one yielded array (one stack when iterating
+        over T with `position=-3`). Channel selection and Z projection are
+        done on these pages only.
 
         Parameters
         ----------
@@ -135,8 +180,18 @@ class StackIO(object):
             keep the two last dimensions, usually X and Y.
         channel_index : int or str
             Channel position to remove. If str, Channels metadata will be used.
+        z_projection : bool
+            If True, yield maximum projections along Z.
         memmap : bool
-            If True, use `numpy.memmap` to read arrays from file if possible.
+            If True, use `numpy.memmap` to read pages from file if possible.
+            Yielded planes are then views on the file.
+        prefetch : int
+            Number of arrays read ahead in a background thread while the
+            current one is processed, see
+            :func:`sktracker.io.utils.prefetch_iterator`.
+        maxworkers : int
+            Number of threads reading (and decompressing) the pages of a
+            yielded array at once, or the strips of a single page.
 
         Returns
         -------
@@ -148,14 +203,6 @@ class StackIO(object):
         else:
             string_types = (str, unicode)
 
-        try:
-            tf = self.get_tif(multifile=True)
-            arr = tf.asarray(memmap=memmap)
-        except ValueError:
-            log.warning("Failed to open TiffFile with multifile option. Use fallback method.")
-            tf = self.get_tif(multifile=False)
-            arr = tf.asarray(memmap=memmap).reshape(self.metadata['Shape'])
-
         if isinstance(channel_index, string_types):
             if 'Channels' in self.metadata.keys():
                 channel_index = self.metadata['Channels'].index(channel_index)
@@ -163,37 +210,135 @@ class StackIO(object):
                 raise TypeError("'Channels' key is missing in metadata."
                                 "Can't find '{}' index".format(channel_index))
 
+        close, pages, shape = self._get_pages()
+        n_leading = _leading_dimensions(shape, len(pages))
+        dtype = next(page for page in pages if page is not None).dtype
+
         current_dimension_order = list(self.metadata['DimensionOrder'])
 
         # Get only one single channel
+        channel_position = None
         if 'C' in current_dimension_order:
             channel_position = current_dimension_order.index('C')
-            arr = np.take(arr, channel_index, axis=channel_position)
-            current_dimension_order.remove('C')
 
+        z_position = None
         if z_projection:
             if 'Z' in current_dimension_order:
                 z_position = current_dimension_order.index('Z')
-                arr = arr.max(axis=z_position)
-                current_dimension_order.remove('Z')
             else:
                 log.warning("No Z detected. Can't perform Z projection")
 
+        kept = [axis for axis in range(len(shape))
+                if axis not in (channel_position, z_position)]
+        iterated = kept[:position]
+        # Page dimensions of the whole image read for each yielded array
+        read = [axis for axis in range(n_leading)
+                if axis not in iterated and axis != channel_position]
+        # Dimensions remaining once the pages are indexed, Z among them
+        remaining = read + [axis for axis in range(n_leading, len(shape))
+                            if axis not in iterated and axis != channel_position]
+
+        def select(arr, index):
+            """Selects the channel and the iterated dimensions inside the
+            pages of `arr` and projects it along Z.
+            """
+            in_page = tuple(index[axis] if axis in iterated or axis == channel_position
+                            else slice(None) for axis in range(n_leading, len(shape)))
+            arr = arr[(slice(None),) * len(read) + in_page]
+            if z_position is not None:
+                arr = arr.max(axis=remaining.index(z_position))
+            return arr
+
+        def read_array(idx, pool):
+            index = [0] * len(shape)
+            if channel_position is not None:
+                index[channel_position] = channel_index
+            for axis, i in zip(iterated, idx):
+                index[axis] = i
+
+            if not read:
+                page = pages[np.ravel_multi_index(index[:n_leading], shape[:n_leading])]
+                if page is None:
+                    return select(np.zeros(shape[n_leading:], dtype=dtype), index)
+                return select(page.asarray(memmap=memmap, maxworkers=maxworkers), index)
+
+            arr = np.zeros([shape[axis] for axis in read] + list(shape[n_leading:]),
+                           dtype=dtype)
+
+            def read_page(sub_index):
+                page_idx = list(index[:n_leading])
+                for axis, i in zip(read, sub_index):
+                    page_idx[axis] = i
+                page = pages[np.ravel_multi_index(page_idx, shape[:n_leading])]
+                if page is not None:
+                    arr[sub_index] = page.asarray()
+
+            sub_indices = list(np.ndindex(*arr.shape[:len(read)]))
+            if pool is not None:
+                pool.map(read_page, sub_indices)
+            else:
+                for sub_index in sub_indices:
+                    read_page(sub_index)
+            return select(arr, index)
+
+        def read_arrays():
+            pool = ThreadPool(maxworkers) if maxworkers > 1 else None
+            try:
+                for idx in np.ndindex(*[shape[axis] for axis in iterated]):
+                    yield read_array(idx, pool)
+            finally:
+                if pool is not None:
+                    pool.terminate()
+                close()
+
         # Define data iterator
         def it():
-            for idx in np.ndindex(arr.shape[:position]):
-                yield arr[idx]
+            return prefetch_iterator(read_arrays(), prefetch)
 
         return it
 
-    def list_iterator(self, memmap=True):
+    def _get_pages(self):
+        """Opens the image and returns a function closing it, the pages of its
+        image in C order of the leading dimensions (None for missing pages),
+        and the image shape.
+        """
+        if self._layout is not None:
+            pages = self._layout.pages(self.image_path)
+            return (lambda: None), pages, self._layout.shape
+
+        try:
+            tf = self.get_tif(multifile=True)
+            series = tf.series[0]
+            pages, shape = series.pages, tuple(series.shape)
+            _leading_dimensions(shape, len(pages))
+        except ValueError:
+            log.warning("Failed to open TiffFile with multifile option. Use fallback method.")
+            tf = self.get_tif(multifile=False)
+            pages, shape = tf.pages, tuple(self.metadata['Shape'])
+        return tf.close, pages, shape
+
+    def list_iterator(self, memmap=True, prefetch=0, n_threads=4, reuse_layout=True):
         """Returns an iterator over each image from
         `self.image_path_list` as an array
 
+        Images are read by a pool of threads, in order, and each file is
+        closed once read.
+
         Parameters
         ----------
         memmap : bool
             If True, use `numpy.memmap` to read arrays from file if possible.
+        prefetch : int
+            Number of images read ahead in a background thread while the
+            current one is processed, see
+            :func:`sktracker.io.utils.prefetch_iterator`.
+        n_threads : int
+            Number of images read at once. With `n_threads=0`, images are
+            read in the iterating thread.
+        reuse_layout : bool
+            If True, the structure of the first file is parsed once and the
+            data of the files sharing it is read without parsing their
+            pages, see :class:`sktracker.io.layout.TiffLayout`.
 
         Returns
         -------
@@ -201,8 +346,47 @@ class StackIO(object):
         """
         image_list = self.image_path_list
 
+        def read_stacks():
+            if not image_list:
+                return
+            layout = TiffLayout.from_file(image_list[0]) if reuse_layout else None
+
+            def read_stack(filename):
+                if layout is not None and layout.matches(filename):
+                    return layout.read(filename, memmap=memmap)
+                with TiffFile(filename) as tf:
+                    return tf.asarray(memmap=memmap)
+
+            if n_threads < 1:
+                for filename in image_list:
+                    yield read_stack(filename)
+                return
+
+            pool = ThreadPool(n_threads)
+            pending = collections.deque()
+            try:
+                for filename in image_list:
+                    pending.append(pool.apply_async(read_stack, (filename,)))
+                    # Bounds the number of stacks in memory
+                    if len(pending) >= 2 * n_threads:
+                        yield pending.popleft().get()
+                while pending:
+                    yield pending.popleft().get()
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+
         def stack_iter():
-            for filename in image_list:
-                stack = TiffFile(filename).asarray(memmap=memmap)
-                yield stack
+            return prefetch_iterator(read_stacks(), prefetch)
         return stack_iter
+
+
+def _leading_dimensions(shape, n_pages):
+    """Number of the first dimensions of `shape` spanned by `n_pages` TIFF
+    pages, the remaining ones being the dimensions of a page.
+    """
+    for n_leading in range(len(shape) - 2, -1, -1):
+        if int(np.prod(shape[:n_leading])) == n_pages:
+            return n_leading
+    raise ValueError("Can't match {} pages to image shape {}".format(n_pages, shape))
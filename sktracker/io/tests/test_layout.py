@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from sktracker import data
+from sktracker.io import TiffFile
+from sktracker.io import imsave
+from sktracker.io.layout import TiffLayout
+from sktracker.io.layout import load_structure
+from sktracker.io.layout import save_structure
+
+
+def test_tiff_layout():
+
+    file_list = data.stack_list()
+    layout = TiffLayout.from_file(file_list[0])
+
+    assert layout.shape == (5, 172, 165)
+    for filename in file_list:
+        assert layout.matches(filename)
+        with TiffFile(filename) as tf:
+            arr = tf.asarray()
+        assert_array_equal(layout.read(filename), arr)
+        assert_array_equal(layout.read(filename, memmap=True), arr)
+
+    assert not layout.matches(data.CZT_peaks())
+
+
+def test_tiff_layout_shifted_pages():
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmp_dir, 'stack.tif')
+        imsave(fname, np.arange(500, dtype=np.uint8).reshape((5, 10, 10)))
+        layout = TiffLayout.from_file(fname)
+
+        # Same size and first page, but the data of the last page is moved
+        shifted = os.path.join(tmp_dir, 'shifted.tif')
+        shutil.copy(fname, shifted)
+        with TiffFile(fname) as tf:
+            tag = tf.pages[-1].tags['strip_offsets']
+            value = np.array([tag.value[0] + 1], dtype=tf.byteorder + 'u4')
+        with open(shifted, 'r+b') as shifted_file:
+            shifted_file.seek(tag.value_offset)
+            shifted_file.write(value.tostring())
+
+        assert layout.matches(fname)
+        assert not layout.matches(shifted)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_tiff_file_max_pages():
+
+    with TiffFile(data.stack_list()[0], max_pages=1) as tf:
+        assert len(tf.pages) == 1
+
+
+def test_structure_cache():
+
+    cache_dir = tempfile.mkdtemp()
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmp_dir, 'stack.tif')
+        shutil.copy(data.stack_list()[0], fname)
+
+        assert load_structure(fname, cache_dir) is None
+
+        layout = TiffLayout.from_file(fname)
+        metadata = {'Shape': (5, 172, 165), 'DimensionOrder': ['I', 'Y', 'X']}
+        save_structure(fname, cache_dir, layout, metadata)
+
+        cached_layout, cached_metadata = load_structure(fname, cache_dir)
+        assert cached_metadata == metadata
+        assert cached_layout.matches(fname)
+        assert_array_equal(cached_layout.read(fname), layout.read(fname))
+
+        # Modified files are not read from the cache
+        stat = os.stat(fname)
+        os.utime(fname, (stat.st_atime, stat.st_mtime + 10))
+        assert load_structure(fname, cache_dir) is None
+    finally:
+        shutil.rmtree(cache_dir)
+        shutil.rmtree(tmp_dir)
@@ -35,6 +35,14 @@ def test_get_metadata():
     assert real_metadata == guessed_metadata
 
 
+def test_get_metadata_header_only():
+
+    for fname in (data.sample_ome(), data.stack_list()[0]):
+        metadata = get_metadata(fname)
+        header_metadata = get_metadata(fname, header_only=True)
+        assert metadata == header_metadata
+
+
 def test_invalidate_metadata():
 
     bad_metadata = {'SizeC': 2, 'SizeZ': 8}
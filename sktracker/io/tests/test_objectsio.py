@@ -10,6 +10,7 @@ import tempfile
 
 import numpy as np
 import pandas as pd
+from pandas.util.testing import assert_frame_equal
 
 from sktracker import data
 from sktracker.io import StackIO
@@ -137,3 +138,52 @@ def test_clean_store_file():
     after = os.path.getsize(oio.store_path)
 
     assert before == after
+
+
+def test_oio_table_format():
+
+    store_path = data.sample_h5_temp()
+    objects = ObjectsIO(store_path=store_path)['objects']
+
+    oio = ObjectsIO(store_path=store_path, table_format=True, complib='zlib', complevel=9)
+    oio['table'] = objects
+
+    assert_frame_equal(oio['table'], objects)
+
+    t_stamps = objects.index.get_level_values('t_stamp')
+    selected = oio.select('table', where='t_stamp < 2')
+    assert_frame_equal(selected, objects[t_stamps < 2])
+
+    # Metadata is still stored as a Series
+    assert oio['metadata']['FileName'] == oio.metadata['FileName']
+
+
+def test_oio_table_format_data_columns():
+
+    store_path = data.sample_h5_temp()
+    objects = ObjectsIO(store_path=store_path)['objects'].reset_index()
+
+    oio = ObjectsIO(store_path=store_path, table_format=True)
+    oio['table'] = objects
+
+    selected = oio.select('table', where='label == 1')
+    assert_frame_equal(selected, objects[objects['label'] == 1])
+
+    selected = oio.select('table', where=['t_stamp >= 2', 'label < 2'])
+    assert_frame_equal(selected, objects[(objects['t_stamp'] >= 2) & (objects['label'] < 2)])
+
+
+def test_oio_table_format_clean_store_file():
+
+    store_path = data.sample_h5_temp()
+    objects = ObjectsIO(store_path=store_path)['objects']
+
+    oio = ObjectsIO(store_path=store_path, table_format=True, complib='zlib', complevel=9)
+    oio['compressed'] = objects
+    oio.clean_store_file()
+
+    with pd.get_store(oio.store_path) as store:
+        filters = store.get_storer('compressed').table.filters
+    assert filters.complib == 'zlib'
+    assert filters.complevel == 9
+    assert_frame_equal(oio['compressed'], objects)
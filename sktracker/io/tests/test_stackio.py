@@ -6,13 +6,19 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 import os
+import shutil
+import tempfile
 
+import numpy as np
 from nose.tools import assert_raises
+from numpy.testing import assert_array_equal
 
 from sktracker import data
 from sktracker.io import StackIO
 from sktracker.io import ObjectsIO
+from sktracker.io import imsave
 from sktracker.io.utils import load_img_list
+from sktracker.io.utils import prefetch_iterator
 
 
 def test_stackio_from_tif_file():
@@ -92,6 +98,85 @@ def test_stackio_image_iterator():
     assert list(it())[0].shape == arr.shape[-2:]
 
 
+def test_stackio_image_iterator_stacks():
+    fname = data.sample_ome()
+    st = StackIO(fname, json_discovery=False)
+
+    # Shape is (T, Z, C, Y, X)
+    arr = st.get_tif().asarray()
+
+    stacks = list(st.image_iterator(position=-3, channel_index=1)())
+    assert len(stacks) == arr.shape[0]
+    for t, stack in enumerate(stacks):
+        assert_array_equal(stack, arr[t, :, 1])
+
+    projections = list(st.image_iterator(position=-2, channel_index=1,
+                                         z_projection=True)())
+    assert len(projections) == arr.shape[0]
+    for t, projection in enumerate(projections):
+        assert_array_equal(projection, arr[t, :, 1].max(axis=0))
+
+
+def test_stackio_image_iterator_prefetch():
+    fname = data.sample_ome()
+    st = StackIO(fname, json_discovery=False)
+
+    stacks = list(st.image_iterator(position=-3, channel_index=1)())
+    prefetched = list(st.image_iterator(position=-3, channel_index=1, prefetch=2)())
+
+    assert len(prefetched) == len(stacks)
+    for stack, prefetched_stack in zip(stacks, prefetched):
+        assert_array_equal(stack, prefetched_stack)
+
+
+def test_stackio_cache_dir():
+    fname = data.sample_ome()
+    cache_dir = tempfile.mkdtemp()
+
+    try:
+        st = StackIO(fname)
+        StackIO(fname, cache_dir=cache_dir)
+        cached_st = StackIO(fname, cache_dir=cache_dir)
+        assert len(os.listdir(cache_dir)) == 1
+    finally:
+        shutil.rmtree(cache_dir)
+
+    assert cached_st.metadata == st.metadata
+
+    stacks = st.image_iterator(position=-3, channel_index=1)()
+    cached_stacks = cached_st.image_iterator(position=-3, channel_index=1)()
+    for stack, cached_stack in zip(stacks, cached_stacks):
+        assert_array_equal(stack, cached_stack)
+
+
+def test_prefetch_iterator():
+
+    assert list(prefetch_iterator(range(10), depth=3)) == list(range(10))
+    assert list(prefetch_iterator(range(10), depth=0)) == list(range(10))
+
+    closed = []
+
+    def items():
+        try:
+            for i in range(100):
+                yield i
+        finally:
+            closed.append(True)
+
+    iterator = prefetch_iterator(items(), depth=2)
+    assert next(iterator) == 0
+    iterator.close()
+    assert closed == [True]
+
+    def failing():
+        yield 0
+        raise IOError('Broken file')
+
+    iterator = prefetch_iterator(failing(), depth=2)
+    assert next(iterator) == 0
+    assert_raises(IOError, next, iterator)
+
+
 def test_load_img_list():
     stack_list_dir = data.stack_list_dir()
     file_list = load_img_list(stack_list_dir)
@@ -124,6 +209,10 @@ def test_stackio_list_iterator():
         assert stack.shape == (5, 172, 165)
     assert n == 3
 
+    stack_iter = stackio.list_iterator(prefetch=2)
+    for stack, prefetched_stack in zip(stackio.list_iterator()(), stack_iter()):
+        assert_array_equal(stack, prefetched_stack)
+
     file_list = data.stack_list()
     stackio = StackIO(image_path_list=file_list, metadata=metadata,
                       base_dir=os.path.dirname(file_list[0]))
@@ -135,3 +224,34 @@ def test_stackio_get_tif_from_list():
     images_list = data.stack_list()
     st = StackIO(image_path_list=images_list)
     assert st.get_tif_from_list(3).asarray().shape == (5, 172, 165)
+
+
+def test_stackio_image_iterator_in_page():
+    # Pages of 3 samples, taken as channels or Z planes
+    arr = np.random.randint(0, 2**16, size=(4, 3, 40, 30)).astype(np.uint16)
+    directory = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(directory, 'samples.tif')
+        imsave(fname, arr)
+
+        metadata = {'Shape': arr.shape, 'DimensionOrder': 'TCYX'}
+        st = StackIO(fname, metadata=metadata)
+        planes = list(st.image_iterator(position=-2, channel_index=2)())
+        assert len(planes) == 4
+        for t, plane in enumerate(planes):
+            assert_array_equal(plane, arr[t, 2])
+
+        metadata = {'Shape': arr.shape, 'DimensionOrder': 'TZYX'}
+        st = StackIO(fname, metadata=metadata)
+        for memmap in (False, True):
+            projections = list(st.image_iterator(position=-2, z_projection=True,
+                                                 memmap=memmap)())
+            assert len(projections) == 4
+            for t, projection in enumerate(projections):
+                assert_array_equal(projection, arr[t].max(axis=0))
+
+        stacks = list(st.image_iterator(position=-3)())
+        for t, stack in enumerate(stacks):
+            assert_array_equal(stack, arr[t])
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import multiprocessing
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from sktracker import data
+from sktracker.io import TiffFile
+from sktracker.io import StackIO
+from sktracker.io import imsave
+
+
+def test_tiff_file_asarray_lazy():
+
+    with TiffFile(data.sample_ome()) as tf:
+        arr = tf.asarray()
+        lazy_arr = tf.asarray_lazy()
+
+        assert lazy_arr.shape == arr.shape
+        assert lazy_arr.dtype == arr.dtype
+        assert len(lazy_arr) == len(arr)
+
+        # Single pages are memory mapped
+        assert isinstance(lazy_arr[3, 2, 1], np.memmap)
+        assert_array_equal(lazy_arr[3, 2, 1], arr[3, 2, 1])
+
+        assert_array_equal(lazy_arr[3], arr[3])
+        assert_array_equal(lazy_arr[2:10:3, ..., 5], arr[2:10:3, ..., 5])
+        assert_array_equal(lazy_arr[-1, :, 0, 4:8], arr[-1, :, 0, 4:8])
+        assert_array_equal(np.asarray(lazy_arr), arr)
+
+
+def test_tiff_file_asarray_maxworkers():
+
+    arr = np.random.RandomState(0).randint(0, 2**16, size=(6, 3, 40, 30)).astype(np.uint16)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmp_dir, 'compressed.tif')
+        imsave(fname, arr, compress=6)
+        with TiffFile(fname) as tf:
+            assert tf.pages[0].compression == 'deflate'
+            assert_array_equal(tf.asarray(maxworkers=3), arr)
+            # Pages are (3, 40, 30) planar RGB images, with one strip per plane
+            assert len(tf.pages[4].strip_offsets) == 3
+            assert_array_equal(tf.pages[4].asarray(maxworkers=3), arr[4])
+
+        metadata = {'DimensionOrder': ['T', 'Z', 'Y', 'X'],
+                    'Shape': arr.shape}
+        st = StackIO(fname, metadata=metadata)
+        stacks = st.image_iterator(position=-3, maxworkers=3)()
+        for stack, real_stack in zip(stacks, arr):
+            assert_array_equal(stack, real_stack)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def _read_maxworkers(fname):
+    with TiffFile(fname) as tf:
+        return tf.asarray(maxworkers=2)
+
+
+def test_tiff_file_asarray_maxworkers_fork():
+
+    arr = np.random.RandomState(0).randint(0, 2**16, size=(6, 5, 40, 30)).astype(np.uint16)
+
+    tmp_dir = tempfile.mkdtemp()
+    pool = None
+    try:
+        fname = os.path.join(tmp_dir, 'compressed.tif')
+        imsave(fname, arr, compress=6)
+        assert_array_equal(_read_maxworkers(fname), arr)
+
+        # Threads of the parent don't exist in the forked workers
+        pool = multiprocessing.Pool(1)
+        result = pool.apply_async(_read_maxworkers, (fname,))
+        assert_array_equal(result.get(timeout=60), arr)
+    finally:
+        if pool is not None:
+            pool.terminate()
+        shutil.rmtree(tmp_dir)
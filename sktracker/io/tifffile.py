@@ -143,8 +143,10 @@ import struct
 import warnings
 import tempfile
 import datetime
+import threading
 import collections
 from fractions import Fraction
+from multiprocessing.pool import ThreadPool
 from xml.etree import cElementTree as etree
 
 import numpy
@@ -160,7 +162,7 @@ import numpy
 __version__ = '2014.08.24'
 __docformat__ = 'restructuredtext en'
 __all__ = ('imsave', 'imread', 'imshow', 'TiffFile', 'TiffWriter',
-           'TiffSequence')
+           'TiffSequence', 'TiffPageArray')
 
 
 def imsave(filename, data, **kwargs):
@@ -744,7 +746,7 @@ class TiffFile(object):
 
     """
     def __init__(self, arg, name=None, offset=None, size=None,
-                 multifile=True, multifile_close=True):
+                 multifile=True, multifile_close=True, max_pages=None):
         """Initialize instance from file.
 
         Parameters
@@ -767,9 +769,13 @@ class TiffFile(object):
             If True (default), keep the handles of other files in multifile
             series closed. This is inefficient when few files refer to
             many pages. If False, the C runtime may run out of resources.
+        max_pages : int
+            Optional maximum number of pages to read. By default all pages
+            are read. Series of partially read files are incomplete.
 
         """
         self._fh = FileHandle(arg, name=name, offset=offset, size=size)
+        self._max_pages = max_pages
         self.offset_size = None
         self.pages = []
         self._multifile = bool(multifile)
@@ -815,7 +821,7 @@ class TiffFile(object):
         else:
             raise ValueError("not a TIFF file")
         self.pages = []
-        while True:
+        while self._max_pages is None or len(self.pages) < self._max_pages:
             try:
                 page = TiffPage(self)
                 self.pages.append(page)
@@ -978,7 +984,7 @@ class TiffFile(object):
 
         return series
 
-    def asarray(self, key=None, series=None, memmap=False):
+    def asarray(self, key=None, series=None, memmap=False, maxworkers=1):
         """Return image data from multiple TIFF pages as numpy array.
 
         By default the first image series is returned.
@@ -992,6 +998,9 @@ class TiffFile(object):
         memmap : bool
             If True, return an array stored in a binary file on disk
             if possible.
+        maxworkers : int
+            Maximum number of threads decoding pages at once (or strips
+            and tiles of a single page).
 
         """
         if key is None and series is None:
@@ -1022,9 +1031,10 @@ class TiffFile(object):
                 result = numpy.swapaxes(result, 0, 1)
             else:
                 result = stack_pages(pages, memmap=memmap,
+                                     maxworkers=maxworkers,
                                      colormapped=False, squeeze=False)
         elif len(pages) == 1:
-            return pages[0].asarray(memmap=memmap)
+            return pages[0].asarray(memmap=memmap, maxworkers=maxworkers)
         elif self.is_ome:
             assert not self.is_palette, "color mapping disabled for ome-tiff"
             if any(p is None for p in pages):
@@ -1059,6 +1069,19 @@ class TiffFile(object):
                     if self._close and self.parent != self.master:
                         self.parent.filehandle.close()
 
+            page_size = result.size // len(pages)
+            if (maxworkers > 1 and page_size * len(pages) == result.size and
+                    page_size == product(next(p for p in pages if p).shape)):
+                # pages re-open their file if closed
+                def read_page(i):
+                    if pages[i]:
+                        a = pages[i].asarray(memmap=False, colormapped=False)
+                    else:
+                        a = nopage
+                    result[i*page_size:(i+1)*page_size] = a.reshape(-1)
+                thread_map(read_page, range(len(pages)), maxworkers)
+                pages = []
+
             keep = KeepOpen(self, self._multifile_close)
             for page in pages:
                 keep.open(page)
@@ -1075,7 +1098,7 @@ class TiffFile(object):
                 index += a.size
             keep.close()
         else:
-            result = stack_pages(pages, memmap=memmap)
+            result = stack_pages(pages, memmap=memmap, maxworkers=maxworkers)
 
         if key is None:
             try:
@@ -1093,6 +1116,25 @@ class TiffFile(object):
             result.shape = (-1,) + pages[0].shape
         return result
 
+    def asarray_lazy(self, series=0, memmap=True):
+        """Return image data of a series as a lazy array of pages.
+
+        Pages are only read when the array is indexed, each one as a
+        numpy.memmap view on the file if possible (uncompressed pages
+        stored in native byte order), so that indexing a plane costs a
+        page read at most, even if the series is not contiguous in file.
+
+        Parameters
+        ----------
+        series : int
+            Defines which series of pages to return.
+        memmap : bool
+            If True (default), memory map pages when possible.
+
+        """
+        s = self.series[series]
+        return TiffPageArray(s.pages, s.shape, s.dtype, memmap=memmap)
+
     def _omeseries(self):
         """Return image series in OME-TIFF file(s)."""
         root = etree.fromstring(self.pages[0].tags['image_description'].value.decode(errors='ignore'))
@@ -1301,6 +1343,105 @@ class TiffFile(object):
         return self.pages[0].is_ome
 
 
+class TiffPageArray(object):
+    """Array-like view on a series of TIFF pages, reading pages on demand.
+
+    Supports numpy style indexing with integers and slices (and lists of
+    indices) along the page dimensions, and any indexing within pages.
+    Indexing a single page returns the page array (or a view of it), with
+    no copy if the page is memory mapped. Other selections are assembled
+    in a new array.
+
+    Attributes
+    ----------
+    shape : tuple
+    dtype : numpy.dtype
+    ndim : int
+    pages : list of TiffPage
+        Missing pages are None and read as zeros.
+
+    Examples
+    --------
+    >>> with TiffFile('test.ome.tif') as tif:
+    ...     data = tif.asarray_lazy()
+    ...     plane = data[3, 2]
+
+    """
+    def __init__(self, pages, shape, dtype, memmap=True):
+        self.pages = pages
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+        self.memmap = memmap
+        # number of leading dimensions spanned by the pages
+        for i in range(len(self.shape), -1, -1):
+            if product(self.shape[:i]) == len(pages):
+                self._leading = i
+                break
+        else:
+            raise ValueError("can not match %i pages to shape %s" % (
+                             len(pages), str(self.shape)))
+        self._page_shape = self.shape[self._leading:]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return product(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        result = self[...]
+        if dtype is not None:
+            result = result.astype(dtype)
+        return result
+
+    def page(self, index):
+        """Return data of page `index` in series order."""
+        page = self.pages[index]
+        if page is None:
+            return numpy.zeros(self._page_shape, self.dtype)
+        return page.asarray(memmap=self.memmap).reshape(self._page_shape)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, )
+        if any(k is None for k in key):
+            raise IndexError("new axes are not supported")
+        if Ellipsis in key:
+            i = key.index(Ellipsis)
+            key = (key[:i] + (slice(None), ) * (self.ndim - len(key) + 1) +
+                   key[i+1:])
+        if len(key) > self.ndim:
+            raise IndexError("too many indices")
+        key = key + (slice(None), ) * (self.ndim - len(key))
+
+        leading, within = key[:self._leading], key[self._leading:]
+        indices = numpy.arange(len(self.pages)).reshape(
+            self.shape[:self._leading])[leading]
+        if indices.ndim == 0:
+            return self.page(int(indices))[within]
+
+        result = None
+        for index in numpy.ndindex(*indices.shape):
+            data = self.page(int(indices[index]))[within]
+            if result is None:
+                result = numpy.empty(indices.shape + numpy.shape(data),
+                                     self.dtype)
+            result[index] = data
+        if result is None:
+            result = numpy.empty(indices.shape + numpy.zeros(
+                self._page_shape, self.dtype)[within].shape, self.dtype)
+        return result
+
+    def __str__(self):
+        return "TiffPageArray %s %s, %i pages" % (
+            str(self.shape), str(self.dtype), len(self.pages))
+
+
 class TiffPage(object):
     """A TIFF image file directory (IFD).
 
@@ -1647,7 +1788,7 @@ class TiffPage(object):
         assert len(self.shape) == len(self.axes)
 
     def asarray(self, squeeze=True, colormapped=True, rgbonly=False,
-                scale_mdgel=False, memmap=False, reopen=True):
+                scale_mdgel=False, memmap=False, reopen=True, maxworkers=1):
         """Read image data from file and return as numpy array.
 
         Raise ValueError if format is unsupported.
@@ -1672,6 +1813,10 @@ class TiffPage(object):
         scale_mdgel : bool
             If True, MD Gel data will be scaled according to the private
             metadata in the second TIFF page. The dtype will be float32.
+        maxworkers : int
+            Maximum number of threads decoding strips or tiles at once.
+            Strips and tiles are read from file first, then decoded, which
+            is faster when the decompressor releases the GIL (zlib).
 
         """
         if not self._shape:
@@ -1687,12 +1832,6 @@ class TiffPage(object):
             raise ValueError("sample formats don't match %s" % str(tag.value))
 
         fh = self.parent.filehandle
-        closed = fh.closed
-        if closed:
-            if reopen:
-                fh.open()
-            else:
-                raise IOError("file handle is closed")
 
         dtype = self._dtype
         shape = self._shape
@@ -1727,12 +1866,34 @@ class TiffPage(object):
         if any(o < 2 for o in offsets):
             raise ValueError("corrupted page")
 
-        if memmap and self._is_memmappable(rgbonly, colormapped):
-            result = fh.memmap_array(typecode, shape, offset=offsets[0])
-        elif self.is_contiguous:
-            fh.seek(offsets[0])
-            result = fh.read_array(typecode, product(shape))
-            result = result.astype('=' + dtype)
+        # file accesses are serialized, data is decoded out of the lock
+        with fh.lock:
+            closed = fh.closed
+            if closed:
+                if reopen:
+                    fh.open()
+                else:
+                    raise IOError("file handle is closed")
+            try:
+                if memmap and self._is_memmappable(rgbonly, colormapped):
+                    result = fh.memmap_array(typecode, shape,
+                                             offset=offsets[0])
+                elif self.is_contiguous:
+                    fh.seek(offsets[0])
+                    result = fh.read_array(typecode, product(shape))
+                else:
+                    result = None
+                    chunks = []
+                    for offset, bytecount in zip(offsets, byte_counts):
+                        fh.seek(offset)
+                        chunks.append(fh.read(bytecount))
+            finally:
+                if closed:
+                    fh.close()
+
+        if result is not None:
+            if not isinstance(result, numpy.memmap):
+                result = result.astype('=' + dtype)
         else:
             if self.is_contig:
                 runlen *= self.samples_per_pixel
@@ -1762,12 +1923,18 @@ class TiffPage(object):
                 table = self.jpeg_tables if 'jpeg_tables' in self.tags else b''
                 decompress = lambda x: decodejpg(x, table, self.photometric)
 
+            def decode(chunk):
+                return unpack(decompress(chunk))
+
+            if maxworkers > 1 and len(chunks) > 1:
+                chunks = thread_map(decode, chunks, maxworkers)
+            else:
+                chunks = map(decode, chunks)
+
             if self.is_tiled:
                 result = numpy.empty(shape, dtype)
                 tw, tl, td, pl = 0, 0, 0, 0
-                for offset, bytecount in zip(offsets, byte_counts):
-                    fh.seek(offset)
-                    tile = unpack(decompress(fh.read(bytecount)))
+                for tile in chunks:
                     tile.shape = tile_shape
                     if self.predictor == 'horizontal':
                         numpy.cumsum(tile, axis=-2, dtype=dtype, out=tile)
@@ -1788,11 +1955,7 @@ class TiffPage(object):
                               self.samples_per_pixel)
                 result = numpy.empty(shape, dtype).reshape(-1)
                 index = 0
-                for offset, bytecount in zip(offsets, byte_counts):
-                    fh.seek(offset)
-                    strip = fh.read(bytecount)
-                    strip = decompress(strip)
-                    strip = unpack(strip)
+                for strip in chunks:
                     size = min(result.size, strip.size, strip_size,
                                result.size - index)
                     result[index:index+size] = strip[:size]
@@ -1848,9 +2011,6 @@ class TiffPage(object):
                     result **= 2  # squary root data format
                 result *= scale
 
-        if closed:
-            # TODO: file remains open if an exception occurred above
-            fh.close()
         return result
 
     def _is_memmappable(self, rgbonly, colormapped):
@@ -2457,12 +2617,15 @@ class FileHandle(object):
         Size of file in bytes.
     is_file : bool
         If True, file has a filno and can be memory mapped.
+    lock : threading.RLock
+        Must be held by threads seeking and reading the file.
+        Shared with the parent FileHandle of embedded files.
 
     All attributes are read-only.
 
     """
     __slots__ = ('_fh', '_arg', '_mode', '_name', '_dir',
-                 '_offset', '_size', '_close', 'is_file')
+                 '_offset', '_size', '_close', 'is_file', 'lock')
 
     def __init__(self, arg, mode='rb', name=None, offset=None, size=None):
         """Initialize file handle from file name or another file handle.
@@ -2492,6 +2655,10 @@ class FileHandle(object):
         self._size = size
         self._close = True
         self.is_file = False
+        if isinstance(arg, FileHandle):
+            self.lock = arg.lock
+        else:
+            self.lock = threading.RLock()
         self.open()
 
     def open(self):
@@ -3420,10 +3587,11 @@ def transpose_axes(data, axes, asaxes='CTZYX'):
     return data
 
 
-def stack_pages(pages, memmap=False, *args, **kwargs):
+def stack_pages(pages, memmap=False, maxworkers=1, *args, **kwargs):
     """Read data from sequence of TiffPage and stack them vertically.
 
     If memmap is True, return an array stored in a binary file on disk.
+    Up to maxworkers pages are decoded at once by a thread pool.
     Additional parameters are passsed to the page asarray function.
 
     """
@@ -3431,7 +3599,8 @@ def stack_pages(pages, memmap=False, *args, **kwargs):
         raise ValueError("no pages")
 
     if len(pages) == 1:
-        return pages[0].asarray(memmap=memmap, *args, **kwargs)
+        return pages[0].asarray(memmap=memmap, maxworkers=maxworkers,
+                                *args, **kwargs)
 
     result = pages[0].asarray(*args, **kwargs)
     shape = (len(pages),) + result.shape
@@ -3441,12 +3610,32 @@ def stack_pages(pages, memmap=False, *args, **kwargs):
     else:
         result = numpy.empty(shape, dtype=result.dtype)
 
-    for i, page in enumerate(pages):
-        result[i] = page.asarray(*args, **kwargs)
+    def read_page(i):
+        result[i] = pages[i].asarray(*args, **kwargs)
+
+    if maxworkers > 1:
+        thread_map(read_page, range(len(pages)), maxworkers)
+    else:
+        for i in range(len(pages)):
+            read_page(i)
 
     return result
 
 
+def thread_map(func, iterable, maxworkers):
+    """Return the list of func applied to iterable by maxworkers threads.
+
+    The pool is created for each call: a pool kept at module level does
+    not survive a fork, and maps in the child processes hang.
+
+    """
+    pool = ThreadPool(maxworkers)
+    try:
+        return pool.map(func, iterable)
+    finally:
+        pool.terminate()
+
+
 def stripnull(string):
     """Return string truncated at first null character.
 
@@ -11,6 +11,12 @@ from __future__ import print_function
 import os
 import re
 import logging
+import threading
+
+try:
+    import queue  # py3k
+except ImportError:
+    import Queue as queue
 
 log = logging.getLogger(__name__)
 
@@ -43,6 +49,82 @@ def load_img_list(directory):
     return img_list
 
 
+def prefetch_iterator(iterable, depth=1):
+    """Iterates over `iterable` while its next `depth` items are read in a
+    background thread.
+
+    Reading files releases the GIL, so that the items are read while the
+    current one is processed. At most `depth` items are waiting in memory
+    besides the one being read and the one being processed.
+
+    Parameters
+    ----------
+    iterable : iterable
+    depth : int
+        Number of items read ahead. With `depth=0`, `iterable` is read
+        in the calling thread.
+
+    Returns
+    -------
+    A Python generator over the items of `iterable`.
+
+    Notes
+    -----
+    Exceptions raised while reading are raised again by the generator. If
+    the generator is closed early, reading stops and `iterable` is closed
+    if it has a `close` method (as generators do).
+    """
+    if depth < 1:
+        for item in iterable:
+            yield item
+        return
+
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    iterator = iter(iterable)
+
+    def put(item):
+        # Gives up when the consumer is gone
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read():
+        try:
+            for item in iterator:
+                if not put((True, item)):
+                    return
+        except Exception as exception:
+            put((False, exception))
+            return
+        finally:
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+        put((False, None))
+
+    reader = threading.Thread(target=read, name='sktracker-prefetch')
+    reader.daemon = True
+    reader.start()
+
+    try:
+        while True:
+            success, item = items.get()
+            if success:
+                yield item
+            elif item is None:
+                break
+            else:
+                raise item
+    finally:
+        stop.set()
+        reader.join()
+
+
 def _looks_like_tif(fname):
     return any([fname.endswith(ext) for ext in _EXTENSIONS])
 
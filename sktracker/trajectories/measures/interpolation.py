@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+import multiprocessing
+
+import numpy as np
+from scipy.interpolate import splev, splrep
+
+import logging
+log = logging.getLogger(__name__)
+
+__all__ = ["interpolate_segments"]
+
+# Segments longer than this are fitted one by one with FITPACK
+# (the batched solver builds dense (length x length) collocation matrices).
+BATCH_MAX_LENGTH = 64
+
+
+def interpolate_segments(segments, times, values, sampling=1, s=0, k=3,
+                         parallel=False):
+    """Spline interpolation of all the segments of a trajectories set.
+
+    Segments are grouped by number of points and spline order. For the
+    interpolating case (`s == 0`), the splines of a whole group are
+    computed at once by solving the stacked collocation systems, with the
+    same knots as `scipy.interpolate.splrep`. Long segments and smoothing
+    splines (`s > 0`) go through `splrep` / `splev`, possibly in a
+    process pool.
+
+    Parameters
+    ----------
+    segments : :class:`sktracker.trajectories.measures.segments.Segments`
+    times : 1D array
+        Time of each row, in label sorted order.
+    values : 2D array
+        Coordinates to interpolate, in label sorted order (one column per coordinate).
+    sampling : int
+    s : float
+    k : int
+    parallel : bool
+        Fit the segments that can't be batched in a process pool.
+
+    Returns
+    -------
+    out_segment_ids : 1D int array
+        Segment of each output row
+    out_t_stamps : 1D int array
+    out_times : 1D array
+    results : dict of 2D arrays
+        Keys are the derivative order (0, 1 and 2 if `k` > 2), each
+        array has one column per coordinate.
+    """
+
+    n_coords = values.shape[1]
+    starts = segments.starts
+    lengths = segments.lengths
+    t_stamps = segments.t_stamps
+
+    # Output rows: from t_stamp0 * sampling to t_stamp1 * sampling, included
+    t_stamp0 = t_stamps[starts]
+    t_stamp1 = t_stamps[starts + lengths - 1]
+    out_lengths = (t_stamp1 - t_stamp0) * sampling + 1
+    out_starts = np.zeros_like(out_lengths)
+    out_starts[1:] = np.cumsum(out_lengths)[:-1]
+    n_out = out_lengths.sum()
+
+    out_segment_ids = np.repeat(np.arange(len(segments)), out_lengths)
+    out_ranks = np.arange(n_out) - out_starts[out_segment_ids]
+    out_t_stamps = (t_stamp0 * sampling)[out_segment_ids] + out_ranks
+
+    t0 = times[starts]
+    t1 = times[starts + lengths - 1]
+    step = np.zeros(len(segments))
+    many = out_lengths > 1
+    step[many] = (t1 - t0)[many] / (out_lengths[many] - 1)
+    out_times = t0[out_segment_ids] + out_ranks * step[out_segment_ids]
+    # Same end point as np.linspace
+    out_times[(out_starts + out_lengths - 1)[many]] = t1[many]
+
+    ders = [0, 1, 2] if k > 2 else [0, 1]
+    results = {}
+    for der in ders:
+        results[der] = np.empty((n_out, n_coords))
+        results[der].fill(np.nan)
+
+    corrected_ks = np.ones_like(lengths) * k
+    too_short = lengths <= corrected_ks
+    while too_short.any():
+        corrected_ks[too_short] -= 2
+        too_short = lengths <= corrected_ks
+
+    # Segments with only one point are returned as is
+    singles = np.flatnonzero(lengths < 2)
+    results[0][out_starts[singles]] = values[starts[singles]]
+
+    batchable = (lengths >= 2) & (corrected_ks >= 1)
+    if s == 0:
+        batchable &= lengths <= BATCH_MAX_LENGTH
+    else:
+        batchable[:] = False
+
+    # Batched path, one group per (length, order, output length)
+    keys = np.vstack([lengths, corrected_ks, out_lengths])[:, batchable]
+    batch_ids = np.flatnonzero(batchable)
+    if batch_ids.size:
+        groups, inverse = _unique_columns(keys)
+        for n_group in range(groups.shape[1]):
+            group = batch_ids[inverse == n_group]
+            m, group_k, n_points = groups[:, n_group]
+            rows = starts[group][:, np.newaxis] + np.arange(m)
+            out_rows = out_starts[group][:, np.newaxis] + np.arange(n_points)
+            interp = _batch_interpolate(times[rows], values[rows],
+                                        out_times[out_rows], group_k,
+                                        ders=[der for der in ders
+                                              if _has_derivative(der, group_k)])
+            for der, res in interp.items():
+                results[der][out_rows] = res
+
+    # One segment at a time
+    single_ids = np.flatnonzero((lengths >= 2) & ~batchable)
+    if single_ids.size:
+        arguments = []
+        for n in single_ids:
+            rows = slice(starts[n], starts[n] + lengths[n])
+            out_rows = slice(out_starts[n], out_starts[n] + out_lengths[n])
+            arguments.append((times[rows], values[rows], out_times[out_rows],
+                              s, corrected_ks[n], k))
+        if parallel and len(arguments) > 1:
+            pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
+            try:
+                fitted = pool.map(_fit_segment, arguments)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            fitted = map(_fit_segment, arguments)
+        for n, interp in zip(single_ids, fitted):
+            out_rows = slice(out_starts[n], out_starts[n] + out_lengths[n])
+            for der, res in interp.items():
+                results[der][out_rows] = res
+
+    return out_segment_ids, out_t_stamps, out_times, results
+
+
+def _fit_segment(args):
+    """Fits and evaluates one segment with FITPACK.
+    """
+    time, values, new_times, s, corrected_k, k = args
+    interp = {}
+    for der in ([0, 1, 2] if k > 2 else [0, 1]):
+        interp[der] = np.empty((new_times.size, values.shape[1]))
+        interp[der].fill(np.nan)
+    for n_coord in range(values.shape[1]):
+        tck = splrep(time, values[:, n_coord], s=s, k=corrected_k)
+        for der in interp.keys():
+            if _has_derivative(der, corrected_k):
+                interp[der][:, n_coord] = splev(new_times, tck, der=der)
+    return interp
+
+
+def _has_derivative(der, k):
+    """Accelerations are only computed for splines of order higher than 2.
+    """
+    return der < 2 or k > 2
+
+
+def _unique_columns(keys):
+    """Returns the unique columns of the 2D int array `keys`
+    and the group number of each column.
+    """
+    order = np.lexsort(keys[::-1])
+    sorted_keys = keys[:, order]
+    is_new = np.ones(order.size, dtype=bool)
+    is_new[1:] = np.any(sorted_keys[:, 1:] != sorted_keys[:, :-1], axis=0)
+    groups = sorted_keys[:, is_new]
+    inverse = np.empty(order.size, dtype=np.int64)
+    inverse[order] = np.cumsum(is_new) - 1
+    return groups, inverse
+
+
+def _interp_knots(x, k):
+    """Knots chosen by FITPACK for an interpolating spline (`s = 0`)
+    of order `k` through the points of each row of `x`.
+    """
+    n_batch, m = x.shape
+    if k % 2:
+        inner = x[:, (k + 1) // 2: m - (k + 1) // 2]
+    else:
+        mid = (x[:, 1:] + x[:, :-1]) / 2.
+        inner = mid[:, k // 2: m - 1 - k // 2]
+    first = np.repeat(x[:, :1], k + 1, axis=1)
+    last = np.repeat(x[:, -1:], k + 1, axis=1)
+    return np.hstack([first, inner, last])
+
+
+def _bspline_basis(knots, x, k):
+    """Values of the `k` order B-spline basis functions defined by
+    the knots of each row of `knots` at the points of the same row of `x`.
+
+    Returns a (n_batch, n_points, n_coefs) array.
+    """
+    n_batch, n_points = x.shape
+    n_coefs = knots.shape[1] - k - 1
+    batch = np.arange(n_batch)[:, np.newaxis]
+
+    # Knot interval containing each point, in [k, n_coefs - 1]
+    interval = (knots[:, np.newaxis, :] <= x[:, :, np.newaxis]).sum(axis=-1) - 1
+    interval = np.clip(interval, k, n_coefs - 1)
+
+    # de Boor - Cox recursion on the k + 1 non zero functions
+    basis = np.zeros((k + 1, n_batch, n_points))
+    basis[0] = 1.
+    left = np.empty((k + 1, n_batch, n_points))
+    right = np.empty((k + 1, n_batch, n_points))
+    for j in range(1, k + 1):
+        left[j] = x - knots[batch, interval + 1 - j]
+        right[j] = knots[batch, interval + j] - x
+        saved = np.zeros((n_batch, n_points))
+        for r in range(j):
+            temp = basis[r] / (right[r + 1] + left[j - r])
+            basis[r] = saved + right[r + 1] * temp
+            saved = left[j - r] * temp
+        basis[j] = saved
+
+    full = np.zeros((n_batch, n_points, n_coefs))
+    point = np.arange(n_points)[np.newaxis, :]
+    for r in range(k + 1):
+        full[batch, point, interval - k + r] = basis[r]
+    return full
+
+
+def _batch_interpolate(x, y, new_x, k, ders=(0, 1)):
+    """Interpolating splines through the rows of `x`, `y`
+    evaluated at the rows of `new_x`.
+
+    Parameters
+    ----------
+    x : (n_batch, m) array
+    y : (n_batch, m, n_coords) array
+    new_x : (n_batch, n_points) array
+    k : int
+    ders : sequence of int
+        Derivative orders to evaluate
+
+    Returns
+    -------
+    dict of (n_batch, n_points, n_coords) arrays, keyed by derivative order.
+    """
+    knots = _interp_knots(x, k)
+    collocation = _bspline_basis(knots, x, k)
+    coefs = np.linalg.solve(collocation, y)
+
+    interp = {}
+    for der in range(max(ders) + 1):
+        if der in ders:
+            basis = _bspline_basis(knots, new_x, k)
+            interp[der] = np.einsum('bpc,bcd->bpd', basis, coefs)
+        if der == max(ders):
+            break
+        # Coefficients of the derivative spline
+        span = (knots[:, k + 1: k + coefs.shape[1]] -
+                knots[:, 1: coefs.shape[1]])[..., np.newaxis]
+        coefs = k * (coefs[:, 1:] - coefs[:, :-1]) / span
+        knots = knots[:, 1:-1]
+        k -= 1
+    return interp
@@ -5,37 +5,358 @@ from __future__ import division
 from __future__ import absolute_import
 from __future__ import print_function
 
-import pandas as pd
+import hashlib
+import inspect
+from collections import OrderedDict
+from contextlib import contextmanager
 from functools import wraps
 
+import numpy as np
+import pandas as pd
+
+import logging
+log = logging.getLogger(__name__)
+
+__all__ = ["trajs_measure", "p2p_measure", "MEASURES", "MeasureCache",
+           "compute_measure", "compute_measures", "measure_dependencies",
+           "required_measure", "cached_call", "clear_cache"]
+
+
+# Registered measures, by name. Each entry is a dict with keys
+# 'function' (the decorated measure), 'kind' ('trajs' or 'p2p'),
+# 'requires' (names of the measures it uses) and 'parameters'
+# (names of its arguments).
+MEASURES = {}
+
+
+class MeasureCache(object):
+    """Least recently used store of measure results.
+
+    Results are keyed on the measure name, a fingerprint of the data
+    it was computed from and the values of its parameters, so that a
+    result is never reused once the data changed.
+
+    Parameters
+    ----------
+    max_size : int
+        Maximum number of stored results
+    max_bytes : int
+        Maximum memory used by the stored results, larger results are
+        not stored
 
-def trajs_measure(method, *args, **kwargs):
     """
+
+    def __init__(self, max_size=128, max_bytes=2**27):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self._results = OrderedDict()
+        self._nbytes = 0
+        self._sessions = 0
+        self._fingerprints = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._results)
+
+    @property
+    def nbytes(self):
+        """Memory used by the stored results
+        """
+        return self._nbytes
+
+    @contextmanager
+    def session(self):
+        """Context in which the data passed to the measures is not
+        modified, so that each object is fingerprinted only once.
+        """
+        self._sessions += 1
+        try:
+            yield self
+        finally:
+            self._sessions -= 1
+            if not self._sessions:
+                self._fingerprints.clear()
+
+    def fingerprint(self, data):
+        """Returns `data_fingerprint(data)`, computed once per object
+        within a session.
+        """
+        if not self._sessions:
+            return data_fingerprint(data)
+        # The object is kept so that its id is not reused
+        if id(data) not in self._fingerprints:
+            self._fingerprints[id(data)] = (data, data_fingerprint(data))
+        return self._fingerprints[id(data)][1]
+
+    def key(self, function, trajs, args=(), kwargs={}):
+        """Returns the cache key of `function(trajs, *args, **kwargs)`,
+        or None if the parameters can't be hashed.
+        """
+        callargs = inspect.getcallargs(function, trajs, *args, **kwargs)
+        params = dict((arg, value) for arg, value in callargs.items()
+                      if value is not trajs)
+        try:
+            params = _freeze(params)
+            hash(params)
+        except TypeError:
+            return None
+        name = '{}.{}'.format(function.__module__, function.__name__)
+        return (name, self.fingerprint(trajs), params)
+
+    def get(self, key):
+        """Returns the result stored under `key`, or None.
+        """
+        if key is None:
+            return None
+        try:
+            entry = self._results.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self._results[key] = entry
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key, result):
+        if key is None:
+            return
+        self._remove(key)
+        nbytes = _nbytes(result)
+        if nbytes > self.max_bytes:
+            return
+        self._results[key] = (result, nbytes)
+        self._nbytes += nbytes
+        while (len(self._results) > self.max_size or
+               self._nbytes > self.max_bytes):
+            self._remove(next(iter(self._results)))
+
+    def _remove(self, key):
+        if key in self._results:
+            result, nbytes = self._results.pop(key)
+            self._nbytes -= nbytes
+
+    def clear(self):
+        self._results.clear()
+        self._nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+
+_cache = MeasureCache()
+
+
+def clear_cache():
+    """Empties the measures cache.
     """
-    @wraps(method)
-    def new_method(*args, **kwargs):
-        trajs = args[0]
-        measure_ = method(*args, **kwargs).sortlevel(['t_stamp', 'label'])
+    _cache.clear()
+
+
+def data_fingerprint(trajs):
+    """SHA1 digest of the index, columns and values of a DataFrame
+    """
+    sha = hashlib.sha1()
+    for name, values in ([(name, trajs.index.get_level_values(level))
+                          for level, name in enumerate(trajs.index.names)] +
+                         [(name, trajs[name]) for name in trajs.columns]):
+        sha.update(repr(name).encode('utf-8'))
+        values = np.asarray(values)
+        if values.dtype.hasobject:
+            sha.update(repr(values.tolist()).encode('utf-8'))
+        else:
+            sha.update(values.dtype.str.encode('utf-8'))
+            sha.update(np.ascontiguousarray(values).view(np.uint8))
+    return sha.hexdigest()
+
+
+def _nbytes(result):
+    """Approximate memory used by the values and index of a DataFrame
+    or a Series
+    """
+    index = result.index
+    return (np.asarray(result.values).nbytes +
+            sum(np.asarray(index.get_level_values(level)).nbytes
+                for level in range(index.nlevels)))
+
+
+def _freeze(value):
+    """Hashable version of a parameter value
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(val)) for key, val in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(val) for val in value)
+    if isinstance(value, np.ndarray):
+        return (value.shape, value.dtype.str,
+                hashlib.sha1(np.ascontiguousarray(value).view(np.uint8)).hexdigest())
+    return value
+
+
+def cached_call(function, trajs, *args, **kwargs):
+    """Calls `function(trajs, *args, **kwargs)` through the measures cache.
+
+    Calls with `append=True` modify `trajs` and are never cached.
+
+    The cache key holds a SHA1 digest of all the values of `trajs`, which
+    each call computes again. Within `compute_measures` it is computed
+    once for all the measures.
+    """
+    if kwargs.get('append'):
+        return function(trajs, *args, **kwargs)
+    key = _cache.key(function, trajs, args, kwargs)
+    result = _cache.get(key)
+    if result is None:
+        result = function(trajs, *args, **kwargs)
+        _cache.set(key, result)
+    return result.copy()
+
+
+def _register(method, new_method, kind, requires):
+    try:
+        argspec = inspect.getfullargspec(method)
+    except AttributeError:  # Python 2
+        argspec = inspect.getargspec(method)
+    MEASURES[method.__name__] = {'function': new_method,
+                                 'kind': kind,
+                                 'requires': list(requires),
+                                 'parameters': argspec.args[1:]}
+
+
+def trajs_measure(method=None, requires=()):
+    """Decorator for measures returning one value per trajectories point.
+
+    The decorated function returns a DataFrame with the measure (named
+    after the function) and the 't' column. Results are memoized and the
+    measure is registered in `MEASURES`.
+
+    Can be used as `@trajs_measure` or `@trajs_measure(requires=[...])`,
+    `requires` listing the names of the measures used by this one.
+    """
+    if method is None:
+        return lambda method: trajs_measure(method, requires=requires)
+
+    def format_measure(trajs, measure_):
+        measure_ = measure_.sortlevel(['t_stamp', 'label'])
         measure = pd.DataFrame.from_dict({method.__name__: measure_.values.ravel(),
                                           't': trajs.t})
-        measure.set_index(trajs.index)
         return measure.sortlevel(['t_stamp', 'label'])
 
-    return new_method
+    return _memoized(method, format_measure, 'trajs', requires)
 
 
-def p2p_measure(method, *args, **kwargs):
-    '''
+def p2p_measure(method=None, requires=()):
+    """Decorator for measures returning one value per segment,
+    see `trajs_measure`.
+    """
+    if method is None:
+        return lambda method: p2p_measure(method, requires=requires)
 
-    '''
-    @wraps(method)
-    def new_method(*args, **kwargs):
-        measure = method(*args, **kwargs)
+    def format_measure(trajs, measure):
         measure.name = method.__name__
         return measure
+
+    return _memoized(method, format_measure, 'p2p', requires)
+
+
+def _memoized(method, format_measure, kind, requires):
+
+    @wraps(method)
+    def new_method(*args, **kwargs):
+        trajs = args[0]
+        key = _cache.key(method, trajs, args[1:], kwargs)
+        measure = _cache.get(key)
+        if measure is None:
+            measure = format_measure(trajs, method(*args, **kwargs))
+            _cache.set(key, measure)
+        return measure.copy()
+
+    _register(method, new_method, kind, requires)
     return new_method
 
 
+def _get_measure(name):
+    if name not in MEASURES:
+        # Registration happens when the measures modules are imported
+        from . import translation, rotation
+    try:
+        return MEASURES[name]
+    except KeyError:
+        raise ValueError('Unknown measure {}'.format(name))
+
+
+def measure_dependencies(name):
+    """Names of all the measures needed to compute measure `name`,
+    dependencies first.
+    """
+    dependencies = []
+    for required in _get_measure(name)['requires']:
+        for dependency in measure_dependencies(required) + [required]:
+            if dependency not in dependencies:
+                dependencies.append(dependency)
+    return dependencies
+
+
+def compute_measure(trajs, name, **params):
+    """Computes the registered measure `name` over `trajs`.
+
+    The result, as the ones of the measures it depends on, is stored
+    in the measures cache.
+    """
+    measure = _get_measure(name)
+    return measure['function'](trajs, **params)
+
+
+def compute_measures(trajs, measures):
+    """Computes several registered measures over `trajs`, sharing
+    their common dependencies.
+
+    The dependencies of each measure (see `measure_dependencies`) are
+    computed first, with the parameters of the measure they accept.
+    `trajs` is fingerprinted once and must not be modified meanwhile.
+
+    Parameters
+    ----------
+    trajs : :class:`sktracker.trajectories.Trajectories`
+    measures : dict or list
+        Either a dict of parameters dicts keyed by measure name, or a list of
+        measure names or `(name, params)` tuples.
+
+    Returns
+    -------
+    results : OrderedDict
+        Measures results, by measure name
+    """
+    if isinstance(measures, dict):
+        measures = list(measures.items())
+    results = OrderedDict()
+    with _cache.session():
+        for measure in measures:
+            if isinstance(measure, (tuple, list)):
+                name, params = measure
+            else:
+                name, params = measure, {}
+            for dependency in measure_dependencies(name):
+                # Existing columns are used as is, see `required_measure`
+                if dependency in trajs.columns:
+                    continue
+                accepted = _get_measure(dependency)['parameters']
+                compute_measure(trajs, dependency,
+                                **dict((param, value) for param, value in params.items()
+                                       if param in accepted))
+            results[name] = compute_measure(trajs, name, **params)
+    return results
+
+
+def required_measure(trajs, name, **params):
+    """Returns the column `name` of `trajs` if it exists, or computes the
+    (memoized) measure `name` with `params`, aligned on `trajs` rows.
+    """
+    if name in trajs.columns:
+        return trajs[name]
+    measure = compute_measure(trajs, name, **params)
+    return measure[name].reindex(trajs.index)
+
+
 def segment_measure(method, *args, **kwargs):
     '''
     '''
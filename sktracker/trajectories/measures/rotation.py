@@ -10,29 +10,31 @@ import pandas as pd
 from ..trajectories import Trajectories
 
 from .measure_decorators import trajs_measure
+from .measure_decorators import cached_call
+from .segments import Segments
 
 import logging
 log = logging.getLogger(__name__)
 
 
-def dir_shift_(segment, shift=1, coords=['v_x', 'v_y', 'v_z']):
-
-    cross = np.cross(segment[coords].shift(-shift//2),
-                     segment[coords].shift(shift//2+1), axis=-1)
-    norm = np.linalg.norm(segment[coords].shift(shift//2+1), axis=1)
-    norm_s = np.linalg.norm(segment[coords].shift(-shift//2), axis=1)
-    #data = np.linalg.norm(cross, axis=1) / (norm * norm_s)
-    data = cross[:, -1] / (norm * norm_s)
-    df = pd.DataFrame(np.arcsin(data), index=segment.index)
-    return df
-
-
 @trajs_measure
 def dir_shift(trajs, shift=1, coords=['v_x', 'v_y', 'v_z']):
+    """Angle between the vectors given by `coords` (by default the speeds)
+    `(shift + 1) // 2` points after and `shift // 2 + 1` points before each
+    point of a segment.
     """
-    """
-    gp = trajs.groupby(level=['label'], group_keys=False)
-    return gp.apply(dir_shift_, shift=shift, coords=coords)
+    segments = Segments(trajs)
+    values = segments.take(trajs, coords)
+    after = segments.shift(values, -shift//2)
+    before = segments.shift(values, shift//2+1)
+    cross = np.cross(after, before, axis=-1)
+    if cross.ndim > 1:
+        cross = cross[:, -1]
+    norm = np.linalg.norm(before, axis=1)
+    norm_s = np.linalg.norm(after, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        data = np.arcsin(cross / (norm * norm_s))
+    return pd.Series(segments.restore(data), index=trajs.index)
 
 
 # Trajectories pseudo methods
@@ -44,18 +46,20 @@ def radial_speed(trajs, in_coords=['rho', 'theta'],
                  out_coords=['v_rad', 'v_orad', 'v_theta']):
     """
     """
+    # Polar coordinates and their interpolation are memoized
     if not from_polar:
-        polar = get_polar_coords(trajs, get_dtheta=False,
-                                 in_coords=in_coords,
-                                 out_coords=['rho', 'theta'],
-                                 periodic=False, append=False)
+        polar = cached_call(get_polar_coords, trajs, get_dtheta=False,
+                            in_coords=in_coords,
+                            out_coords=['rho', 'theta'],
+                            periodic=False, append=False)
         in_coords = ['rho', 'theta']
     else:
         polar = trajs[in_coords].copy()
 
     polar = Trajectories(polar)
     polar['t'] = trajs['t']
-    intp_polar = polar.time_interpolate(coords=['rho', 'theta'], s=smooth, k=3)
+    intp_polar = cached_call(Trajectories.time_interpolate, polar,
+                             coords=['rho', 'theta'], s=smooth, k=3)
     radial_speed_c, ortho_rad_speed_c, angular_speed_c = out_coords
     radial_speed = intp_polar['v_rho']
     ortho_rad_speed = intp_polar['rho'] * intp_polar['v_theta']
@@ -113,13 +117,10 @@ def get_polar_coords(trajs, get_dtheta=False,
                                           rho_coord: rhos})
     polar_trajs.set_index(trajs.index, inplace=True)
     polar_trajs['t'] = trajs.t
-    if not periodic:
-        polar_trajs = polar_trajs.groupby(level='label').apply(continuous_theta_,
-                                                               theta_coord, get_dtheta)
-    elif get_dtheta:
-        polar_trajs = polar_trajs.groupby(
-            level='label').apply(periodic_dtheta_,
-                                 theta_coord)
+    if not periodic or get_dtheta:
+        segments = Segments(polar_trajs)
+        _segments_theta(polar_trajs, segments, theta_coord,
+                        continuous=not periodic, get_dtheta=get_dtheta)
     polar_trajs = polar_trajs.sortlevel(['t_stamp', 'label'])
     if append:
         for coord in polar_trajs.columns:
@@ -146,40 +147,35 @@ def get_spherical_coords(trajs, get_dtheta=False,
                                               phi: phis})
 
     if not periodic:
-        spherical_trajs = spherical_trajs.groupby(
-            level='label').apply(continuous_theta_,
-                                 theta, get_dtheta=get_dtheta)
-        spherical_trajs = spherical_trajs.groupby(
-            level='label').apply(continuous_theta_,
-                                 phi, get_dtheta=get_dtheta)
+        segments = Segments(spherical_trajs)
+        for coord in (theta, phi):
+            _segments_theta(spherical_trajs, segments, coord,
+                            get_dtheta=get_dtheta)
 
     return spherical_trajs.sortlevel(['t_stamp', 'label'])
 
-# Segment method
+# Label sorted array methods, see `Segments`
 
 
-def continuous_theta_(segment, coord='theta', get_dtheta=True):
-    """
+def _segments_theta(trajs, segments, coord='theta',
+                    continuous=True, get_dtheta=True):
+    """Makes the angles of column `coord` continuous for each segment
+    and/or adds the periodic boundary corrected difference between
+    two successive points as the 'd' + `coord` column (0 for the first
+    point of each segment). `trajs` is modified in place.
     """
-
-    out = _continuous_theta(segment[coord].values,
-                            return_dtheta=get_dtheta)
+    thetas = segments.take(trajs, coord)
+    dthetas = segments.diff(thetas)
+    dthetas[dthetas > np.pi] -= 2 * np.pi
+    dthetas[dthetas < - np.pi] += 2 * np.pi
+    dthetas[segments.is_start] = 0
     if get_dtheta:
-        thetas, dthetas_ = out
-        dthetas = np.zeros_like(thetas)
-        dthetas[1:] = dthetas_
-        segment['d'+coord] = dthetas
-        segment[coord] = thetas
-    else:
-        segment[coord] = out
-    return segment
-
+        trajs['d'+coord] = segments.restore(dthetas)
+    if continuous:
+        thetas = (thetas[segments.starts][segments.segment_ids]
+                  + segments.cumsum(dthetas))
+        trajs[coord] = segments.restore(thetas)
 
-def periodic_dtheta_(segment, coord='theta'):
-    dtheta_ = np.zeros_like(segment[coord].values).ravel()
-    dtheta_[1:] = _periodic_dtheta(segment[coord].values)
-    segment['d'+coord] = dtheta_
-    return segment
 
 # Array methods
 
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+import numpy as np
+
+import logging
+log = logging.getLogger(__name__)
+
+__all__ = ["Segments"]
+
+
+class Segments(object):
+    """Label sorted view over the rows of trajectories.
+
+    Rows are sorted by `label` then by `t_stamp`, so that each segment
+    occupies a contiguous slice of the sorted arrays. Segment-wise
+    operations (shifts, differences, cumulative sums) are then computed
+    in one pass over the whole dataset instead of one `groupby.apply`
+    call per segment.
+
+    Parameters
+    ----------
+    trajs : :class:`pandas.DataFrame`
+        Indexed by `(t_stamp, label)`.
+
+    Attributes
+    ----------
+    order : ndarray
+        Positions of the rows of `trajs` once sorted by label and t_stamp.
+    labels : ndarray
+        Label of each sorted row.
+    t_stamps : ndarray
+        t_stamp of each sorted row.
+    unique_labels : ndarray
+        Label of each segment.
+    starts : ndarray
+        Position of the first row of each segment in the sorted arrays.
+    lengths : ndarray
+        Number of rows of each segment.
+    segment_ids : ndarray
+        Segment number of each sorted row.
+    ranks : ndarray
+        Position of each sorted row in its own segment.
+
+    Examples
+    --------
+    >>> from sktracker import data
+    >>> from sktracker.trajectories import Trajectories
+    >>> from sktracker.trajectories.measures.segments import Segments
+    >>> trajs = Trajectories(data.brownian_trajs_df())
+    >>> segments = Segments(trajs)
+    >>> x = segments.take(trajs, 'x')
+    >>> dx = x - segments.shift(x, 1)
+
+    """
+
+    def __init__(self, trajs):
+
+        labels = np.asarray(trajs.index.get_level_values('label'))
+        t_stamps = np.asarray(trajs.index.get_level_values('t_stamp'))
+
+        self.order = np.lexsort((t_stamps, labels))
+        self.labels = labels[self.order]
+        self.t_stamps = t_stamps[self.order]
+
+        is_start = np.ones(self.labels.size, dtype=bool)
+        is_start[1:] = self.labels[1:] != self.labels[:-1]
+        self.is_start = is_start
+
+        self.starts = np.flatnonzero(is_start)
+        self.lengths = np.diff(np.append(self.starts, self.labels.size))
+        self.unique_labels = self.labels[self.starts]
+        self.segment_ids = np.cumsum(is_start) - 1
+        self.ranks = np.arange(self.labels.size) - self.starts[self.segment_ids]
+
+    def __len__(self):
+        """Number of segments."""
+        return self.starts.size
+
+    @property
+    def size(self):
+        """Number of rows."""
+        return self.labels.size
+
+    @property
+    def stops(self):
+        """Position following the last row of each segment."""
+        return self.starts + self.lengths
+
+    def take(self, trajs, coords):
+        """Returns the values of `coords` in label sorted order, as floats.
+
+        Parameters
+        ----------
+        trajs : :class:`pandas.DataFrame`
+            The trajectories used to build this instance
+        coords : str or list of str
+            A single column name gives a 1D array, a list gives a 2D
+            array with one column per coordinate.
+        """
+        return np.asarray(trajs[coords].values, dtype=np.float64)[self.order]
+
+    def restore(self, values):
+        """Puts back label sorted `values` in the row order of the original
+        trajectories.
+        """
+        values = np.asarray(values)
+        restored = np.empty_like(values)
+        restored[self.order] = values
+        return restored
+
+    def shift(self, values, periods=1):
+        """Segment-wise equivalent of :meth:`pandas.DataFrame.shift`:
+        sorted row `i` receives the value of row `i - periods` of the same
+        segment, or NaN if there is no such row.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        shifted = np.empty_like(values)
+        shifted.fill(np.nan)
+        src_ranks = self.ranks - periods
+        valid = (src_ranks >= 0) & (src_ranks < self.lengths[self.segment_ids])
+        dest = np.flatnonzero(valid)
+        shifted[dest] = values[dest - periods]
+        return shifted
+
+    def diff(self, values, periods=1):
+        """Segment-wise equivalent of :meth:`pandas.DataFrame.diff`
+        """
+        return values - self.shift(values, periods)
+
+    def cumsum(self, values):
+        """Segment-wise cumulative sum, skipping NaNs like
+        :meth:`pandas.Series.cumsum` does.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        is_nan = np.isnan(values)
+        filled = np.where(is_nan, 0, values)
+        total = filled.cumsum(axis=0)
+        # Cumulated value before the start of each segment
+        offsets = total[self.starts] - filled[self.starts]
+        cumulated = total - offsets[self.segment_ids]
+        cumulated[is_nan] = np.nan
+        return cumulated
+
+    def at_t_stamp(self, values, t_stamp):
+        """Returns, for each segment, the value of `values` at `t_stamp`,
+        or NaN if the segment does not contain this time stamp.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        out = np.empty((len(self),) + values.shape[1:])
+        out.fill(np.nan)
+        rows = np.flatnonzero(self.t_stamps == t_stamp)
+        out[self.segment_ids[rows]] = values[rows]
+        return out
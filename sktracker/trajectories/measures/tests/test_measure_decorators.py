@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+import pandas as pd
+from numpy.testing import assert_array_almost_equal
+
+from sktracker.trajectories import Trajectories
+from sktracker.trajectories.measures import measure_decorators
+from sktracker.trajectories.measures import translation
+from sktracker import data
+
+
+def test_registry():
+    assert 'cum_disp' in measure_decorators.MEASURES
+    assert measure_decorators.MEASURES['p2p_cum_dir']['kind'] == 'p2p'
+    assert measure_decorators.measure_dependencies('sld_cum_dir') == ['cum_disp']
+    assert measure_decorators.measure_dependencies('cum_disp') == []
+
+
+def test_compute_measures():
+    trajs = Trajectories(data.brownian_trajs_df())
+    columns = list(trajs.columns)
+    measure_decorators.clear_cache()
+    cache = measure_decorators._cache
+
+    fingerprinted = []
+    data_fingerprint = measure_decorators.data_fingerprint
+
+    def counted_fingerprint(data):
+        fingerprinted.append(data)
+        return data_fingerprint(data)
+
+    measure_decorators.data_fingerprint = counted_fingerprint
+    try:
+        results = measure_decorators.compute_measures(trajs,
+                                                      [('sld_cum_dir', {'window': 4}),
+                                                       ('sld_processivity', {'window': 4}),
+                                                       'cum_disp'])
+    finally:
+        measure_decorators.data_fingerprint = data_fingerprint
+    # Input is not modified
+    assert list(trajs.columns) == columns
+    # Each measure, cum_disp included, is computed only once
+    assert cache.misses == 3
+    # The data is fingerprinted once
+    assert len(fingerprinted) == 1
+
+    assert_array_almost_equal(results['cum_disp']['cum_disp'],
+                              translation.cum_disp(trajs)['cum_disp'])
+
+
+def test_cache_invalidation():
+    trajs = Trajectories(data.brownian_trajs_df())
+    measure_decorators.clear_cache()
+    first = translation.cum_disp(trajs)
+    expected = first['cum_disp'].values * 2
+    # Returned results are copies of the cached ones
+    first['cum_disp'] = 0
+    for coord in ['x', 'y', 'z']:
+        trajs[coord] *= 2
+    second = translation.cum_disp(trajs)
+    assert measure_decorators._cache.hits == 0
+    assert_array_almost_equal(second['cum_disp'].values, expected)
+    third = translation.cum_disp(trajs)
+    assert measure_decorators._cache.hits == 1
+    assert_array_almost_equal(third['cum_disp'].values, expected)
+
+
+def test_cache_max_bytes():
+    trajs = Trajectories(data.brownian_trajs_df())
+    nbytes = measure_decorators._nbytes(trajs)
+    cache = measure_decorators.MeasureCache(max_bytes=int(2.5 * nbytes))
+
+    for key in range(3):
+        cache.set(key, trajs)
+    # The least recently used result is dropped
+    assert len(cache) == 2
+    assert cache.get(0) is None
+    assert cache.nbytes == 2 * nbytes
+
+    # Too large to be stored
+    cache.set(3, Trajectories(pd.concat([trajs] * 3)))
+    assert len(cache) == 2
+    assert cache.get(3) is None
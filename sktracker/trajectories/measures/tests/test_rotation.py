@@ -56,3 +56,30 @@ def test_continuous_theta_2d():
 
     assert_almost_equal(thetas_out, thetas_th)
     assert_almost_equal(thetas_out2, thetas_th.T)
+
+
+def test_polar_coords_continuous():
+
+    trajs = data.brownian_trajs_df()
+    trajs = Trajectories(trajs)
+    # Circles at 0.5 rad per time stamp
+    angles = trajs.index.get_level_values('t_stamp').values * 0.5
+    trajs['x'] = np.cos(angles)
+    trajs['y'] = np.sin(angles)
+    polar = rotation.get_polar_coords(trajs, get_dtheta=True)
+    for label, segment in polar.groupby(level='label'):
+        assert_array_almost_equal(np.diff(segment.theta.values), 0.5)
+        assert_array_almost_equal(segment.dtheta.values[1:], 0.5)
+        assert segment.dtheta.values[0] == 0
+
+
+def test_dir_shift():
+
+    trajs = data.brownian_trajs_df()
+    trajs = Trajectories(trajs)
+    angles = trajs.index.get_level_values('t_stamp').values * 0.5
+    trajs['v_x'] = np.cos(angles)
+    trajs['v_y'] = np.sin(angles)
+    shifts = rotation.dir_shift(trajs, shift=1, coords=['v_x', 'v_y'])
+    # Angle between the speeds at t - 1 and t + 1
+    assert_array_almost_equal(shifts['dir_shift'].dropna(), -1)
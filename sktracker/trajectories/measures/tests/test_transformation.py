@@ -58,3 +58,18 @@ def test_interp_series():
     inter = interp_series(series, new_index)
 
     assert_array_equal(inter.values, np.array([5, 15, 25, 35, 45, 55, 60]))
+
+
+def test_time_interpolate_splrep():
+
+    from scipy.interpolate import splrep, splev
+
+    trajs = Trajectories(data.brownian_trajs_df())
+    interpolated = transformation.time_interpolate(trajs, sampling=2, s=0, k=3)
+
+    segment = trajs.get_segments()[0]
+    tck = splrep(segment.t.values, segment.x.values, s=0, k=3)
+    expected = interpolated.xs(0, level='label')
+    assert_array_almost_equal(expected.x.values, splev(expected.t.values, tck))
+    assert_array_almost_equal(expected.v_x.values, splev(expected.t.values, tck, der=1))
+    assert_array_almost_equal(expected.a_x.values, splev(expected.t.values, tck, der=2))
@@ -30,6 +30,14 @@ def test_cum_disp():
     c_disp = translation.cum_disp(trajs)
     assert np.all(c_disp.cum_disp == trajs.x)
 
+
+def test_cum_disp_2d():
+
+    trajs = linear_trajs()
+    trajs['y'] = trajs.x
+    c_disp = translation.cum_disp(trajs, coords=['x', 'y'])
+    assert_array_almost_equal(c_disp.cum_disp, trajs.x * np.sqrt(2))
+
 def test_p2p_cum_dir():
 
     trajs = linear_trajs()
@@ -75,3 +83,26 @@ def test_get_MSD():
     msd = translation.get_MSD(trajs)
     assert_array_almost_equal(np.sqrt(msd['MSD']), trajs.x)
 
+
+
+def test_get_MSD_gaps():
+    trajs = linear_trajs()
+    # Remove every other time point of the first segment
+    trajs = Trajectories(trajs.drop([(t, 0) for t in range(1, 61, 2)]))
+    for algorithm in ('fft', 'direct'):
+        msd = translation.get_MSD(trajs, algorithm=algorithm)
+        dts = msd.index.get_level_values('Dt_stamp')
+        first = msd.xs(0, level='label')
+        assert_array_almost_equal(np.sqrt(first['MSD'].values[::2]),
+                                  dts.unique()[::2] / 2.)
+        assert np.all(np.isnan(first['MSD'].values[1::2]))
+        assert_array_almost_equal(msd.xs(1, level='label')['Dt'].values,
+                                  dts.unique() * 2.)
+
+
+def test_get_MSD_ensemble():
+    trajs = linear_trajs()
+    msd = translation.get_MSD(trajs, ensemble=True)
+    assert_array_almost_equal(np.sqrt(msd['MSD']), msd.index.values / 2.)
+    msd = translation.get_MSD(trajs, ensemble=True, algorithm='direct')
+    assert_array_almost_equal(msd['MSD_std'].dropna(), 0)
@@ -9,7 +9,9 @@ from __future__ import print_function
 import numpy as np
 import pandas as pd
 from sklearn.decomposition import PCA
-from scipy.interpolate import splev, splrep
+
+from .segments import Segments
+from .interpolation import interpolate_segments
 
 import logging
 log = logging.getLogger(__name__)
@@ -60,7 +62,8 @@ def _grouped_pca(trajs, pca, coords, group_kw):
 
 def time_interpolate(trajs, sampling=1,
                      s=0, k=3,
-                     coords=['x', 'y', 'z']):
+                     coords=['x', 'y', 'z'],
+                     parallel=False):
     """Interpolates each segment of the trajectories along time using `scipy.interpolate.splrep`
 
     Parameters
@@ -87,6 +90,10 @@ def time_interpolate(trajs, sampling=1,
        Even order splines should be avoided especially with small s values.
        1 <= k <= 5
 
+    parallel : bool, default False
+       If True, segments which can't be interpolated in batch (long segments,
+       or all of them when `s` > 0) are fitted in a process pool.
+
     Returns
     -------
     interpolated : a :class:`pandas.Dataframe` instance
@@ -102,60 +109,41 @@ def time_interpolate(trajs, sampling=1,
     - If a segment is too short to be interpolated with the passed order `k`, the order will be
       automatically diminished.
     - Segments with only one point will be returned as is
+    - Segments are not interpolated one by one: see
+      :func:`sktracker.trajectories.measures.interpolation.interpolate_segments`
     """
-    interpolated = trajs.groupby(level='label').apply(_segment_interpolate_,
-                                                      sampling=sampling, s=s, k=k,
-                                                      coords=coords)
-    interpolated = interpolated.swaplevel(
-        't_stamp', 'label').sortlevel(['t_stamp', 'label'])
-    return interpolated
-
-
-def _segment_interpolate_(segment, sampling, s=0, k=3,
-                          coords=['x', 'y', 'z']):
-    """
-    """
-
-    corrected_k = k
-    while segment.shape[0] <= corrected_k:
-        corrected_k -= 2
-
-    t_stamps_in = segment.index.get_level_values('t_stamp').values
-    t_stamp0, t_stamp1 = t_stamps_in[0], t_stamps_in[-1]
-    t0, t1 = segment.t.iloc[0], segment.t.iloc[-1]
-    t_stamps = np.arange(t_stamp0*sampling,
-                         t_stamp1*sampling+1, dtype=np.int)
-    times = np.linspace(t0, t1, t_stamps.size)
-    t_stamps = pd.Index(t_stamps, dtype=np.int, name='t_stamp')
-    tmp_df = pd.DataFrame(index=t_stamps)
-    tmp_df['t'] = times
-    if segment.shape[0] < 2:
-        for coord in coords:
-            tmp_df[coord] = segment[coord].values
-            tmp_df['v_'+coord] = np.nan
-            tmp_df['a_'+coord] = np.nan
-        return tmp_df
-        #pass
-
-    tck = _spline_rep(segment, coords, s=s, k=corrected_k)
-
-    for coord in coords:
-        tmp_df[coord] = splev(times, tck[coord], der=0)
-        tmp_df['v_'+coord] = splev(times, tck[coord], der=1)
-        if k > 2:
-            if corrected_k > 2:
-                tmp_df['a_'+coord] = splev(times, tck[coord], der=2)
+    coords = list(coords)
+    segments = Segments(trajs)
+    times = segments.take(trajs, 't')
+    values = segments.take(trajs, coords)
+
+    out = interpolate_segments(segments, times, values,
+                               sampling=sampling, s=s, k=k,
+                               parallel=parallel)
+    out_segment_ids, out_t_stamps, out_times, results = out
+    out_labels = segments.unique_labels[out_segment_ids]
+
+    columns = ['t']
+    data = {'t': out_times}
+    # Single point segments always come with (empty) accelerations
+    with_acceleration = 2 in results or np.any(segments.lengths < 2)
+    for n_coord, coord in enumerate(coords):
+        columns.extend([coord, 'v_' + coord])
+        data[coord] = results[0][:, n_coord]
+        data['v_' + coord] = results[1][:, n_coord]
+        if with_acceleration:
+            columns.append('a_' + coord)
+            if 2 in results:
+                data['a_' + coord] = results[2][:, n_coord]
             else:
-                tmp_df['a_'+coord] = times * np.nan
-    return tmp_df
+                data['a_' + coord] = out_times * np.nan
 
-
-def _spline_rep(df, coords=('x', 'y', 'z'), s=0, k=3):
-    time = df.t
-    tcks = {}
-    for coord in coords:
-        tcks[coord] = splrep(time, df[coord].values, s=s, k=k)
-    return pd.DataFrame.from_dict(tcks)
+    order = np.lexsort((out_labels, out_t_stamps))
+    index = pd.MultiIndex.from_arrays([out_t_stamps[order], out_labels[order]],
+                                      names=['t_stamp', 'label'])
+    interpolated = pd.DataFrame(dict((col, data[col][order]) for col in columns),
+                                index=index, columns=columns)
+    return interpolated
 
 
 def back_proj_interp(interpolated, orig, sampling):
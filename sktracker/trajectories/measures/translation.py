@@ -10,6 +10,8 @@ import pandas as pd
 
 from .measure_decorators import trajs_measure
 from .measure_decorators import p2p_measure
+from .measure_decorators import required_measure
+from .segments import Segments
 
 import logging
 log = logging.getLogger(__name__)
@@ -23,7 +25,7 @@ def by_segments(trajs, group_keys=False, **kwargs):
 # Point to point methods
 
 
-@p2p_measure
+@p2p_measure(requires=['cum_disp'])
 def p2p_cum_dir(trajs, t_stamp0, t_stamp1,
                 coords=['x', 'y', 'z'],
                 append=False):
@@ -35,12 +37,12 @@ def p2p_cum_dir(trajs, t_stamp0, t_stamp1,
                   coords=['x', 'y', 'z'],
                   append=False)
     '''
-    if not 'cum_disp' in trajs.columns:
-        trajs['cum_disp'] = cum_disp(trajs)['cum_disp']
-    shifted = by_segments(trajs).apply(p2p_dif_, t_stamp0, t_stamp1,
-                                       [coords[0], 'cum_disp'])
-    measure = shifted[coords[0]] / shifted['cum_disp']
-    return measure
+    segments = Segments(trajs)
+    values = _with_cum_disp(trajs, segments, coords, [coords[0]])
+    shifted = _p2p_dif(segments, values, t_stamp0, t_stamp1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        measure = shifted[:, 0] / shifted[:, 1]
+    return pd.Series(measure, index=_labels_index(segments))
 
 
 @p2p_measure
@@ -49,41 +51,34 @@ def p2p_directionality(trajs, t_stamp0, t_stamp1,
     '''Computes the ratio between the displacement along the first coordinate
     and the net displacement between t_stamp0 and t_stamp1
     '''
-    shifted = by_segments(trajs).apply(p2p_dif_, t_stamp0, t_stamp1,
-                                       coords)
-    measure = shifted[coords[0]] / np.linalg.norm(shifted[coords],
-                                                  axis=1)
-    return measure
+    segments = Segments(trajs)
+    shifted = _p2p_dif(segments, segments.take(trajs, coords),
+                       t_stamp0, t_stamp1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        measure = shifted[:, 0] / np.linalg.norm(shifted, axis=1)
+    return pd.Series(measure, index=_labels_index(segments))
 
 
-@p2p_measure
+@p2p_measure(requires=['cum_disp'])
 def p2p_processivity(trajs, t_stamp0, t_stamp1,
                      signed=True,
                      coords=['x', 'y', 'z']):
     '''Computes
     '''
-    if not 'cum_disp' in trajs.columns:
-        trajs['cum_disp'] = cum_disp(trajs, coords)['cum_disp']
-
-    shifted = by_segments(trajs).apply(p2p_dif_, t_stamp0, t_stamp1,
-                                       coords+['cum_disp'])
-
-    if signed:
-        measure = (np.linalg.norm(shifted[coords], axis=1) /
-                   shifted['cum_disp']) * np.sign(shifted[coords[0]])
-    else:
-        measure = (np.linalg.norm(shifted[coords], axis=1) /
-                   shifted['cum_disp'])
-    return measure
+    segments = Segments(trajs)
+    values = _with_cum_disp(trajs, segments, coords, coords)
+    shifted = _p2p_dif(segments, values, t_stamp0, t_stamp1)
+    measure = _processivity(shifted[:, :-1], shifted[:, -1], signed)
+    return pd.Series(measure, index=_labels_index(segments))
 
 
 @trajs_measure
 def cum_disp(trajs, coords=['x', 'y', 'z']):
     '''
     '''
-    measure = by_segments(trajs).apply(cumulative_displacement_,
-                                       coords=coords)
-    return measure
+    segments = Segments(trajs)
+    measure = _cumulative_displacement(segments, segments.take(trajs, coords))
+    return pd.Series(segments.restore(measure), index=trajs.index)
 
 
 ### Sliding methods
@@ -92,119 +87,296 @@ def sld_dir(trajs, window,
             coords=['x', 'y', 'z']):
     '''
     '''
-    shifted = by_segments(trajs).apply(shifted_dif_, window, coords)
-    measure = (shifted[coords[0]] / np.linalg.norm(shifted[coords],
-                                                   axis=1))
-    return measure
+    segments = Segments(trajs)
+    shifted = _shifted_dif(segments, segments.take(trajs, coords), window)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        measure = shifted[:, 0] / np.linalg.norm(shifted, axis=1)
+    return pd.Series(segments.restore(measure), index=trajs.index)
 
 
-@trajs_measure
+@trajs_measure(requires=['cum_disp'])
 def sld_processivity(trajs, window, signed=True,
                      coords=['x', 'y', 'z']):
     '''
     '''
-    if not 'cum_disp' in trajs.columns:
-        trajs['cum_disp'] = cum_disp(trajs, coords)['cum_disp']
+    segments = Segments(trajs)
+    values = _with_cum_disp(trajs, segments, coords, coords)
+    shifted = _shifted_dif(segments, values, window)
+    measure = _processivity(shifted[:, :-1], shifted[:, -1], signed)
+    return pd.Series(segments.restore(measure), index=trajs.index)
 
-    shifted = by_segments(trajs).apply(shifted_dif_, window,
-                                       coords+['cum_disp'])
-    if signed:
-        measure = np.sign(shifted[coords[0]]) * (np.linalg.norm(shifted[coords], axis=1) /
-                                                 shifted['cum_disp'])
-    else:
-        measure = np.linalg.norm(shifted[coords], axis=1) / shifted['cum_disp']
-    return measure
 
-
-@trajs_measure
+@trajs_measure(requires=['cum_disp'])
 def sld_cum_dir(trajs, window, coords=['x', 'y', 'z']):
     '''
     Window is expressed in t_stamps
     '''
-    if not 'cum_disp' in trajs.columns:
-        trajs['cum_disp'] = cum_disp(trajs, coords)['cum_disp']
+    segments = Segments(trajs)
+    values = _with_cum_disp(trajs, segments, coords, [coords[0]])
+    shifted = _shifted_dif(segments, values, window)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        measure = shifted[:, 0] / shifted[:, 1]
+    return pd.Series(segments.restore(measure), index=trajs.index)
+
+
+def get_MSD(trajs, coords=['x', 'y', 'z'], algorithm='fft', ensemble=False):
+    '''Computes the mean square displacement of each segment, or of the
+    whole set of segments if `ensemble` is True.
+
+    Displacements are computed between points separated by `Dt_stamp`
+    time stamps, so missing time points in a segment are correctly taken
+    into account.
+
+    Parameters
+    ----------
+    trajs : :class:`sktracker.trajectories.Trajectories`
+    coords : list of str
+        The coordinates used to compute the displacements
+    algorithm : {'fft', 'direct'}, default 'fft'
+        'fft' computes all the lags of a segment at once with Fourier
+        transforms (O(T log T)); 'direct' loops over the lags (O(T²)).
+        With 'fft', 'MSD_std' is computed from fourth order moments and
+        is less accurate when it is small compared to 'MSD'.
+    ensemble : bool, default False
+        If True, square displacements of all the segments are pooled together.
+
+    Returns
+    -------
+    MSD : :class:`pandas.DataFrame`
+        Indexed by `(Dt_stamp, label)`, or by `Dt_stamp` if `ensemble` is
+        True, with columns 'MSD', 'MSD_std' and 'Dt', the average time
+        difference corresponding to `Dt_stamp`.
+
+    Notes
+    -----
+    For a segment with points at times :math:`t`, the MSD is given by
 
-    shifted = by_segments(trajs).apply(shifted_dif_, window,
-                                       [coords[0], 'cum_disp'])
-    measure = shifted[coords[0]] / shifted['cum_disp']
-    return measure
+    .. math::
 
+        \\mbox{MSD}(\\Delta t) = \\frac{1}{N(\\Delta t)}\\sum_{t}
+            \\left(\\mathbf{r}(t + \\Delta t)  - \\mathbf{r}(t) \\right)^2
 
-def get_MSD(trajs):
+    where the sum runs over the :math:`N(\\Delta t)` pairs of points
+    separated by :math:`\\Delta t`.
     '''
-    Compute the mean square displacement for each segment.
-    '''
-    dts = trajs.t_stamps - trajs.t_stamps[0]
-    MSD = by_segments(trajs, group_keys=True).apply(compute_MSD_, dts)
-    MSD = MSD.sortlevel(['Dt_stamp', 'label']).swaplevel('Dt_stamp', 'label')
-    MSD['Dt'] = trajs.t.values - trajs.t.iloc[0]
-    return MSD
+    coords = list(coords)
+    if algorithm not in ('fft', 'direct'):
+        raise ValueError("algorithm should be 'fft' or 'direct', not {}".format(algorithm))
+
+    t_stamps = np.unique(trajs.index.get_level_values('t_stamp'))
+    dts = t_stamps - t_stamps[0]
+
+    segments = Segments(trajs)
+    values = segments.take(trajs, coords)
+    times = segments.take(trajs, 't')
+    n_pairs, sq_sums, sq2_sums, dt_sums = _lag_sums(segments, values, times,
+                                                    dts[-1] + 1, algorithm)
+    if ensemble:
+        n_pairs, sq_sums, sq2_sums, dt_sums = [sums.sum(axis=0)[np.newaxis, :]
+                                               for sums in (n_pairs, sq_sums,
+                                                            sq2_sums, dt_sums)]
+    n_pairs, sq_sums, sq2_sums, dt_sums = [sums[:, dts] for sums in
+                                           (n_pairs, sq_sums, sq2_sums, dt_sums)]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        msd = sq_sums / n_pairs
+        var = (sq2_sums - n_pairs * msd**2) / (n_pairs - 1)
+        msd_std = np.sqrt(np.where(n_pairs > 1, np.maximum(var, 0), np.nan))
+        mean_dt = dt_sums / n_pairs
+    msd[:, 0] = 0
+    msd_std[:, 0] = 0
+    mean_dt[:, 0] = 0
+
+    columns = ['MSD', 'MSD_std', 'Dt']
+    data = {'MSD': msd.T.ravel(), 'MSD_std': msd_std.T.ravel(), 'Dt': mean_dt.T.ravel()}
+    if ensemble:
+        index = pd.Index(dts, name='Dt_stamp')
+    else:
+        n_segments = len(segments)
+        index = pd.MultiIndex.from_arrays([np.repeat(dts, n_segments),
+                                           np.tile(segments.unique_labels, dts.size)],
+                                          names=['Dt_stamp', 'label'])
+    return pd.DataFrame(data, index=index, columns=columns)
 
-## Segment pseudo methods
 
+def _lag_sums(segments, values, times, n_lags, algorithm='fft'):
+    '''For each segment and each lag (in t_stamps) up to `n_lags`, computes
+    the number of pairs of points, the sum of their square displacements,
+    the sum of the squares of those, and the sum of their time differences.
 
-#@segment_measure
-def shifted_dif_(segment, shift, coords):
+    Segments are laid on regular t_stamp grids (with a mask for the
+    missing points), grouped by the power of two above their span.
     '''
+    n_segments = len(segments)
+    n_pairs = np.zeros((n_segments, n_lags))
+    sq_sums = np.zeros((n_segments, n_lags))
+    sq2_sums = np.zeros((n_segments, n_lags))
+    dt_sums = np.zeros((n_segments, n_lags))
+
+    # Displacements don't depend on the origin, centering each segment
+    # limits rounding errors in the FFT based sums
+    starts = segments.starts
+    values = values - (np.add.reduceat(values, starts, axis=0)
+                       / segments.lengths[:, np.newaxis])[segments.segment_ids]
+    times = times - (np.add.reduceat(times, starts)
+                     / segments.lengths)[segments.segment_ids]
+
+    t_stamp0 = segments.t_stamps[starts]
+    spans = segments.t_stamps[segments.stops - 1] - t_stamp0 + 1
+    buckets = np.ceil(np.log2(spans)).astype(np.int64)
+    positions = np.empty(n_segments, dtype=np.int64)
+    for bucket in np.unique(buckets):
+        ids = np.flatnonzero(buckets == bucket)
+        length = spans[ids].max()
+        positions.fill(-1)
+        positions[ids] = np.arange(ids.size)
+        rows = np.flatnonzero(positions[segments.segment_ids] >= 0)
+        seg_ids = segments.segment_ids[rows]
+        grid_rows = positions[seg_ids]
+        grid_cols = segments.t_stamps[rows] - t_stamp0[seg_ids]
+
+        mask = np.zeros((ids.size, length))
+        mask[grid_rows, grid_cols] = 1
+        x = np.zeros((ids.size, values.shape[1], length))
+        x[grid_rows, :, grid_cols] = values[rows]
+        t = np.zeros((ids.size, length))
+        t[grid_rows, grid_cols] = times[rows]
+
+        max_lag = min(length, n_lags)
+        if algorithm == 'fft':
+            sums = _fft_lag_sums(mask, x, t, max_lag, 2 ** (bucket + 1))
+        else:
+            sums = _direct_lag_sums(mask, x, t, max_lag)
+        for out, res in zip((n_pairs, sq_sums, sq2_sums, dt_sums), sums):
+            out[ids, :max_lag] = res
+    return n_pairs, sq_sums, sq2_sums, dt_sums
+
+
+def _direct_lag_sums(mask, x, t, n_lags):
+    '''See `_lag_sums`, one lag at a time.
     '''
-    left_shift = - np.floor(shift/2).astype(np.int)
-    right_shift = np.ceil(shift/2).astype(np.int)
-    return segment[coords].shift(left_shift) - segment[coords].shift(right_shift)
+    n_pairs = np.zeros((mask.shape[0], n_lags))
+    sq_sums = np.zeros((mask.shape[0], n_lags))
+    sq2_sums = np.zeros((mask.shape[0], n_lags))
+    dt_sums = np.zeros((mask.shape[0], n_lags))
+    n_pairs[:, 0] = mask.sum(axis=1)
+    for lag in range(1, n_lags):
+        pairs = mask[:, lag:] * mask[:, :-lag]
+        sq_disp = ((x[..., lag:] - x[..., :-lag])**2).sum(axis=1) * pairs
+        n_pairs[:, lag] = pairs.sum(axis=1)
+        sq_sums[:, lag] = sq_disp.sum(axis=1)
+        sq2_sums[:, lag] = (sq_disp**2).sum(axis=1)
+        dt_sums[:, lag] = ((t[:, lag:] - t[:, :-lag]) * pairs).sum(axis=1)
+    return n_pairs, sq_sums, sq2_sums, dt_sums
+
+
+def _fft_lag_sums(mask, x, t, n_lags, n_fft):
+    '''See `_lag_sums`. All the sums are expressed as correlations
+    :math:`\\sum_t a(t + \\Delta t) b(t)` computed through FFT.
+
+    With :math:`r'` and :math:`r` the positions at :math:`t + \\Delta t`
+    and :math:`t`, and :math:`P = r' \\cdot r`, the square displacement
+    is :math:`D = r'^2 + r^2 - 2P`, and
 
+    .. math::
+
+        D^2 = r'^4 + r^4 + 4P^2 + 2r'^2r^2 - 4r'^2P - 4r^2P
 
-#@segment_measure
-def p2p_dif_(segment, t_stamp0, t_stamp1, coords):
     '''
-    Computes the difference of coordinates coords between t_stamp1 and t_stamp0
+    fft = lambda a: np.fft.rfft(a, n_fft)
+
+    def correlate(fa, fb):
+        return np.fft.irfft(fa * fb.conj(), n_fft)[..., :n_lags]
+
+    r2 = (x**2).sum(axis=1)
+    f_mask = fft(mask)
+    f_x = fft(x)
+    f_r2 = fft(r2)
+    f_r4 = fft(r2**2)
+    f_r2x = fft(r2[:, np.newaxis, :] * x)
+    f_t = fft(t)
+
+    n_pairs = np.round(correlate(f_mask, f_mask))
+    sq_sums = (correlate(f_r2, f_mask) + correlate(f_mask, f_r2)
+               - 2 * correlate(f_x, f_x).sum(axis=1))
+    dt_sums = correlate(f_t, f_mask) - correlate(f_mask, f_t)
+
+    p2_sums = np.zeros_like(sq_sums)
+    n_coords = x.shape[1]
+    for i in range(n_coords):
+        for j in range(i, n_coords):
+            f_xx = fft(x[:, i] * x[:, j])
+            p2_sums += (1 if i == j else 2) * correlate(f_xx, f_xx)
+    sq2_sums = (correlate(f_r4, f_mask) + correlate(f_mask, f_r4)
+                + 4 * p2_sums + 2 * correlate(f_r2, f_r2)
+                - 4 * correlate(f_r2x, f_x).sum(axis=1)
+                - 4 * correlate(f_x, f_r2x).sum(axis=1))
+    # Rounding errors
+    no_pairs = n_pairs == 0
+    dt_sums[no_pairs] = 0
+    sq_sums = np.where(no_pairs, 0, np.maximum(sq_sums, 0))
+    sq2_sums = np.where(no_pairs, 0, np.maximum(sq2_sums, 0))
+    return n_pairs, sq_sums, sq2_sums, dt_sums
+
+## Label sorted array methods, see `Segments`
+
+
+def _labels_index(segments):
+    return pd.Index(segments.unique_labels, name='label')
+
+
+def _with_cum_disp(trajs, segments, coords, columns):
+    '''Label sorted values of `columns`, plus the cumulated displacement
+    over `coords` as last column. An existing 'cum_disp' column is used
+    as is.
     '''
-    t_stamps = segment.index.get_level_values('t_stamp')
-    if not {t_stamp0, t_stamp1}.issubset(set(t_stamps)):
-        diff = segment.loc[t_stamps[0]][coords]*np.nan
-    else:
-        diff = segment[coords].loc[t_stamp1] - segment[coords].loc[t_stamp0]
-    return diff
+    cum_disp_ = required_measure(trajs, 'cum_disp', coords=coords)
+    return np.column_stack([segments.take(trajs, columns),
+                            np.asarray(cum_disp_.values, dtype=np.float64)[segments.order]])
 
 
-#@segment_measure
-def cumulative_displacement_(segment, coords):
-    '''Computes the cumulated displacement of the segment given by
+def _processivity(shifted, cum_disp, signed=True):
+    '''Ratio between the net and the cumulated displacements,
+    signed by the displacement along the first coordinate.
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        measure = np.linalg.norm(shifted, axis=1) / cum_disp
+    if signed:
+        measure *= np.sign(shifted[:, 0])
+    return measure
 
-    .. math::
 
-        \begin{aligned}
-        D(0) &= 0\\
-        D(t) &= \sum_{i=1}^{t} \left((x_i - x_{i-1})^2 + (y_i - y_{i-1})^2 + (z_i -
-        z_{i-1})^2\right)^{1/2}\\
-        \end{aligned}
-    '''
-    x, y, z = coords
-    displacement = np.sqrt(segment[x].diff()**2
-                           + segment[y].diff()**2
-                           + segment[z].diff()**2)
-    displacement = displacement.cumsum()
-    displacement.iloc[0] = 0
-    #segment['fwd_frac'] = (segment[x] - segment[x].iloc[0]) / segment['disp']
-    return displacement
+def _shifted_dif(segments, values, shift):
+    '''Difference of `values` between the rows `floor(shift / 2)` after
+    and `ceil(shift / 2)` before each row of the same segment.
+    '''
+    left_shift = - int(np.floor(shift / 2))
+    right_shift = int(np.ceil(shift / 2))
+    return segments.shift(values, left_shift) - segments.shift(values, right_shift)
+
 
+def _p2p_dif(segments, values, t_stamp0, t_stamp1):
+    '''
+    Computes the difference of `values` between t_stamp1 and t_stamp0
+    for each segment, NaN if one of the time stamps is missing.
+    '''
+    return (segments.at_t_stamp(values, t_stamp1)
+            - segments.at_t_stamp(values, t_stamp0))
 
-#@segment_measure
-def compute_MSD_(segment, dts, coords=['x', 'y', 'z']):
-    '''Computes the mean square displacement of the segment given by
+
+def _cumulative_displacement(segments, values):
+    '''Computes the cumulated displacement of each segment given by
 
     .. math::
 
-        \begin{aligned}
-        \mbox{MSD}(\Delta t) &=  \frac{\sum_0^{T - \Delta t}
-            \left(\mathbf{r}(t + \Delta t)  - \mathbf{r}(t) \right)^2}{(T - \Delta t) / \delta t}
-        \end{aligned}
-    '''
-    dts = np.asarray(dts, dtype=np.int)
-    msds = pd.DataFrame(index=pd.Index(dts, name='Dt_stamp'),
-                        columns=['MSD', 'MSD_std'], dtype=np.float)
-    msds.loc[0] = 0, 0
-    for dt in dts[1:]:
-        msd = ((segment[coords]
-                - segment[coords].shift(dt)).dropna()**2).sum(axis=1)
-        msds.loc[dt, 'MSD'] = msd.mean()
-        msds.loc[dt, 'MSD_std'] = msd.std()
-    return msds
+        \\begin{aligned}
+        D(0) &= 0\\\\
+        D(t) &= \\sum_{i=1}^{t} \\left(\\sum_{c}(c_i - c_{i-1})^2\\right)^{1/2}\\\\
+        \\end{aligned}
+
+    where `c` runs over the columns of `values`.
+    '''
+    displacement = np.sqrt((segments.diff(values)**2).sum(axis=1))
+    displacement = segments.cumsum(displacement)
+    displacement[segments.is_start] = 0
+    return displacement
@@ -593,7 +593,8 @@ class Trajectories(pd.DataFrame):
                          time_step=None,
                          keep_speed=True,
                          keep_acceleration=True,
-                         coords=['x', 'y', 'z']):
+                         coords=['x', 'y', 'z'],
+                         parallel=False):
         """
         Interpolates each segment of the trajectories along time
         using `scipy.interpolate.splrep`
@@ -622,6 +623,9 @@ class Trajectories(pd.DataFrame):
            The order of the spline fit. It is recommended to use cubic splines.
            Even order splines should be avoided especially with small s values.
            1 <= k <= 5
+        parallel : bool
+           If True, segments which can't be interpolated in batch are fitted in a
+           process pool.
 
         Returns
         -------
@@ -663,14 +667,16 @@ class Trajectories(pd.DataFrame):
                 else:
                     coords_other.append(coord)
 
-            interpolated = time_interpolate_(self, sampling, s, k, coords_number)
+            interpolated = time_interpolate_(self, sampling, s, k, coords_number,
+                                             parallel=parallel)
 
             for coord in coords_other:
                 interpolated[coord] = self[coord]
 
         else:
 
-            interpolated = time_interpolate_(self, sampling, s, k, coords)
+            interpolated = time_interpolate_(self, sampling, s, k, coords,
+                                             parallel=parallel)
 
         if not keep_speed:
             for coord in interpolated.columns: